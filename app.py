@@ -2,36 +2,11 @@ from chalice import Chalice
 
 from chalicelib.telemetry import xray_recorder
 from chalicelib.app_utils import process_request
+from chalicelib.processor_registry import get_processor
 
 from chalicelib.customer_portal import customer_portal_handler
 from chalicelib.user_organizations import user_organizations_handler
 
-from chalicelib.processors.FlowDiagramProcessor import FlowDiagramProcessor
-from chalicelib.processors.SummaryProcessor import SummarizeProcessor
-from chalicelib.processors.CodeSummarizerProcessor import CodeSummarizerProcessor
-from chalicelib.processors.ExplainProcessor import ExplainProcessor
-from chalicelib.processors.CustomProcessor import CustomProcessor
-from chalicelib.processors.GenerateProcessor import GenerateProcessor
-from chalicelib.processors.ConvertCodeFunctionProcessor import ConvertCodeFunctionProcessor
-from chalicelib.processors.TestGeneratorProcessor import TestGeneratorProcessor
-from chalicelib.processors.TestGeneratorFunctionProcessor import TestGeneratorFunctionProcessor
-from chalicelib.processors.AnalyzeProcessor import AnalyzeProcessor
-from chalicelib.processors.ComplianceProcessor import ComplianceProcessor
-from chalicelib.processors.CodingGuidelinesProcessor import CodingGuidelinesProcessor
-from chalicelib.processors.BlueprintProcessor import BlueprintProcessor
-from chalicelib.processors.SecurityFunctionProcessor import SecurityFunctionProcessor
-from chalicelib.processors.ComplianceFunctionProcessor import ComplianceFunctionProcessor
-from chalicelib.processors.CompareCodeProcessor import CompareCodeProcessor
-from chalicelib.processors.PerformanceProcessor import PerformanceProcessor
-from chalicelib.processors.PerformanceFunctionProcessor import PerformanceFunctionProcessor
-from chalicelib.processors.QuickBlueprintProcessor import QuickBlueprintProcessor
-from chalicelib.processors.DraftBlueprintFunctionProcessor import DraftBlueprintFunctionProcessor
-from chalicelib.processors.QuickSummaryProcessor import QuickSummaryProcessor
-from chalicelib.processors.CustomScanFunctionProcessor import CustomScanFunctionProcessor
-from chalicelib.processors.ChatProcessor import ChatProcessor
-from chalicelib.processors.ChatDriver_FunctionProcessor import ChatDriverFunctionProcessor
-from chalicelib.processors.UIDriver_FunctionProcessor import UIDriverFunctionProcessor
-
 
 app = Chalice(app_name='boost')
 
@@ -45,151 +20,169 @@ app = Chalice(app_name='boost')
 
 @app.lambda_function(name='flowdiagram')
 def flowdiagram(event, _):
-    flowDiagramProcessor = FlowDiagramProcessor()
+    flowDiagramProcessor = get_processor('FlowDiagramProcessor')
     return process_request(event, flowDiagramProcessor.flowdiagram_code, flowDiagramProcessor.api_version)
 
 
 @app.lambda_function(name='summarize')
 def summarize(event, _):
-    summarizeProcessor = SummarizeProcessor()
+    summarizeProcessor = get_processor('SummarizeProcessor')
     return process_request(event, summarizeProcessor.summarize_inputs, summarizeProcessor.api_version)
 
 
 @app.lambda_function(name='codesummarizer')
 def codesummarizer(event, _):
-    codeSummarizerProcessor = CodeSummarizerProcessor()
+    codeSummarizerProcessor = get_processor('CodeSummarizerProcessor')
     return process_request(event, codeSummarizerProcessor.summarize_code, codeSummarizerProcessor.api_version)
 
 
 @app.lambda_function(name='explain')
 def explain(event, _):
-    explainProcessor = ExplainProcessor()
+    explainProcessor = get_processor('ExplainProcessor')
     return process_request(event, explainProcessor.explain_code, explainProcessor.api_version)
 
 
 @app.lambda_function(name='generate')
 def generate(event, _):
-    generateProcessor = GenerateProcessor()
+    generateProcessor = get_processor('GenerateProcessor')
     return process_request(event, generateProcessor.convert_code, generateProcessor.api_version)
 
 
 @app.lambda_function(name='convert_code')
 def convert_code(event, context):
-    convertCodeFunctionProcessor = ConvertCodeFunctionProcessor()
+    convertCodeFunctionProcessor = get_processor('ConvertCodeFunctionProcessor')
     return process_request(event, convertCodeFunctionProcessor.convert_code, convertCodeFunctionProcessor.api_version)
 
 
 @app.lambda_function(name='compare_code')
 def compare_code(event, _):
-    compareCodeProcessor = CompareCodeProcessor()
+    compareCodeProcessor = get_processor('CompareCodeProcessor')
     return process_request(event, compareCodeProcessor.compare_code, compareCodeProcessor.api_version)
 
 
 @app.lambda_function(name='testgen')
 def testgen(event, _):
-    testGeneratorProcessor = TestGeneratorProcessor()
+    testGeneratorProcessor = get_processor('TestGeneratorProcessor')
     return process_request(event, testGeneratorProcessor.testgen_code, testGeneratorProcessor.api_version)
 
 
 @app.lambda_function(name='generate_tests')
 def generate_tests(event, _):
-    testGeneratorFunctionProcessor = TestGeneratorFunctionProcessor()
+    testGeneratorFunctionProcessor = get_processor('TestGeneratorFunctionProcessor')
     return process_request(event, testGeneratorFunctionProcessor.generate_tests, testGeneratorFunctionProcessor.api_version)
 
 
 @app.lambda_function(name='analyze')
 def analyze(event, _):
-    analyzeProcessor = AnalyzeProcessor()
+    analyzeProcessor = get_processor('AnalyzeProcessor')
     return process_request(event, analyzeProcessor.analyze_code, analyzeProcessor.api_version)
 
 
 @app.lambda_function(name='analyze_function')
 def analyze_function(event, _):
-    securityFunctionProcessor = SecurityFunctionProcessor()
+    securityFunctionProcessor = get_processor('SecurityFunctionProcessor')
     return process_request(event, securityFunctionProcessor.secure_code, securityFunctionProcessor.api_version)
 
 
+@app.lambda_function(name='analyze_function_batch')
+def analyze_function_batch(event, _):
+    securityFunctionProcessor = get_processor('SecurityFunctionProcessor')
+    return process_request(event, securityFunctionProcessor.secure_code_batch, securityFunctionProcessor.api_version)
+
+
 @app.lambda_function(name='compliance')
 def compliance(event, context):
-    complianceProcessor = ComplianceProcessor()
+    complianceProcessor = get_processor('ComplianceProcessor')
     return process_request(event, complianceProcessor.compliance_code, complianceProcessor.api_version)
 
 
 @app.lambda_function(name='compliance_function')
 def compliance_function(event, _):
-    complianceFunctionProcessor = ComplianceFunctionProcessor()
+    complianceFunctionProcessor = get_processor('ComplianceFunctionProcessor')
     return process_request(event, complianceFunctionProcessor.check_compliance, complianceFunctionProcessor.api_version)
 
 
+@app.lambda_function(name='compliance_function_batch')
+def compliance_function_batch(event, _):
+    complianceFunctionProcessor = get_processor('ComplianceFunctionProcessor')
+    return process_request(event, complianceFunctionProcessor.check_compliance_batch, complianceFunctionProcessor.api_version)
+
+
 @app.lambda_function(name='codeguidelines')
 def codeguidelines(event, context):
-    codeguidelinesProcessor = CodingGuidelinesProcessor()
+    codeguidelinesProcessor = get_processor('CodingGuidelinesProcessor')
     return process_request(event, codeguidelinesProcessor.checkguidelines_code, codeguidelinesProcessor.api_version)
 
 
 @app.lambda_function(name='performance')
 def performance(event, context):
-    performanceProcessor = PerformanceProcessor()
+    performanceProcessor = get_processor('PerformanceProcessor')
     return process_request(event, performanceProcessor.check_performance, performanceProcessor.api_version)
 
 
 @app.lambda_function(name='performance_function')
 def performance_function(event, context):
-    performanceFunctionProcessor = PerformanceFunctionProcessor()
+    performanceFunctionProcessor = get_processor('PerformanceFunctionProcessor')
     return process_request(event, performanceFunctionProcessor.check_performance, performanceFunctionProcessor.api_version)
 
 
+@app.lambda_function(name='performance_function_batch')
+def performance_function_batch(event, context):
+    performanceFunctionProcessor = get_processor('PerformanceFunctionProcessor')
+    return process_request(event, performanceFunctionProcessor.check_performance_batch, performanceFunctionProcessor.api_version)
+
+
 @app.lambda_function(name='customscan_function')
 def customscan_function(event, context):
-    customScanFunctionProcessor = CustomScanFunctionProcessor()
+    customScanFunctionProcessor = get_processor('CustomScanFunctionProcessor')
     return process_request(event, customScanFunctionProcessor.custom_scan, customScanFunctionProcessor.api_version)
 
 
 @app.lambda_function(name='blueprint')
 def blueprint(event, context):
-    blueprintProcessor = BlueprintProcessor()
+    blueprintProcessor = get_processor('BlueprintProcessor')
     return process_request(event, blueprintProcessor.blueprint_code, blueprintProcessor.api_version)
 
 
 @app.lambda_function(name='quick-blueprint')
 def quick_blueprint(event, context):
-    quickBlueprintProcessor = QuickBlueprintProcessor()
+    quickBlueprintProcessor = get_processor('QuickBlueprintProcessor')
     return process_request(event, quickBlueprintProcessor.quick_blueprint, quickBlueprintProcessor.api_version)
 
 
 @app.lambda_function(name='quick-summary')
 def quick_summary(event, context):
-    quickSummaryProcessor = QuickSummaryProcessor()
+    quickSummaryProcessor = get_processor('QuickSummaryProcessor')
     return process_request(event, quickSummaryProcessor.quick_summary, quickSummaryProcessor.api_version)
 
 
 @app.lambda_function(name='draft-blueprint')
 def draft_blueprint(event, context):
-    draftBlueprintFunctionProcessor = DraftBlueprintFunctionProcessor()
+    draftBlueprintFunctionProcessor = get_processor('DraftBlueprintFunctionProcessor')
     return process_request(event, draftBlueprintFunctionProcessor.draft_blueprint, draftBlueprintFunctionProcessor.api_version)
 
 
 @app.lambda_function(name='chat')
 def chat(event, _):
-    chatProcessor = ChatProcessor()
+    chatProcessor = get_processor('ChatProcessor')
     return process_request(event, chatProcessor.process_chat, chatProcessor.api_version)
 
 
 @app.lambda_function(name='chat_driver')
 def chat_driver(event, _):
-    chatDriverFunctionProcessor = ChatDriverFunctionProcessor()
+    chatDriverFunctionProcessor = get_processor('ChatDriverFunctionProcessor')
     return process_request(event, chatDriverFunctionProcessor.chat_driver, chatDriverFunctionProcessor.api_version)
 
 
 @app.lambda_function(name='ui_driver')
 def ui_driver(event, _):
-    uiDriverFunctionProcessor = UIDriverFunctionProcessor()
+    uiDriverFunctionProcessor = get_processor('UIDriverFunctionProcessor')
     return process_request(event, uiDriverFunctionProcessor.ui_driver, uiDriverFunctionProcessor.api_version)
 
 
 @app.lambda_function(name='customprocess')
 def customprocess(event, _):
-    customProcessor = CustomProcessor()
+    customProcessor = get_processor('CustomProcessor')
     return process_request(event, customProcessor.customprocess_code, customProcessor.api_version)
 
 
@@ -10,7 +10,7 @@ from json.decoder import JSONDecodeError
 from chalice import BadRequestError
 from chalicelib.log import mins_and_secs
 
-from chalicelib.telemetry import cloudwatch, xray_recorder
+from chalicelib.telemetry import aws_telemetry_enabled, xray_recorder, metrics_buffer_scope
 from chalicelib.auth import \
     validate_request_lambda, \
     clean_account, \
@@ -19,6 +19,8 @@ from chalicelib.auth import \
 from chalicelib.aws import \
     init_current_lambda_cost
 
+from chalicelib.usage_reporting import resume_usage_reporting
+
 
 def generate_correlation_id():
     correlation_id = str(uuid.uuid4())
@@ -32,7 +34,7 @@ def handle_exception(e, correlation_id, email, organization, function_name, api_
     exception_info = traceback.format_exc().replace('\n', ' ')
     print(f'BOOST_USAGE: email:{email}, organization:{organization}, function({function_name}:{correlation_id}) FAILED with exception: {exception_info}')
 
-    if cloudwatch is not None:
+    if aws_telemetry_enabled:
         subsegment = xray_recorder.begin_subsegment('exception')
         subsegment.put_annotation('correlation_id', correlation_id)
         subsegment.put_annotation('error', exception_info)
@@ -62,12 +64,22 @@ def common_lambda_logic(event, function_name, handler_function, api_version):
         return process_response(preflight_response, event, function_name)
 
     try:
-        return process_response(handler_function(event, correlation_id), event, function_name)
+        with metrics_buffer_scope():
+            return process_response(handler_function(event, correlation_id), event, function_name)
     except Exception as e:
         return process_response(handle_exception(e, correlation_id, "unknown", "unknown", function_name, api_version), event, function_name)
 
 
+# all metrics captured while processing the request are emitted once, when the request completes
 def process_request(event, function, api_version):
+    # usage left unreported by an earlier invocation is reported in the background, off this request's critical path
+    resume_usage_reporting()
+
+    with metrics_buffer_scope():
+        return process_request_with_metrics_buffer(event, function, api_version)
+
+
+def process_request_with_metrics_buffer(event, function, api_version):
     # Generate a new UUID for the correlation ID
     correlation_id = generate_correlation_id()
 
@@ -123,10 +135,10 @@ def process_request(event, function, api_version):
         organization = json_data.get('organization')
 
         # Capture the duration of the validation step
-        if cloudwatch is not None:
+        if aws_telemetry_enabled:
             with xray_recorder.capture('validate_request_lambda'):
                 # first we check if the account is enabled
-                account = validate_request_lambda(json_data, headers, function.__name__, correlation_id, False)
+                account = validate_request_lambda(json_data, headers, function.__name__, correlation_id, False, deep=False)
 
                 email = account['email'] if 'email' in account else email
                 organization = account['organization'] if 'organization' in account else organization
@@ -138,7 +150,7 @@ def process_request(event, function, api_version):
                     validate_request_lambda(json_data, headers, function.__name__, correlation_id, True)
         else:
             start_time = time.monotonic()
-            account = validate_request_lambda(json_data, headers, function.__name__, correlation_id, False)
+            account = validate_request_lambda(json_data, headers, function.__name__, correlation_id, False, deep=False)
 
             email = account['email'] if 'email' in account else email
             organization = account['organization'] if 'organization' in account else organization
@@ -160,7 +172,7 @@ def process_request(event, function, api_version):
             raise BadRequestError("Error: Unable to determine email address for account")
 
         # Now call the function
-        if cloudwatch is not None:
+        if aws_telemetry_enabled:
             with xray_recorder.capture(function.__name__):
                 result = function(json_data, account, function.__name__, correlation_id)
         else:
@@ -197,7 +209,7 @@ def process_request(event, function, api_version):
         elif service_stage in ('dev', "test", "local"):
             serviceFailureDetails = exception_info
 
-        if cloudwatch is not None:
+        if aws_telemetry_enabled:
             subsegment = xray_recorder.begin_subsegment('exception')
             subsegment.put_annotation('correlation_id', correlation_id)
             subsegment.put_annotation('error', exception_info)
@@ -1,8 +1,10 @@
 import requests
 from chalice import UnauthorizedError
 import re
-from chalicelib.telemetry import cloudwatch, xray_recorder, capture_metric, InfoMetrics
+from chalicelib.telemetry import aws_telemetry_enabled, xray_recorder, capture_metric, InfoMetrics
 import time
+import hashlib
+import threading
 from .payments import check_valid_subscriber, ExtendedAccountBillingError
 from chalicelib.version import API_VERSION
 from chalicelib.log import mins_and_secs
@@ -26,6 +28,11 @@ class ExtendedUnauthorizedError(UnauthorizedError):
 # Create a cache with a time-to-live (TTL) of 5 minutes
 token_2_email_cache = TTLCache(maxsize=100, ttl=300)
 
+# signed identities that have already been verified, keyed by a hash of the signing algorithm and signed identity
+#   cached identities are re-checked for expiration on every use, so an identity never outlives its 'expires'
+verified_identity_cache = TTLCache(maxsize=1000, ttl=300)
+verified_identity_lock = threading.Lock()
+
 
 def request_get_with_retry(url, headers, max_retries=1):
     retry_count = 0
@@ -205,7 +212,7 @@ def fetch_orgs(access_token, requested_organization=None):
 
 # function to get the domain from an email address, returns true if validated, and returns email if found in token
 def validate_github_session(access_token, organization, correlation_id, raiseOnError=True):
-    if cloudwatch is not None:
+    if aws_telemetry_enabled:
         with xray_recorder.capture('fetch_email_and_username'):
             email, username = fetch_email_and_username(access_token, raiseOnError)
     else:
@@ -225,7 +232,7 @@ def validate_github_session(access_token, organization, correlation_id, raiseOnE
         return True, email
 
     # otherwise, we validate the user's requested organization against their GitHub org list
-    if cloudwatch is not None:
+    if aws_telemetry_enabled:
         with xray_recorder.capture('fetch_orgs'):
             orgs = fetch_orgs(access_token, organization)
     else:
@@ -251,10 +258,54 @@ def validate_github_session(access_token, organization, correlation_id, raiseOnE
     return False, email
 
 
+def signed_identity_expired(identity):
+    now = datetime.now().timestamp()
+
+    if identity.get('expires') and identity['expires'] < now:
+        return True
+
+    # standard JWT expiration claim - verified by jwt.decode, but must also be re-checked for cached identities
+    if identity.get('exp') and identity['exp'] < now:
+        return True
+
+    return False
+
+
+# Verify the signed identity (JWT) and return the decoded identity
+#   already verified identities are returned from cache, without fetching the signing key or verifying the signature
+def verify_signed_identity(signed_identity, signing_algorithm):
+    identity_key = hashlib.sha256(f"{signing_algorithm}:{signed_identity}".encode('utf-8')).hexdigest()
+
+    with verified_identity_lock:
+        identity = verified_identity_cache.get(identity_key)
+        if identity is not None and signed_identity_expired(identity):
+            verified_identity_cache.pop(identity_key, None)
+            identity = None
+
+    if identity is None:
+        try:
+            identity = jwt.decode(signed_identity, get_jwt_signing_key(), algorithms=[signing_algorithm])
+        except jwt.InvalidSignatureError:
+            # the signing key may have been rotated since we cached it - so refetch the key and try once more
+            identity = jwt.decode(signed_identity, get_jwt_signing_key(refresh=True), algorithms=[signing_algorithm])
+
+        # Validate expiration time
+        if signed_identity_expired(identity):
+            raise jwt.ExpiredSignatureError("Signed identity expired")
+
+        with verified_identity_lock:
+            verified_identity_cache[identity_key] = identity
+
+    # callers may modify the identity, so don't hand out the cached copy
+    return dict(identity)
+
+
 # function to validate that the request came from a github logged in user or we are running on localhost
 # or that the session token is valid github oauth token for a subscribed email. This version is for the
 # raw lambda function and so has the session key passed in as a string
-def validate_request_lambda(request_json, headers, function_name, correlation_id, raiseOnError=True):
+# deep - compute the full account status (e.g. users, paid invoices) rather than using the cached account status;
+#   defaults to a deep check when not raising errors
+def validate_request_lambda(request_json, headers, function_name, correlation_id, raiseOnError=True, deep=None):
     session = request_json.get('session')
     organization = request_json.get('organization')
     version = request_json.get('version')
@@ -263,17 +314,11 @@ def validate_request_lambda(request_json, headers, function_name, correlation_id
     signed_identity = next((value for key, value in headers.items() if key.lower() == 'x-signed-identity'), None) if headers is not None else None
     if signed_identity:
         try:
-            signing_key = get_jwt_signing_key()  # Function to retrieve the public key
-
             # look for signing algorithm out of headers using same case invariant approach, defaulting to RS256
             signing_algorithm = next((value for key, value in headers.items() if key.lower() == 'x-signing-algorithm'), 'RS256')
 
-            # Decode and verify JWT
-            identity = jwt.decode(signed_identity, signing_key, algorithms=[signing_algorithm])
-
-            # Validate expiration time
-            if identity.get('expires') and identity['expires'] < datetime.now().timestamp():
-                raise jwt.ExpiredSignatureError("Signed identity expired")
+            # Decode and verify JWT (including expiration time)
+            identity = verify_signed_identity(signed_identity, signing_algorithm)
 
             if 'email' not in identity:
                 raise jwt.InvalidTokenError("Invalid signed identity- missing email")
@@ -340,7 +385,7 @@ def validate_request_lambda(request_json, headers, function_name, correlation_id
     signed_user = signed_identity is not None
 
     # if we got this far, we got a valid email. now check that the email is subscribed
-    account = check_valid_subscriber(signed_user, email, organization, correlation_id, not raiseOnError)
+    account = check_valid_subscriber(signed_user, email, organization, correlation_id, not raiseOnError if deep is None else deep)
 
     # if not validated, we need to see if we have a billing error, or if the user is not subscribed
     if not account['enabled']:
@@ -364,6 +409,10 @@ def validate_request_lambda(request_json, headers, function_name, correlation_id
     return account
 
 
+# the account returned to clients with each analysis: enabled, status, operation_cost, operation_expense, org and email
+#   - none of which need a deep check (users, balance_paid and usage_this_month are never returned here). Analysis
+#   requests use the cached account status, so for a paid account (whose status isn't invalidated by its usage) the
+#   status can be up to ACCOUNT_STATUS_CACHE_TTL seconds old; the customer portal always returns a fresh, deep status
 def clean_account(account, email=None, organization=None):
     # if we are in an extreme error path without account info
     #   then return unknown for status and email
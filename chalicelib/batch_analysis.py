@@ -0,0 +1,96 @@
+import contextvars
+import os
+from collections import namedtuple
+
+# Batch analysis - one request analyzes many files for one processor, so authentication, prompt loading and the
+#   fixed prompt overhead are paid once per request (and once per pack of files) instead of once per file
+#
+# Small files are packed together into one code block, each preceded by a header line naming the file. Each pack
+#   is analyzed with line numbers counted from the start of the pack, and the findings are mapped back to the file
+#   (and the file's own line numbers) they fall in. Files too large to share a pack are analyzed alone - and
+#   chunked as usual
+
+batch_max_files = int(os.environ.get('BATCH_MAX_FILES', 500))
+
+# the most tokens of code packed into one analysis - 0 uses half of the processor's input buffer, leaving the
+#   rest for the prompt around the code
+batch_pack_max_tokens = int(os.environ.get('BATCH_PACK_MAX_TOKENS', 0))
+
+# packs analyzed at the same time (each pack's own chunks run in parallel as well)
+batch_max_concurrent_packs = int(os.environ.get('BATCH_MAX_CONCURRENT_PACKS', 4))
+
+# a file's place in a pack
+#   index              - position of the file in the request
+#   start, end         - line range of the file's code in the pack (0-based, end exclusive)
+#   line_number_base   - line number of the file's first line, for reporting findings in the file's own numbering
+PackedFile = namedtuple('PackedFile', ['index', 'name', 'start', 'end', 'line_number_base', 'size'])
+
+Pack = namedtuple('Pack', ['code', 'files'])
+
+# the pack being analyzed in this context, so its usage can be billed per file
+current_batch_pack = contextvars.ContextVar('current_batch_pack', default=None)
+
+
+def file_header(name):
+    return f"==== file: {name} ===="
+
+
+# files is a list of (name, code, line_number_base), count_tokens returns the tokens in a string
+# Returns the packs, largest first - files are placed into the first pack with room (first fit decreasing), so
+#   files end up in as few packs as possible
+def pack_files(files, count_tokens, max_tokens):
+    sized = sorted(((count_tokens(file_header(name) + '\n' + code), index) for index, (name, code, _) in enumerate(files)),
+                   reverse=True)
+
+    bins = []
+    for tokens, index in sized:
+        for packed in bins:
+            if packed['tokens'] + tokens <= max_tokens:
+                packed['tokens'] += tokens
+                packed['indexes'].append(index)
+                break
+        else:
+            bins.append({'tokens': tokens, 'indexes': [index]})
+
+    packs = []
+    for packed in bins:
+        lines = []
+        packed_files = []
+        for index in sorted(packed['indexes']):
+            name, code, line_number_base = files[index]
+            code_lines = code.splitlines()
+            lines.append(file_header(name))
+            packed_files.append(PackedFile(index, name, len(lines), len(lines) + len(code_lines), line_number_base, len(code)))
+            lines.extend(code_lines)
+        packs.append(Pack('\n'.join(lines), packed_files))
+
+    return packs
+
+
+# findings (with lineNumber counted from 1 at the start of the pack) grouped by file index, in the file's own
+#   line numbers - a finding on a file's header line is reported on the file's first line
+def split_findings(findings, pack):
+    findings_by_file = {packed_file.index: [] for packed_file in pack.files}
+
+    for finding in findings:
+        line_number = finding.get('lineNumber')
+        if not isinstance(line_number, int):
+            continue
+
+        line = line_number - 1
+        for packed_file in pack.files:
+            if packed_file.start - 1 <= line < max(packed_file.end, packed_file.start):
+                line = max(line, packed_file.start)
+                findings_by_file[packed_file.index].append(
+                    dict(finding, lineNumber=line - packed_file.start + packed_file.line_number_base))
+                break
+
+    return findings_by_file
+
+
+# each file's share of the pack, by the size of its code
+def file_shares(pack):
+    total_size = sum(packed_file.size for packed_file in pack.files)
+    if total_size == 0:
+        return [1 / len(pack.files)] * len(pack.files)
+    return [packed_file.size / total_size for packed_file in pack.files]
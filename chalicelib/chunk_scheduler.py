@@ -0,0 +1,109 @@
+import heapq
+import time
+from collections import namedtuple
+
+from chalicelib.openai_throttler import latency_estimate_safety_margin, seconds_in_a_minute
+
+# Deadline-aware scheduling for chunked analysis - chunks are started longest first, on as many workers as needed for
+#   the most chunks to finish before the OpenAI call deadline, and a chunk that can't finish before the deadline is
+#   skipped instead of started (a timed out OpenAI call is still billed, and its output is lost)
+#
+# Chunk durations are estimated from the learned OpenAI latency (see openai_latency.py) - until a model has enough
+#   latency samples, chunks are ordered by size, never skipped, and run with the engine's default concurrency
+
+max_chunk_concurrency_default = 32
+
+ChunkSchedule = namedtuple('ChunkSchedule', [
+    'order',             # chunk indexes in the order they should be started
+    'concurrency',       # number of chunks to run at once (None without latency estimates - the engine's default)
+    'skipped',           # chunk indexes that aren't expected to finish before the deadline
+    'predicted_finish',  # chunk index -> predicted seconds from the start until the chunk finishes
+])
+
+
+# Predicted finish time of each chunk (seconds from the start), when run in the given order on `concurrency` workers -
+#   a chunk starts when a worker is free and the rate limit has accrued enough tokens for it
+def simulate_chunk_schedule(order, durations, tokens, concurrency, rate_limit_tokens_per_minute):
+    rate = rate_limit_tokens_per_minute / seconds_in_a_minute
+
+    workers = [0.0] * concurrency
+    tokens_started = 0
+    predicted_finish = {}
+    for index in order:
+        worker_free = heapq.heappop(workers)
+
+        # the rate limit bucket starts full, then refills at the rate limit
+        tokens_started += tokens[index]
+        tokens_available = max(0.0, (tokens_started - rate_limit_tokens_per_minute) / rate)
+
+        predicted_finish[index] = max(worker_free, tokens_available) + durations[index]
+        heapq.heappush(workers, predicted_finish[index])
+
+    return predicted_finish
+
+
+# Plan the order, concurrency and skipped chunks - durations are the estimated seconds for each chunk (None if unknown)
+#   and tokens are each chunk's input + output tokens
+def plan_chunk_schedule(durations, tokens, deadline_seconds, rate_limit_tokens_per_minute,
+                        max_concurrency=max_chunk_concurrency_default):
+    chunk_count = len(durations)
+
+    # longest chunks first - they're the ones that can't finish if started late
+    order = sorted(range(chunk_count), key=lambda index: (durations[index] or 0, tokens[index]), reverse=True)
+
+    # without estimates there's nothing to size the workers by, so the engine keeps its usual concurrency
+    if chunk_count == 0 or any(duration is None for duration in durations):
+        return ChunkSchedule(order, None, set(), {})
+
+    # skip the longest chunks that can't finish (each one frees time for the shorter chunks behind it), until every
+    #   chunk still scheduled is predicted to finish on the most workers we can use
+    skipped = set()
+    while True:
+        scheduled = [index for index in order if index not in skipped]
+        predicted_finish = simulate_chunk_schedule(scheduled, durations, tokens, min(max(1, len(scheduled)), max_concurrency),
+                                                   rate_limit_tokens_per_minute)
+
+        late = [index for index in scheduled if predicted_finish[index] > deadline_seconds]
+        if not late:
+            break
+        skipped.add(late[0])
+
+    # then use the fewest workers that still finish every scheduled chunk in time
+    for concurrency in range(1, max(1, min(len(scheduled), max_concurrency)) + 1):
+        predicted_finish = simulate_chunk_schedule(scheduled, durations, tokens, concurrency, rate_limit_tokens_per_minute)
+        if all(finish <= deadline_seconds for finish in predicted_finish.values()):
+            break
+
+    return ChunkSchedule(scheduled + sorted(skipped, key=order.index), concurrency, skipped, predicted_finish)
+
+
+class ChunkScheduler:
+    # chunks are (input tokens, output tokens) for each chunk
+    def __init__(self, chunks, deadline_seconds, rate_limit_tokens_per_minute, latency_model=None, model=None,
+                 max_concurrency=max_chunk_concurrency_default, clock=time.time):
+        self.deadline_seconds = deadline_seconds
+        self.clock = clock
+        self.start = self.clock()
+
+        self.estimates = [self.estimate_chunk_seconds(latency_model, model, input_tokens, output_tokens)
+                          for input_tokens, output_tokens in chunks]
+
+        self.schedule = plan_chunk_schedule(self.estimates,
+                                            [input_tokens + output_tokens for input_tokens, output_tokens in chunks],
+                                            deadline_seconds, rate_limit_tokens_per_minute, max_concurrency)
+
+    @staticmethod
+    def estimate_chunk_seconds(latency_model, model, input_tokens, output_tokens):
+        if latency_model is None or model is None:
+            return None
+
+        estimate = latency_model.predict(model, input_tokens, output_tokens)
+        return estimate * latency_estimate_safety_margin if estimate is not None else None
+
+    # a chunk can start if it was scheduled, and (now that it's ready to start) is still expected to finish in time
+    def can_start(self, index):
+        if index in self.schedule.skipped:
+            return False
+
+        estimate = self.estimates[index]
+        return estimate is None or (self.clock() - self.start) + estimate <= self.deadline_seconds
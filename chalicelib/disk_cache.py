@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# Disk cache shared by every interpreter process in a sandbox - Lambda's /tmp outlives a process, so a new process
+#   in a warm sandbox starts with the prompts, storage listings and tokenizer data earlier processes fetched
+#
+#   blobs/<sha256>              - contents, addressed by their hash (checked on every read)
+#   entries/<sha256 of key>     - the blob holding the key's contents, and metadata for validating it (e.g. an S3
+#                                 ETag, a timestamp, or when it was last checked)
+#   tiktoken/                   - tiktoken's own download cache (TIKTOKEN_CACHE_DIR), with the hash of each file
+#                                 recorded in tiktoken-hashes.json
+#
+# Enabled by default - disable with useDiskCache=False
+
+disk_cache_directory = os.environ.get('BOOST_DISK_CACHE_DIRECTORY', os.path.join(tempfile.gettempdir(), 'boost-cache'))
+
+
+class DiskCacheStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.remote_fetches = 0
+
+    def record_hit(self, count=1):
+        with self.lock:
+            self.hits += count
+
+    def record_remote_fetch(self, count=1):
+        with self.lock:
+            self.remote_fetches += count
+
+    # hits and remote fetches since the last call - so loads before the first request (e.g. prompts loaded when a
+    #   processor is constructed) are reported with the first request
+    def take(self):
+        with self.lock:
+            stats = {'hits': self.hits, 'remote_fetches': self.remote_fetches}
+            self.hits = 0
+            self.remote_fetches = 0
+            return stats
+
+
+disk_cache_stats = DiskCacheStats()
+
+
+def content_hash(contents):
+    return hashlib.sha256(contents).hexdigest()
+
+
+# write then rename, so no process reads a partially written file
+def write_atomically(path, contents):
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+        f.write(contents)
+    os.replace(f.name, path)
+
+
+class DiskCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'entries'), exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, 'entries', content_hash(key.encode('utf-8')))
+
+    def blob_path(self, blob_hash):
+        return os.path.join(self.directory, 'blobs', blob_hash)
+
+    def get_entry(self, key):
+        try:
+            with open(self.entry_path(key), 'r') as entry_file:
+                entry = json.load(entry_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        return entry if entry.get('key') == key else None
+
+    # the key's (contents, metadata), or None if it isn't cached (or its contents don't match their hash)
+    def get(self, key):
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+
+        try:
+            with open(self.blob_path(entry['hash']), 'rb') as blob_file:
+                contents = blob_file.read()
+        except FileNotFoundError:
+            return None
+
+        if content_hash(contents) != entry['hash']:
+            self.remove(key)
+            return None
+
+        return contents, entry['metadata']
+
+    def put(self, key, contents, metadata):
+        blob_hash = content_hash(contents)
+        if not os.path.exists(self.blob_path(blob_hash)):
+            write_atomically(self.blob_path(blob_hash), contents)
+        self.put_entry(key, blob_hash, metadata)
+
+    # update the metadata of cached contents, e.g. after revalidating them
+    def update_metadata(self, key, metadata):
+        entry = self.get_entry(key)
+        if entry is not None:
+            self.put_entry(key, entry['hash'], metadata)
+
+    def put_entry(self, key, blob_hash, metadata):
+        write_atomically(self.entry_path(key), json.dumps({'key': key, 'hash': blob_hash, 'metadata': metadata}).encode('utf-8'))
+
+    def remove(self, key):
+        try:
+            os.remove(self.entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    def tiktoken_directory(self):
+        return os.path.join(self.directory, 'tiktoken')
+
+    # point tiktoken's download cache into this cache (unless it was configured), and drop any cached tokenizer
+    #   file that doesn't match the hash it had when it was downloaded - returns the files already cached
+    def prepare_tiktoken_cache(self):
+        os.environ.setdefault('TIKTOKEN_CACHE_DIR', self.tiktoken_directory())
+        tiktoken_directory = os.environ['TIKTOKEN_CACHE_DIR']
+        if not tiktoken_directory:
+            return set()  # tiktoken caching disabled
+
+        os.makedirs(tiktoken_directory, exist_ok=True)
+        hashes = self.tiktoken_hashes()
+
+        cached_files = set()
+        for entry in os.scandir(tiktoken_directory):
+            if entry.name.endswith('.tmp') or entry.name == 'tiktoken-hashes.json':
+                continue
+            if entry.name in hashes:
+                with open(entry.path, 'rb') as f:
+                    if content_hash(f.read()) != hashes[entry.name]:
+                        os.remove(entry.path)
+                        continue
+            cached_files.add(entry.name)
+
+        return cached_files
+
+    # record the hashes of the tokenizer files tiktoken downloaded - returns the files that were downloaded
+    def record_tiktoken_cache(self, cached_files):
+        tiktoken_directory = os.environ.get('TIKTOKEN_CACHE_DIR')
+        if not tiktoken_directory or not os.path.isdir(tiktoken_directory):
+            return set()
+
+        hashes = self.tiktoken_hashes()
+        downloaded_files = set()
+        for entry in os.scandir(tiktoken_directory):
+            if entry.name.endswith('.tmp') or entry.name == 'tiktoken-hashes.json' or entry.name in cached_files:
+                continue
+            with open(entry.path, 'rb') as f:
+                hashes[entry.name] = content_hash(f.read())
+            downloaded_files.add(entry.name)
+
+        if downloaded_files:
+            write_atomically(os.path.join(tiktoken_directory, 'tiktoken-hashes.json'), json.dumps(hashes).encode('utf-8'))
+
+        return downloaded_files
+
+    def tiktoken_hashes(self):
+        try:
+            with open(os.path.join(os.environ['TIKTOKEN_CACHE_DIR'], 'tiktoken-hashes.json'), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+
+disk_cache = None
+disk_cache_lock = threading.Lock()
+
+
+# Returns the disk cache for this sandbox, or None if it is disabled (or the directory can't be used)
+def get_disk_cache():
+    global disk_cache
+
+    # use the disk cache by default unless disabled in environment variable
+    useDiskCache = False if "useDiskCache" in os.environ and os.environ["useDiskCache"] == "False" else True
+    if not useDiskCache:
+        return None
+
+    if disk_cache is None:
+        with disk_cache_lock:
+            if disk_cache is None:
+                try:
+                    disk_cache = DiskCache(disk_cache_directory)
+                except OSError as e:
+                    print(f"Disk cache unavailable in {disk_cache_directory}: {e}")
+                    return None
+
+    return disk_cache
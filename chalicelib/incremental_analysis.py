@@ -0,0 +1,151 @@
+import contextvars
+import difflib
+import os
+import re
+import threading
+import uuid
+from collections import namedtuple
+
+from chalicelib.result_cache import make_result_cache_backend
+
+# Incremental re-analysis for the bug-reporting function processors (security, performance, compliance)
+#
+# Each analysis is stored (the code, its first line number and the findings) under an analysis id returned to the
+#   client. When the client sends that id back as previousAnalysisId along with its edited code, only the changed
+#   hunks (plus a few lines of context) are re-analyzed - findings outside the hunks keep their description, with
+#   their lineNumber shifted to where that line moved in the new code
+#
+# Disabled unless the INCREMENTAL_ANALYSIS_STORE environment variable selects a backend, using the same
+#   <type>:<location> settings as ANALYSIS_RESULT_CACHE (local:, s3: or dynamodb:)
+
+incremental_analysis_ttl = int(os.environ.get('INCREMENTAL_ANALYSIS_TTL', 7 * 24 * 60 * 60))  # 1 week
+
+# unchanged lines re-analyzed before and after each changed region, so the changed code is seen in context
+incremental_context_lines = int(os.environ.get('INCREMENTAL_CONTEXT_LINES', 5))
+
+# beyond this many hunks, or this share of the code re-analyzed, a full analysis is cheaper and sees more context
+incremental_max_hunks = int(os.environ.get('INCREMENTAL_MAX_HUNKS', 4))
+incremental_max_reanalyzed_ratio = float(os.environ.get('INCREMENTAL_MAX_REANALYZED_RATIO', 0.5))
+
+# set while the hunks of an incremental analysis are analyzed, so each hunk's usage is charged without notifying the
+#   account - the account is notified once for the request
+incremental_hunk_analysis = contextvars.ContextVar('incremental_hunk_analysis', default=False)
+
+# a range of lines in the new code to re-analyze - start inclusive, end exclusive, 0-based
+Hunk = namedtuple('Hunk', ['start', 'end'])
+
+# how to update a previous analysis for edited code
+#   hunks      - the ranges of the new code to re-analyze
+#   line_map   - for each unchanged line of the old code, its line in the new code (0-based)
+IncrementalPlan = namedtuple('IncrementalPlan', ['hunks', 'line_map'])
+
+
+def plan_incremental_analysis(old_code, new_code, context_lines=incremental_context_lines):
+    old_lines = old_code.splitlines()
+    new_lines = new_code.splitlines()
+
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+
+    line_map = {}
+    changed = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            line_map.update({i1 + offset: j1 + offset for offset in range(i2 - i1)})
+        else:
+            # a deletion has no new lines, so the lines around where it was are re-analyzed
+            changed.append((j1, max(j2, j1 + 1)))
+
+    hunks = []
+    for start, end in changed:
+        start = max(0, start - context_lines)
+        end = min(len(new_lines), end + context_lines)
+        if end <= start:
+            continue  # all of the code was deleted
+        if hunks and start <= hunks[-1].end:
+            hunks[-1] = Hunk(hunks[-1].start, max(hunks[-1].end, end))
+        else:
+            hunks.append(Hunk(start, end))
+
+    return IncrementalPlan(hunks, line_map)
+
+
+def reanalyzed_line_count(plan):
+    return sum(hunk.end - hunk.start for hunk in plan.hunks)
+
+
+def hunk_code(code, hunk):
+    return '\n'.join(code.splitlines()[hunk.start:hunk.end])
+
+
+# the previous findings that still apply - those on unchanged lines outside the re-analyzed hunks, moved to
+#   their line number in the new code
+def carry_forward_findings(findings, plan, old_line_number_base, new_line_number_base):
+    carried = []
+    for finding in findings:
+        line_number = finding.get('lineNumber')
+        if not isinstance(line_number, int):
+            continue
+
+        new_line = plan.line_map.get(line_number - old_line_number_base)
+        if new_line is None or any(hunk.start <= new_line < hunk.end for hunk in plan.hunks):
+            continue
+
+        carried.append(dict(finding, lineNumber=new_line + new_line_number_base))
+
+    return carried
+
+
+# the org and user an analysis belongs to - stored analyses hold the customer's code and findings, so they're only
+#   returned to the account that stored them
+def analysis_owner(account):
+    return {'organization': account.get('organization'), 'email': account.get('email')}
+
+
+class IncrementalAnalysisStore:
+    def __init__(self, backend):
+        self.backend = backend
+
+    # returns the id to re-analyze from
+    def put(self, processor_name, account, code, line_number_base, findings):
+        analysis_id = uuid.uuid4().hex
+        stored = self.backend.put(analysis_id, {'processor': processor_name,
+                                                'owner': analysis_owner(account),
+                                                'code': code,
+                                                'lineNumberBase': line_number_base,
+                                                'findings': findings})
+        return analysis_id if stored else None
+
+    # the stored analysis, or None if it is unknown, expired, from a different processor, or another account's
+    def get(self, processor_name, account, analysis_id):
+        # the id is part of a file path or object key, so only ids we could have issued are looked up
+        if not isinstance(analysis_id, str) or not re.fullmatch(r'[0-9a-f]{32}', analysis_id):
+            return None
+
+        analysis = self.backend.get(analysis_id)
+        if analysis is None or analysis.get('processor') != processor_name:
+            return None
+        if analysis.get('owner') != analysis_owner(account):
+            return None
+        return analysis
+
+
+incremental_analysis_store = None
+incremental_analysis_store_lock = threading.Lock()
+
+
+# Returns the store for previous analyses, or None if incremental analysis is disabled
+def get_incremental_analysis_store():
+    global incremental_analysis_store
+
+    store_setting = os.environ.get('INCREMENTAL_ANALYSIS_STORE')
+    if not store_setting:
+        return None
+
+    with incremental_analysis_store_lock:
+        if incremental_analysis_store is None:
+            backend = make_result_cache_backend(store_setting, 'INCREMENTAL_ANALYSIS_STORE',
+                                                ttl=incremental_analysis_ttl, fields=None)
+            incremental_analysis_store = IncrementalAnalysisStore(backend)
+            print(f"Analyses stored for incremental re-analysis in {store_setting}")
+
+    return incremental_analysis_store
@@ -0,0 +1,136 @@
+import json
+import threading
+import time
+from collections import deque
+
+# Learned OpenAI call latency - each completed call records a (model, input tokens, output tokens, duration) sample,
+#   and a per-model least squares fit of duration = base + input_rate * input_tokens + output_rate * output_tokens
+#   estimates how long a call will take (e.g. for deadline planning in the Throttler)
+#
+# Samples are also logged (OPENAI_LATENCY::) so client/latency_model_report.py can report fit quality offline
+
+# samples kept per model - recent samples only, so the fit tracks OpenAI's current performance
+max_latency_samples = 500
+
+# below this many samples, a model has no estimate
+min_latency_samples_for_fit = 10
+
+latency_log_prefix = "OPENAI_LATENCY::"
+
+
+# solve the normal equations (X'X) b = X'y for a small number of features, with Gaussian elimination
+def least_squares(rows, targets):
+    features = len(rows[0])
+    xtx = [[sum(row[i] * row[j] for row in rows) for j in range(features)] for i in range(features)]
+    xty = [sum(row[i] * target for row, target in zip(rows, targets)) for i in range(features)]
+
+    # a tiny ridge term keeps the system solvable when a feature doesn't vary (e.g. fixed output size)
+    for i in range(features):
+        xtx[i][i] += 1e-6
+
+    augmented = [xtx[i] + [xty[i]] for i in range(features)]
+    for column in range(features):
+        pivot = max(range(column, features), key=lambda row: abs(augmented[row][column]))
+        augmented[column], augmented[pivot] = augmented[pivot], augmented[column]
+        if abs(augmented[column][column]) < 1e-12:
+            return None
+        for row in range(features):
+            if row != column:
+                factor = augmented[row][column] / augmented[column][column]
+                augmented[row] = [value - factor * pivot_value for value, pivot_value in zip(augmented[row], augmented[column])]
+
+    return [augmented[i][features] / augmented[i][i] for i in range(features)]
+
+
+class LatencyModel:
+    def __init__(self, max_samples=max_latency_samples, min_samples=min_latency_samples_for_fit):
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.samples = {}  # model -> deque of (input_tokens, output_tokens, duration)
+        self.fits = {}  # model -> coefficients, refit when new samples arrive
+
+    def record(self, model, input_tokens, output_tokens, duration, log=True):
+        with self.lock:
+            self.samples.setdefault(model, deque(maxlen=self.max_samples)).append((input_tokens, output_tokens, duration))
+            self.fits.pop(model, None)
+
+        if log:
+            print(f"{latency_log_prefix}{json.dumps({'model': model, 'input_tokens': input_tokens, 'output_tokens': output_tokens, 'duration': round(duration, 3), 'timestamp': int(time.time())})}")
+
+    # coefficients (base seconds, seconds per input token, seconds per output token), or None if too few samples
+    def fit(self, model):
+        with self.lock:
+            if model in self.fits:
+                return self.fits[model]
+
+            samples = list(self.samples.get(model, []))
+            if len(samples) < self.min_samples:
+                return None
+
+            coefficients = least_squares([(1.0, input_tokens, output_tokens) for input_tokens, output_tokens, _ in samples],
+                                         [duration for _, _, duration in samples])
+            self.fits[model] = coefficients
+            return coefficients
+
+    # estimated seconds for a call, or None if the model doesn't have enough samples yet
+    def predict(self, model, input_tokens, output_tokens):
+        coefficients = self.fit(model)
+        if coefficients is None:
+            return None
+
+        base, input_rate, output_rate = coefficients
+        # never estimate less than the fastest call we've seen (e.g. if the fit has a negative base)
+        with self.lock:
+            fastest = min(duration for _, _, duration in self.samples[model])
+        return max(fastest, base + input_rate * input_tokens + output_rate * output_tokens)
+
+    # fit quality for the model's samples: sample count, r-squared, root mean squared error and mean absolute error
+    def fit_quality(self, model, samples=None):
+        coefficients = self.fit(model)
+        if coefficients is None:
+            return None
+
+        with self.lock:
+            samples = list(samples if samples is not None else self.samples[model])
+
+        base, input_rate, output_rate = coefficients
+        errors = [duration - (base + input_rate * input_tokens + output_rate * output_tokens)
+                  for input_tokens, output_tokens, duration in samples]
+        mean_duration = sum(duration for _, _, duration in samples) / len(samples)
+        total_variance = sum((duration - mean_duration) ** 2 for _, _, duration in samples)
+
+        return {
+            'samples': len(samples),
+            'r_squared': 1 - sum(error ** 2 for error in errors) / total_variance if total_variance > 0 else 0.0,
+            'rmse': (sum(error ** 2 for error in errors) / len(samples)) ** 0.5,
+            'mae': sum(abs(error) for error in errors) / len(samples),
+        }
+
+
+# latency samples from every OpenAI call in this container
+openai_latency_model = LatencyModel()
+
+
+# record a completed OpenAI call's latency, if the response reports its token usage
+def record_openai_latency(model, response, duration):
+    usage = response.get('usage') if isinstance(response, dict) else None
+    if model is None or usage is None:
+        return
+
+    try:
+        openai_latency_model.record(model, usage['prompt_tokens'], usage['completion_tokens'], duration)
+    # never fail an OpenAI call because its latency couldn't be recorded
+    except Exception as e:
+        print(f"Unable to record OpenAI latency: {str(e)}")
+
+
+def parse_latency_log_line(line):
+    index = line.find(latency_log_prefix)
+    if index < 0:
+        return None
+
+    try:
+        return json.loads(line[index + len(latency_log_prefix):].strip())
+    except json.JSONDecodeError:
+        return None
@@ -0,0 +1,131 @@
+import contextvars
+import json
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import aiohttp
+
+# Rate limits reported by OpenAI in response headers, per model - so the Throttler can track the account's real
+#   tokens-per-minute limit and remaining tokens, rather than a hard-coded default
+#   https://platform.openai.com/docs/guides/rate-limits/rate-limits-in-headers
+
+rate_limits = {}  # model -> {'limit_tokens', 'remaining_tokens', 'reset_tokens', 'observed_at'}
+rate_limits_lock = threading.Lock()
+
+# limits are kept by the model named in the request (e.g. 'gpt-4'), which is what the Throttler looks them up by -
+#   not the 'openai-model' response header, which names the resolved snapshot (e.g. 'gpt-4-0613')
+#
+# the model of the async OpenAI call being made by the current task - aiohttp's trace callbacks don't see the request
+#   body, so the call sets this, and the trace context captures it when the request starts
+openai_request_model = contextvars.ContextVar('openai_request_model', default=None)
+
+duration_pattern = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+duration_units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+
+
+# parse OpenAI reset durations, e.g. "6m0s", "1.5s", "20ms"
+def parse_duration(value):
+    if value is None:
+        return None
+
+    matches = duration_pattern.findall(value)
+    if not matches:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    return sum(float(amount) * duration_units[unit] for amount, unit in matches)
+
+
+def header_value(headers, name):
+    if headers is None:
+        return None
+    return next((value for key, value in headers.items() if key.lower() == name), None)
+
+
+# now is when the headers were received - on the same clock as the Throttler's (wall time by default)
+def record_rate_limit_headers(model, headers, now=None):
+    limit_tokens = header_value(headers, 'x-ratelimit-limit-tokens')
+    remaining_tokens = header_value(headers, 'x-ratelimit-remaining-tokens')
+    if model is None or limit_tokens is None or remaining_tokens is None:
+        return
+
+    try:
+        observed = {
+            'limit_tokens': int(limit_tokens),
+            'remaining_tokens': int(remaining_tokens),
+            'reset_tokens': parse_duration(header_value(headers, 'x-ratelimit-reset-tokens')),
+            'observed_at': now if now is not None else time.time(),
+        }
+    except ValueError:
+        print(f"Unexpected OpenAI rate limit headers for {model}: limit={limit_tokens}, remaining={remaining_tokens}")
+        return
+
+    with rate_limits_lock:
+        rate_limits[model] = observed
+
+
+# the most recent rate limits reported for the model, or None if none have been seen in this container
+def get_rate_limits(model):
+    with rate_limits_lock:
+        observed = rate_limits.get(model)
+        return dict(observed) if observed is not None else None
+
+
+# how long to wait before retrying after a rate limit error, from the error's headers - or None if not reported
+def rate_limit_retry_after(error):
+    headers = getattr(error, 'headers', None)
+
+    retry_after_ms = header_value(headers, 'retry-after-ms')
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = header_value(headers, 'retry-after')
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+
+    return parse_duration(header_value(headers, 'x-ratelimit-reset-tokens'))
+
+
+def request_model(request_body):
+    try:
+        return json.loads(request_body).get('model') if request_body else None
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def capture_rate_limit_headers(response, *args, **kwargs):
+    try:
+        record_rate_limit_headers(request_model(response.request.body), response.headers)
+    # never fail an OpenAI call because the headers couldn't be read
+    except Exception as e:
+        print(f"Unable to capture OpenAI rate limit headers: {str(e)}")
+
+    return response
+
+
+def make_trace_config_ctx(trace_request_ctx=None):
+    return SimpleNamespace(trace_request_ctx=trace_request_ctx, model=openai_request_model.get())
+
+
+async def on_aiohttp_request_end(session, trace_config_ctx, params):
+    try:
+        record_rate_limit_headers(trace_config_ctx.model, params.response.headers)
+    except Exception as e:
+        print(f"Unable to capture OpenAI rate limit headers: {str(e)}")
+
+
+# aiohttp trace config for the async OpenAI client, that records rate limit headers from every response
+def make_rate_limit_trace_config():
+    trace_config = aiohttp.TraceConfig(trace_config_ctx_factory=make_trace_config_ctx)
+    trace_config.on_request_end.append(on_aiohttp_request_end)
+    return trace_config
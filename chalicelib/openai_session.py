@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from chalicelib.openai_rate_limits import capture_rate_limit_headers
+
+# One pooled, keep-alive HTTP session shared by every OpenAI call in the container (see openai.requestssession) - by
+#   default the OpenAI client makes a session per thread, so every chunk thread opens (and TLS handshakes) its own
+#   connection, and closes it again after 3 minutes
+#
+# The pool grows to the chunk concurrency (see ensure_openai_pool_size), and connection stats (new connections,
+#   reused connections and handshake time) are reported with each request's metrics
+
+openai_pool_size_default = int(os.environ.get('OPENAI_POOL_SIZE', 32))
+
+# the OpenAI client's own default (see openai.api_requestor)
+openai_max_connection_retries = 2
+
+
+class ConnectionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.handshake_seconds = 0.0
+
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def record_connection(self, handshake_seconds):
+        with self.lock:
+            self.connections += 1
+            self.handshake_seconds += handshake_seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {'requests': self.requests, 'connections': self.connections, 'handshake_seconds': self.handshake_seconds}
+
+    # requests, new connections, reused connections and total handshake time since an earlier snapshot
+    def since(self, snapshot):
+        current = self.snapshot()
+        requests_made = current['requests'] - snapshot['requests']
+        connections = current['connections'] - snapshot['connections']
+        return {
+            'requests': requests_made,
+            'connections': connections,
+            'reused': max(0, requests_made - connections),
+            'handshake_seconds': current['handshake_seconds'] - snapshot['handshake_seconds'],
+        }
+
+
+openai_connection_stats = ConnectionStats()
+
+
+# connections that time their connect (TCP connect and, for HTTPS, the TLS handshake)
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start_time = time.monotonic()
+        super().connect()
+        openai_connection_stats.record_connection(time.monotonic() - start_time)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start_time = time.monotonic()
+        super().connect()
+        openai_connection_stats.record_connection(time.monotonic() - start_time)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+# the shared session outlives any one caller - the OpenAI client closes its sessions every few minutes, but closing
+#   this one would drop the pooled connections for every other thread
+class PooledSession(requests.Session):
+    def close(self):
+        pass
+
+    def close_pool(self):
+        super().close()
+
+
+openai_session = None
+openai_pool_size = 0
+openai_session_lock = threading.Lock()
+
+
+def mount_pooled_adapter_locked(pool_size):
+    global openai_pool_size
+
+    replaced_adapter = openai_session.adapters.get('https://')
+
+    adapter = PooledHTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=openai_max_connection_retries)
+    openai_session.mount('https://', adapter)
+    openai_session.mount('http://', adapter)
+    openai_pool_size = pool_size
+
+    # close the replaced pool's idle connections, rather than abandoning them open - calls still using one of its
+    #   connections finish normally, and the connection is closed when it's released
+    if isinstance(replaced_adapter, PooledHTTPAdapter):
+        replaced_adapter.close()
+
+
+def count_request(response, *args, **kwargs):
+    openai_connection_stats.record_request()
+    return response
+
+
+# the shared session for OpenAI calls - installed as openai.requestssession, so the OpenAI client calls this for each
+#   thread, and every thread gets the same session
+def get_openai_session():
+    global openai_session
+
+    if openai_session is None:
+        with openai_session_lock:
+            if openai_session is None:
+                session = PooledSession()
+                # record the rate limits OpenAI reports in every response, so the Throttler can track the account's real limits
+                session.hooks['response'].extend([capture_rate_limit_headers, count_request])
+                openai_session = session
+                mount_pooled_adapter_locked(openai_pool_size_default)
+
+    return openai_session
+
+
+# grow the connection pool so each of `concurrency` concurrent calls can keep its own connection alive
+def ensure_openai_pool_size(concurrency):
+    get_openai_session()
+
+    with openai_session_lock:
+        if concurrency > openai_pool_size:
+            print(f"OpenAI connection pool resized from {openai_pool_size} to {concurrency} connections")
+            mount_pooled_adapter_locked(concurrency)
+
+    return openai_pool_size
+
+
+def get_openai_pool_size():
+    return openai_pool_size
@@ -0,0 +1,130 @@
+import json
+import time
+
+from chalicelib.usage import get_token_ledger, tokens_from_function
+
+# Streaming OpenAI responses - deltas are accumulated as they arrive, so a call that runs out of time still returns the
+#   text (or function call arguments) generated so far, instead of nothing; and time to first token is measured
+
+
+# Returns the longest prefix of truncated JSON that can be closed into valid JSON (cut after the last complete value),
+#   closed and parsed - or None if nothing can be salvaged. e.g. '{"bugs": [{"line": 1}, {"li' -> {"bugs": [{"line": 1}]}
+def salvage_partial_json(partial):
+    stack = []
+    in_string = False
+    escaped = False
+    safe_end = None
+    safe_stack = None
+
+    for index, char in enumerate(partial):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+
+        if char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]':
+            if not stack:
+                return None
+            stack.pop()
+            safe_end, safe_stack = index + 1, list(stack)
+        elif char == ',':
+            safe_end, safe_stack = index, list(stack)
+
+    if not stack and not in_string:
+        safe_end, safe_stack = len(partial), []
+
+    if safe_end is None:
+        return None
+
+    try:
+        return json.loads(partial[:safe_end] + ''.join(reversed(safe_stack)))
+    except json.JSONDecodeError:
+        return None
+
+
+class StreamedResponse:
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.first_token_time = None
+        self.role = 'assistant'
+        self.content = []
+        self.function_name = None
+        self.function_arguments = []
+        self.finish_reason = None
+
+    def add(self, chunk):
+        if not chunk.get('choices'):
+            return
+
+        choice = chunk['choices'][0]
+        delta = choice.get('delta', {})
+
+        if self.first_token_time is None and (delta.get('content') or delta.get('function_call')):
+            self.first_token_time = time.time()
+
+        if delta.get('role'):
+            self.role = delta['role']
+        if delta.get('content'):
+            self.content.append(delta['content'])
+        if delta.get('function_call'):
+            if delta['function_call'].get('name'):
+                self.function_name = delta['function_call']['name']
+            if delta['function_call'].get('arguments'):
+                self.function_arguments.append(delta['function_call']['arguments'])
+
+        if choice.get('finish_reason'):
+            self.finish_reason = choice['finish_reason']
+
+    @property
+    def received_tokens(self):
+        return self.first_token_time is not None
+
+    @property
+    def time_to_first_token(self):
+        return self.first_token_time - self.start_time if self.first_token_time is not None else None
+
+    # the runAnalysis result for the response - if the stream was cut off (partial), the content generated so far, or
+    #   the function call arguments salvaged as valid JSON
+    def result(self, params, partial=False):
+        content = ''.join(self.content)
+        arguments = ''.join(self.function_arguments)
+
+        message = {'role': self.role, 'content': content if content else None}
+        discarded = 0
+        if self.function_name is not None or arguments:
+            if partial:
+                # function arguments are always an object
+                salvaged = salvage_partial_json(arguments)
+                salvaged_arguments = json.dumps(salvaged) if isinstance(salvaged, dict) else ''
+                discarded = max(1, len(arguments) - len(salvaged_arguments))
+                arguments = salvaged_arguments
+            message['function_call'] = {'name': self.function_name, 'arguments': arguments}
+
+        # streamed responses don't report usage, so count it
+        ledger = get_token_ledger()
+        model = params.get('model')
+        input_tokens = sum(ledger.num_tokens_from_string(m.get('content') or '', model)[0] for m in params['messages'])
+        input_tokens += tokens_from_function(params, model, ledger)
+        output_tokens = ledger.num_tokens_from_string(content + ''.join(self.function_arguments), model)[0]
+
+        result = dict(
+            message=message,
+            response=content,
+            finish=None if partial else self.finish_reason,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            time_to_first_token=self.time_to_first_token)
+
+        if partial:
+            result['partial'] = True
+            result['discarded'] = discarded
+
+        return result
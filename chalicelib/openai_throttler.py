@@ -1,8 +1,10 @@
+import asyncio
 import threading
 import time
-import random
 
 from chalicelib.usage import OpenAIDefaults
+from chalicelib.rate_limit_backend import rate_limit_bucket_key, bucket_tolerance
+from chalicelib.openai_rate_limits import get_rate_limits
 
 # lambda AWS call must complete in 15 minutes, so our OpenAI call must complete in 12 mins
 max_openai_wait_time_in_mins_before_lambda_timeout_default = 12
@@ -18,109 +20,205 @@ max_timeout_seconds_for_all_openai_calls_default = int(max_openai_wait_time_in_m
 
 max_timeout_seconds_for_single_openai_call_default = int(6 * seconds_in_a_minute)  # 6 minutes
 
+# learned latency estimates are scaled up by this much when planning around the overall deadline, since OpenAI
+#   latency varies from call to call
+latency_estimate_safety_margin = 1.5
 
+
+# Token bucket rate limiter for OpenAI calls - the bucket holds up to a minute of tokens, and refills continuously
+#   at rate_limit_tokens_per_minute / 60 tokens per second. A call that needs more tokens than are in the bucket waits
+#   exactly as long as it takes the bucket to refill the shortfall
 class Throttler:
     def __init__(self,
                  rate_limit_tokens_per_minute=OpenAIDefaults.rate_limit_tokens_per_minute,
                  max_timeout_seconds_for_single_openai_call=max_timeout_seconds_for_single_openai_call_default,
                  max_timeout_seconds_for_all_openai_calls=max_timeout_seconds_for_all_openai_calls_default,
-                 max_openai_wait_time_in_mins_before_lambda_timeout=max_openai_wait_time_in_mins_before_lambda_timeout_default):
+                 max_openai_wait_time_in_mins_before_lambda_timeout=max_openai_wait_time_in_mins_before_lambda_timeout_default,
+                 clock=time.time,
+                 rate_limit_backend=None,
+                 model=None,
+                 latency_model=None):
 
         self.rate_limit_tokens_per_minute = rate_limit_tokens_per_minute if rate_limit_tokens_per_minute is not None else OpenAIDefaults.rate_limit_tokens_per_minute
         self.rate = self.rate_limit_tokens_per_minute / seconds_in_a_minute
-        self.bucket = self.rate_limit_tokens_per_minute
+        self.capacity = self.rate_limit_tokens_per_minute
+        self.bucket = self.capacity
+        self.clock = clock  # injectable for simulation; must match the clock callers use for first_wait
+        self.last_refill = self.clock()
         self.lock = threading.Condition()
         self.max_wait_time = max_openai_wait_time_in_mins_before_lambda_timeout * seconds_in_a_minute
         self.max_timeout_seconds_for_single_openai_call = max_timeout_seconds_for_single_openai_call
         self.max_timeout_seconds_for_all_openai_calls = max_timeout_seconds_for_all_openai_calls
+        self.rate_limit_backend = rate_limit_backend  # shared with other containers (see rate_limit_backend.py), if any
+        self.latency_model = latency_model  # learned call latency (see openai_latency.py), if any
 
-    def get_simple_processing_time_estimate(self, tokens):
-        # Estimate the processing time based on the token count
-        if 0 <= tokens <= 500:
-            return 25
-        elif 500 < tokens <= 3000:
-            return 45
-        elif 3000 < tokens <= 5000:
-            return 90
-        elif 5000 < tokens <= 8000:
-            return 150
-        else:
-            return 180
-
-    def get_weighted_proportional_processing_time_estimate(self, tokens, input_tokens):
-        output_tokens = tokens - input_tokens
-
-        input_weight = 1.3  # input tokens likely cause processing to take longer than output tokens to generate
-        output_weight = 0.7
-
-        # Calculate weighted token count
-        weighted_tokens = int((input_tokens * input_weight) + (output_tokens * output_weight))
+        # the account's real limits for the model, as reported in OpenAI response headers, replace the defaults
+        self.model = model
+        self.rate_limits_observed_at = 0.0
+        with self.lock:
+            if self.apply_observed_rate_limits_locked():
+                self.bucket = self.observed_remaining_tokens_locked()
 
-        # Proportional time estimates based on the given ranges:
-        token_ranges = [500, 3000, 5000, 8000]
-        time_estimates = [25, 45, 90, 150, 180]
+    # add the tokens that have accrued since the last refill
+    def refill_locked(self):
+        now = self.clock()
+        self.bucket = min(self.capacity, self.bucket + (now - self.last_refill) * self.rate)
+        self.last_refill = now
 
-        for i, upper_limit in enumerate(token_ranges):
-            if weighted_tokens <= upper_limit:
-                proportion = weighted_tokens / upper_limit
-                return proportion * float(time_estimates[i])
+    # returns True if OpenAI has reported newer rate limits for the model, which are now applied to the bucket
+    def apply_observed_rate_limits_locked(self):
+        if self.model is None:
+            return False
 
-        # If the weighted_tokens exceeds the highest defined range, return the maximum estimated time.
-        return float(time_estimates[-1])
+        observed = get_rate_limits(self.model)
+        if observed is None or observed['observed_at'] <= self.rate_limits_observed_at:
+            return False
 
-    def get_proportional_processing_time_estimate(self, tokens):
-        # Define data points for tokens and their respective processing times
-        token_ranges = [0, 500, 3000, 5000, 8000]
-        time_estimates = [25, 45, 90, 150, 180]  # in seconds
+        self.observed_rate_limits = observed
+        self.rate_limits_observed_at = observed['observed_at']
 
-        # Find the appropriate range for the given tokens
-        for i in range(1, len(token_ranges)):
-            if tokens <= token_ranges[i]:
-                # Calculate proportional estimate using linear interpolation
-                token_range_diff = token_ranges[i] - token_ranges[i - 1]
-                time_estimate_diff = time_estimates[i] - time_estimates[i - 1]
+        if observed['limit_tokens'] != self.rate_limit_tokens_per_minute:
+            print(f"Thread-{threading.get_ident()}:Throttler: {self.model} rate limit is {observed['limit_tokens']} tokens per minute (was {self.rate_limit_tokens_per_minute})")
 
-                ratio = (tokens - token_ranges[i - 1]) / token_range_diff
-                interpolated_time = time_estimates[i - 1] + ratio * time_estimate_diff
+        self.rate_limit_tokens_per_minute = observed['limit_tokens']
+        self.rate = self.rate_limit_tokens_per_minute / seconds_in_a_minute
+        self.capacity = self.rate_limit_tokens_per_minute
 
-                return int(interpolated_time)
+        # OpenAI's count doesn't include our calls still in flight, so never raise our bucket to match it
+        self.bucket = min(self.bucket, self.observed_remaining_tokens_locked())
 
-        # If tokens exceed the defined range, return the maximum estimated time
-        return time_estimates[-1]
+        return True
 
-    def get_randomized_processing_time_estimate(self, tokens, input_tokens):
-        wait_time = self.get_weighted_proportional_processing_time_estimate(tokens, input_tokens)
+    # the remaining tokens OpenAI reported, refilled for the time since they were reported
+    def observed_remaining_tokens_locked(self):
+        observed = self.observed_rate_limits
+        return min(self.capacity, observed['remaining_tokens'] + max(0.0, self.clock() - observed['observed_at']) * self.rate)
 
-        # Random factor between 0.95 and 1.05
-        random_factor = random.uniform(0.95, 1.05)
+    # returns 0 if the tokens were taken from the bucket, -1 if the throttler is bypassed, or else the exact number
+    #   of seconds until the bucket will hold the tokens needed
+    def get_wait_time(self, tokens_needed, first_wait, input_tokens):
+        delay = self.reserve_tokens(tokens_needed, first_wait, input_tokens)
+        if delay is not None:
+            return delay
 
-        return wait_time * random_factor
+        return self.acquire_reserved_shared_tokens(tokens_needed)
 
-    def get_wait_time(self, tokens_needed, first_wait, input_tokens):
+    # takes the tokens from our own bucket and returns None - so the shared bucket can then be checked without holding
+    #   the lock (see acquire_reserved_shared_tokens) - or else returns the wait time (or -1) as for get_wait_time
+    def reserve_tokens(self, tokens_needed, first_wait, input_tokens):
         with self.lock:
             # if we're going to hit the max overall timeout for calls if we don't start this call, then just start it
             #       and bypass throttler... can't be worse than indefinite hang or exceeding overall timeout
-            if (self.max_timeout_seconds_for_all_openai_calls - self.max_timeout_seconds_for_single_openai_call) < (time.time() - first_wait):
-                print(f"Thread-{threading.get_ident()}:Throttler: {tokens_needed} tokens needed, {self.bucket} tokens available, but max overall timeout for calls is too close, so bypassing throttler")
+            expected_call_seconds = self.expected_call_seconds(tokens_needed, input_tokens)
+            if (self.max_timeout_seconds_for_all_openai_calls - expected_call_seconds) < (self.clock() - first_wait):
+                print(f"Thread-{threading.get_ident()}:Throttler: {tokens_needed} tokens needed, {int(self.bucket)} tokens available, but max overall timeout for calls is too close (call expected to take {expected_call_seconds:.2f} secs), so bypassing throttler")
                 return float(-1)
 
-            if self.bucket >= tokens_needed:
-                print(f"Thread-{threading.get_ident()}:Throttler: {tokens_needed} tokens needed, {self.bucket} tokens available, no wait needed")
-                self.bucket -= tokens_needed
-                return float(0.0)
+            self.refill_locked()
+            self.apply_observed_rate_limits_locked()
 
-            tokens_short = tokens_needed - self.bucket
-
-            # we'll wait the estimate for how long it will take to process the tokens we need
-            wait_time = self.get_randomized_processing_time_estimate(tokens_short, input_tokens)
-
-            return wait_time
+            # a call larger than the bucket can't wait for more than a full bucket - it runs when the bucket is full,
+            #   and the bucket goes into debt, so later calls wait for the bucket to recover
+            tokens_required = min(tokens_needed, self.capacity)
 
+            # (allowing for floating point error, so a caller that waited exactly the wait time isn't asked to wait again)
+            if self.bucket + bucket_tolerance >= tokens_required:
+                self.bucket -= tokens_needed
+                return None
+
+            return (tokens_required - self.bucket) / self.rate
+
+    # the call fits our own bucket (and its tokens are reserved) - but other containers may be using the same rate
+    #   limit. The shared bucket is a network call, so it's made outside the lock - returns 0 if the call can start,
+    #   or else the shared wait time, after giving the reserved tokens back
+    def acquire_reserved_shared_tokens(self, tokens_needed):
+        shared_wait_time = self.acquire_shared_tokens(tokens_needed)
+        if shared_wait_time > 0:
+            with self.lock:
+                self.bucket = min(self.capacity, self.bucket + tokens_needed)
+            print(f"Thread-{threading.get_ident()}:Throttler: {tokens_needed} tokens needed, {int(self.bucket)} tokens available, but shared rate limit needs a wait of {shared_wait_time:.2f} secs")
+            return shared_wait_time
+
+        print(f"Thread-{threading.get_ident()}:Throttler: {tokens_needed} tokens needed, {int(self.bucket) + tokens_needed} tokens available, no wait needed")
+        return float(0.0)
+
+    # How long the call is expected to take - from the learned latency for the model (assuming the call uses all of its
+    #   output tokens, with a safety margin), or else the single call timeout if there isn't enough latency data yet
+    def expected_call_seconds(self, tokens_needed, input_tokens):
+        if self.latency_model is None or self.model is None:
+            return self.max_timeout_seconds_for_single_openai_call
+
+        estimate = self.latency_model.predict(self.model, input_tokens, max(0, tokens_needed - input_tokens))
+        if estimate is None:
+            return self.max_timeout_seconds_for_single_openai_call
+
+        return min(self.max_timeout_seconds_for_single_openai_call, estimate * latency_estimate_safety_margin)
+
+    # returns 0 if the tokens were taken from the shared bucket (or there is no shared bucket), or else the seconds
+    #   until the shared bucket will hold them
+    def acquire_shared_tokens(self, tokens_needed):
+        if self.rate_limit_backend is None:
+            return float(0.0)
+
+        try:
+            return self.rate_limit_backend.try_acquire(rate_limit_bucket_key, tokens_needed, self.capacity, self.rate)
+
+        # never block calls because the shared rate limit is unavailable - fall back to our own bucket
+        except Exception as e:
+            print(f"Thread-{threading.get_ident()}:Throttler: Shared rate limit unavailable, using local rate limit only: {str(e)}")
+            return float(0.0)
+
+    # called when a call completes - the bucket refills over time (not on completion), so this only wakes the waiting
+    #   calls to recheck the bucket
     def refill(self, tokens_needed):
         with self.lock:
-            print(f"Thread-{threading.get_ident()}:Throttler: Refilling bucket (was:{self.bucket}) with {tokens_needed} tokens")
-            self.bucket += tokens_needed
-            self.bucket = min(self.bucket, OpenAIDefaults.rate_limit_tokens_per_minute)
+            self.refill_locked()
 
             # notify all threads they can try again
             self.lock.notify_all()
+
+    # give back tokens taken for a call that was never made (e.g. the chunk was skipped), and wake the waiting calls
+    def return_tokens(self, tokens):
+        with self.lock:
+            self.refill_locked()
+            self.bucket = min(self.capacity, self.bucket + tokens)
+
+        self.refill(tokens)
+
+
+# Throttler for the asyncio chunk engine - waiting for tokens is awaitable, so a waiting chunk doesn't hold a thread
+#   all chunks run on one event loop, so the bucket accounting is shared with (and identical to) the Throttler
+class AsyncThrottler(Throttler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.refilled = asyncio.Event()
+
+    # returns 0 once the tokens are taken from the bucket, or -1 if the throttler was bypassed (see get_wait_time)
+    async def wait_for_tokens(self, tokens_needed, first_wait, input_tokens, log=None):
+        while True:
+            delay = self.reserve_tokens(tokens_needed, first_wait, input_tokens)
+            if delay is None:
+                # the shared bucket's backend (e.g. DynamoDB) is synchronous, so it's called off the event loop
+                if self.rate_limit_backend is not None:
+                    delay = await asyncio.to_thread(self.acquire_reserved_shared_tokens, tokens_needed)
+                else:
+                    delay = self.acquire_reserved_shared_tokens(tokens_needed)
+            if delay <= 0:
+                return delay
+
+            if log is not None:
+                log(f"Waiting up to {delay:.2f} secs for {tokens_needed} tokens ({self.bucket} available)")
+
+            # wait for the specified delay or until tokens are returned to the bucket
+            refilled = self.refilled
+            try:
+                await asyncio.wait_for(refilled.wait(), timeout=float(delay))
+            except asyncio.TimeoutError:
+                pass
+
+    def refill(self, tokens_needed):
+        super().refill(tokens_needed)
+
+        # wake all waiting chunks so they can try again
+        self.refilled.set()
+        self.refilled = asyncio.Event()
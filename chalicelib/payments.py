@@ -7,6 +7,8 @@ from chalice import UnauthorizedError
 import traceback
 import random
 import datetime
+import threading
+from cachetools import TTLCache
 
 from chalicelib.version import API_VERSION
 from chalicelib.telemetry import capture_metric, InfoMetrics
@@ -14,14 +16,21 @@ from . import pvsecret
 from chalicelib.alert import notify_new_customer, notify_customer_first_usage
 from chalicelib.log import mins_and_secs
 from chalicelib.usage import boost_cost_per_kb
+from chalicelib.usage_reporting import queue_usage_record, useAsyncUsageReporting
 
 customerportal_api_version = API_VERSION  # API version is global for now, not service specific
 print("customerportal_api_version: ", customerportal_api_version)
 
-if 'AWS_CHALICE_CLI_MODE' not in os.environ:
+
+# the Stripe key is loaded from the secret store on first Stripe use (not at import), so lambdas that never
+#   call Stripe don't pay for the Secrets Manager round-trip on cold start
+def init_stripe_api_key():
+    if stripe.api_key is not None or 'AWS_CHALICE_CLI_MODE' in os.environ:
+        return
+
     secret_json = pvsecret.get_secrets()
 
-    service_stage = variable_value = os.getenv('CHALICE_STAGE')
+    service_stage = os.getenv('CHALICE_STAGE')
     if (service_stage == "prod" or service_stage == "staging"):
         stripe.api_key = secret_json["stripe_prod"]
         print("Using Production Stripe Key - from Secret Store")
@@ -30,6 +39,19 @@ if 'AWS_CHALICE_CLI_MODE' not in os.environ:
         stripe.api_key = secret_json["stripe_dev"]
 
 
+# computed account status for enabled accounts, keyed by (email, organization, signed) - so repeat requests don't
+#   repeat the 5-10 sequential Stripe calls needed to compute it. Deep checks always bypass (and refresh) the cache,
+#   and entries are invalidated when usage or billing may have changed the status (see invalidate_account_status)
+account_status_cache = TTLCache(maxsize=1000, ttl=int(os.environ.get('ACCOUNT_STATUS_CACHE_TTL', 300)))
+account_status_cache_lock = threading.Lock()
+
+
+def invalidate_account_status(email, organization, signed=None):
+    with account_status_cache_lock:
+        for signed_user in ([True, False] if signed is None else [signed]):
+            account_status_cache.pop((email, organization, signed_user), None)
+
+
 class ExtendedAccountBillingError(UnauthorizedError):
     def __init__(self, message, reason=None):
         super().__init__(message)
@@ -37,6 +59,8 @@ class ExtendedAccountBillingError(UnauthorizedError):
 
 
 def stripe_retry(func, *args, **kwargs):
+    init_stripe_api_key()
+
     retry_count = 0
     max_retries = 1
 
@@ -225,21 +249,32 @@ def check_create_subscription_item(subscription, email):
     return subscription_item
 
 
+# timestamp - when the usage occurred (e.g. for queued usage); defaults to now
+def report_usage_record(subscription_item_id, quantity, timestamp=None, idempotency_key=None):
+    usage_record = {'timestamp': timestamp} if timestamp is not None else {}
+
+    stripe_retry(stripe.SubscriptionItem.create_usage_record,
+                 subscription_item_id,
+                 quantity=quantity,
+                 idempotency_key=idempotency_key if idempotency_key is not None else str(uuid.uuid4()),
+                 **usage_record
+                 )
+
+
 def update_usage(subscription_item, bytes, chargeToCustomer=True):
     # calculate the usage by dividing the bytes by 1024 and rounding up
     usage = math.ceil(bytes / 1024)
-    idempotency_key = str(uuid.uuid4())
 
     # calculate the cost
     cost = usage * boost_cost_per_kb
 
     # update the usage if the customer is being charged
     if chargeToCustomer:
-        stripe_retry(stripe.SubscriptionItem.create_usage_record,
-                     subscription_item.id,
-                     quantity=usage,
-                     idempotency_key=idempotency_key
-                     )
+        if useAsyncUsageReporting:
+            # reported to Stripe in the background, so the request doesn't wait on Stripe
+            queue_usage_record(subscription_item.id, usage)
+        else:
+            report_usage_record(subscription_item.id, usage)
     return cost
 
 
@@ -255,11 +290,21 @@ def update_usage_for_text(account, bytes_of_text, usage_type, chargeToCustomer=T
     # store the operation cost for the caller
     account['operation_cost'] = cost
 
+    notify_account_usage(account, usage_type)
+
+    return cost
+
+
+# once per request that used the account - notify of first usage, and invalidate the account's cached status
+def notify_account_usage(account, usage_type):
     # if we have 0.0 usage, and tracking usage, then notify of first usage
     if 'usage_this_month' in account and account['usage_this_month'] == 0.0:
         notify_customer_first_usage(account['email'], account['org'], usage_type)
 
-    return cost
+    # usage can move an unpaid account out of trial (or past its first usage), so the cached status is stale
+    if account.get('status') != 'paid' or account.get('usage_this_month') == 0.0:
+        if 'email' in account and 'organization' in account:
+            invalidate_account_status(account['email'], account['organization'])
 
 
 SaraPremium_Subscription_ProductId = 'prod_POWlNodbOA6mWx'
@@ -280,6 +325,8 @@ VisualStudioCodeBoost_Subscription_ProductId = 'prod_Np7PkkO9dDn4Cs'
 #   - paid: the customer has a payment method
 #   - active: the customer has no usage, no invoice, no balance, no payment method
 def check_customer_account_status(signed, customer, deep=False):
+    init_stripe_api_key()
+
     account_status = {
         'enabled': False,
         'status': 'active',
@@ -524,6 +571,14 @@ def check_valid_subscriber(signed, email, organization, correlation_id, deep=Fal
     if (organization is None):
         raise Exception("Organization is required to create a subscription account")
 
+    account_status_key = (email, organization, signed)
+    if not deep:
+        with account_status_cache_lock:
+            account_status = account_status_cache.get(account_status_key)
+        if account_status is not None:
+            # callers update the account (e.g. operation_cost), so don't hand out the cached copy
+            return dict(account_status)
+
     customer = check_create_customer(email=email, org=organization, correlation_id=correlation_id)
     if not customer:
         return {'enabled': False, 'status': 'unregistered'}
@@ -547,6 +602,11 @@ def check_valid_subscriber(signed, email, organization, correlation_id, deep=Fal
     account_status["email"] = email
     account_status["organization"] = organization
 
+    # only enabled accounts are cached, so a suspended or expired account sees its billing fix on the next request
+    if account_status['enabled']:
+        with account_status_cache_lock:
+            account_status_cache[account_status_key] = dict(account_status)
+
     return account_status
 
 
@@ -555,4 +615,8 @@ def customer_portal_url(account):
                            customer=account['customer'].id,
                            return_url='https://polyverse.com',
                            )
+
+    # the customer is likely about to change their billing, so recompute their status on the next request
+    invalidate_account_status(account['email'], account['organization'])
+
     return session
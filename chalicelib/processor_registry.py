@@ -0,0 +1,41 @@
+import importlib
+import threading
+
+# processors constructed in this container, keyed by processor class (or processor class name)
+processor_instances = {}
+processor_instances_lock = threading.Lock()
+
+# processor classes that don't live in a module of the same name under chalicelib.processors
+processor_modules = {
+    'SummarizeProcessor': 'SummaryProcessor',
+    'ChatDriverFunctionProcessor': 'ChatDriver_FunctionProcessor',
+    'UIDriverFunctionProcessor': 'UIDriver_FunctionProcessor',
+}
+
+
+# Imports a processor class by name - so each lambda only imports its own processor (and the libraries
+#   that processor needs) on a cold start, instead of importing every processor in app.py
+def load_processor_class(processor_name):
+    module_name = processor_modules.get(processor_name, processor_name)
+    module = importlib.import_module(f"chalicelib.processors.{module_name}")
+    return getattr(module, processor_name)
+
+
+# Returns the shared processor instance for this (warm) container, constructing it on first use
+#   Constructing a processor loads all of its prompts (and validates any function schema), so we only do that
+#   once per container - each call then only refreshes prompts whose file timestamps have changed
+# processor may be a processor class, or the name of a processor class to be imported lazily
+def get_processor(processor):
+    processor_instance = processor_instances.get(processor)
+    if processor_instance is not None:
+        return processor_instance
+
+    with processor_instances_lock:
+        # another thread may have constructed the processor while we waited for the lock
+        processor_instance = processor_instances.get(processor)
+        if processor_instance is None:
+            processor_class = load_processor_class(processor) if isinstance(processor, str) else processor
+            processor_instance = processor_class()
+            processor_instances[processor] = processor_instance
+
+    return processor_instance
@@ -1,7 +1,32 @@
 from chalicelib.processors.FunctionGenericProcessor import FunctionGenericProcessor
+from chalicelib.processors.GenericProcessor import openai_calls_deadline
+from chalicelib.incremental_analysis import (
+    get_incremental_analysis_store,
+    plan_incremental_analysis,
+    reanalyzed_line_count,
+    carry_forward_findings,
+    hunk_code,
+    incremental_max_hunks,
+    incremental_max_reanalyzed_ratio,
+    incremental_hunk_analysis,
+)
+from chalicelib.batch_analysis import (
+    pack_files,
+    split_findings,
+    file_shares,
+    current_batch_pack,
+    batch_max_files,
+    batch_pack_max_tokens,
+    batch_max_concurrent_packs,
+)
+from chalicelib.usage import token_ledger_scope
+from chalicelib.payments import update_usage, notify_account_usage
 from chalice import BadRequestError
 
+import concurrent.futures
+import contextvars
 import json
+import time
 
 
 # the live version does not use startCol and endCol. The line number is calculated from the original line number of the chunk if given,
@@ -80,13 +105,213 @@ class BugFunctionGenericProcessor(FunctionGenericProcessor):
 
         return response
 
+    # code without inputMetadata is numbered from 1, as an editor would (and as the model numbers it, without an
+    #   instruction)
+    def get_line_number_base(self, data):
+        if 'inputMetadata' not in data:
+            return 1
+        inputMetadata = json.loads(data['inputMetadata'])
+        return inputMetadata['lineNumberBase'] if 'lineNumberBase' in inputMetadata else 0
+
     def collect_inputs_for_processing(self, data):
         prompt_format_args = super().collect_inputs_for_processing(data)
 
         if 'inputMetadata' in data:
-            inputMetadata = json.loads(data['inputMetadata'])
-            lineNumberBase = inputMetadata['lineNumberBase'] if 'lineNumberBase' in inputMetadata else 0
+            lineNumberBase = self.get_line_number_base(data)
             prompt_format_args['lineNumberBase'] = f"When identifying source numbers for issues," \
                                                    f" treat the first line of the code as line number {lineNumberBase}"
 
         return prompt_format_args
+
+    # when incremental analysis is enabled, each analysis is stored and its id returned as analysisId - a client
+    #   sending it back as previousAnalysisId with edited code only has the changed hunks re-analyzed
+    def process_input_with_function_output(self, data, account, function_name, correlation_id):
+        store = get_incremental_analysis_store()
+        code = data.get(self.get_chunkable_input())
+        if store is None or not isinstance(code, str):
+            return super().process_input_with_function_output(data, account, function_name, correlation_id)
+
+        def log(message):
+            print(f"{function_name}:{account['email']}:{correlation_id}:{message}")
+
+        processor_name = type(self).__name__
+        line_number_base = self.get_line_number_base(data)
+
+        response = None
+        if 'previousAnalysisId' in data:
+            previous = store.get(processor_name, account, data['previousAnalysisId'])
+            if previous is None:
+                log(f"Previous analysis {data['previousAnalysisId']} not found, analyzing all of the code")
+            else:
+                response = self.process_incremental_input(previous, data, account, function_name, correlation_id, log)
+
+        if response is None:
+            response = super().process_input_with_function_output(data, account, function_name, correlation_id)
+
+        analysis_id = store.put(processor_name, account, code, line_number_base, response.get('details', []))
+        if analysis_id is not None:
+            response['analysisId'] = analysis_id
+
+        return response
+
+    # re-analyze only the hunks of the code changed since the previous analysis, and merge in the previous findings
+    #   on unchanged lines - or None if a full analysis is the better choice
+    def process_incremental_input(self, previous, data, account, function_name, correlation_id, log):
+        code = data[self.get_chunkable_input()]
+        line_number_base = self.get_line_number_base(data)
+
+        plan = plan_incremental_analysis(previous['code'], code)
+        reanalyzed_lines = reanalyzed_line_count(plan)
+        total_lines = max(1, len(code.splitlines()))
+
+        if len(plan.hunks) > incremental_max_hunks or reanalyzed_lines > total_lines * incremental_max_reanalyzed_ratio:
+            log(f"Incremental analysis would re-analyze {reanalyzed_lines} of {total_lines} lines in {len(plan.hunks)} hunks,"
+                f" analyzing all of the code")
+            return None
+
+        findings = carry_forward_findings(previous['findings'], plan, previous['lineNumberBase'], line_number_base)
+        carried_findings = len(findings)
+
+        inputMetadata = json.loads(data['inputMetadata']) if 'inputMetadata' in data else {}
+
+        # the hunks only charge usage - the request's cost is their total, and the account is notified once
+        operation_cost = 0.0
+        hunk_token = incremental_hunk_analysis.set(True)
+        try:
+            for hunk in plan.hunks:
+                hunk_data = dict(data)
+                hunk_data[self.get_chunkable_input()] = hunk_code(code, hunk)
+                hunk_data['inputMetadata'] = json.dumps(dict(inputMetadata, lineNumberBase=line_number_base + hunk.start))
+
+                hunk_response = super().process_input_with_function_output(hunk_data, account, function_name, correlation_id)
+                operation_cost += account.get('operation_cost', 0.0)
+                findings.extend(hunk_response['details'])
+        finally:
+            incremental_hunk_analysis.reset(hunk_token)
+            account['operation_cost'] = operation_cost
+            notify_account_usage(account, function_name)
+
+        findings.sort(key=lambda finding: finding.get('lineNumber') if isinstance(finding.get('lineNumber'), int) else 0)
+
+        log(f"Incremental analysis re-analyzed {reanalyzed_lines} of {total_lines} lines in {len(plan.hunks)} hunks,"
+            f" kept {carried_findings} previous findings")
+
+        return {
+            "status": "bugsfound" if len(findings) > 0 else "nobugsfound",
+            "details": findings
+        }
+
+    # analyzes the list of files in data['files'] (each with a name and code, and optionally inputMetadata) in as
+    #   few analyses as the token budget allows - returns the status and findings of each file, in request order
+    def process_batch_input(self, data, account, function_name, correlation_id):
+        files = data.get('files')
+        if not isinstance(files, list) or not files:
+            raise BadRequestError("Error: please provide a list of files to analyze")
+        if len(files) > batch_max_files:
+            raise BadRequestError(f"Error: please provide at most {batch_max_files} files to analyze in one request")
+        if not all(isinstance(file, dict) and isinstance(file.get(self.get_chunkable_input()), str) for file in files):
+            raise BadRequestError("Error: please provide the code of each file to analyze")
+
+        def log(message):
+            print(f"{function_name}:{account['email']}:{correlation_id}:{message}")
+
+        max_tokens = batch_pack_max_tokens or self.calculate_input_token_buffer(self.get_default_max_tokens(data)) // 2
+
+        with token_ledger_scope() as ledger:
+            packs = pack_files([(file.get('name', str(index)), file[self.get_chunkable_input()],
+                                 self.get_line_number_base(file))
+                                for index, file in enumerate(files)],
+                               lambda text: ledger.num_tokens_from_string(text, data.get('model'))[0],
+                               max_tokens)
+
+        log(f"Batch of {len(files)} files packed into {len(packs)} analyses")
+
+        # all the packs share one deadline for their OpenAI calls, so packs run in later waves can't take the batch
+        #   past the Lambda timeout
+        _, all_ai_calls_timeout, _ = self.get_remaining_call_timeout_settings(data)
+        deadline_token = openai_calls_deadline.set(time.time() + all_ai_calls_timeout)
+
+        try:
+            # each pack runs in the request's context, so it shares the request's metrics buffer (and deadline)
+            request_context = contextvars.copy_context()
+
+            def analyze_pack(pack):
+                return request_context.copy().run(self.analyze_batch_pack, pack, data, account, function_name, correlation_id, log)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(batch_max_concurrent_packs, len(packs))) as executor:
+                pack_results = list(executor.map(analyze_pack, packs))
+        finally:
+            openai_calls_deadline.reset(deadline_token)
+
+        results = [None] * len(files)
+        for pack_result, _ in pack_results:
+            for index, result in pack_result.items():
+                results[index] = dict(result, name=files[index].get('name', str(index)))
+
+        account['operation_cost'] = sum(operation_cost for _, operation_cost in pack_results)
+
+        # the packs only charge usage - the account is notified of the request's usage once
+        notify_account_usage(account, function_name)
+
+        return {"files": results}
+
+    # returns the result for each file in the pack (keyed by the file's index in the request), and the pack's billed cost
+    def analyze_batch_pack(self, pack, data, account, function_name, correlation_id, log):
+        # a pack waiting for an earlier wave may not get to start before the batch's deadline
+        if time.time() >= openai_calls_deadline.get():
+            log(f"Batch analysis of {len(pack.files)} files skipped - the deadline for the batch's OpenAI calls has passed")
+            return {packed_file.index: {"status": "error", "error": "skipped - the batch ran out of time before these files were analyzed", "details": []}
+                    for packed_file in pack.files}, 0.0
+
+        # packs are billed at the same time, so each records its cost in its own copy of the account
+        account = dict(account)
+
+        pack_data = {key: value for key, value in data.items() if key != 'files'}
+        pack_data[self.get_chunkable_input()] = pack.code
+        pack_data['inputMetadata'] = json.dumps({'lineNumberBase': 1})
+
+        current_batch_pack.set(pack)
+
+        try:
+            # the full analysis, without the incremental analysis store
+            response = super().process_input_with_function_output(pack_data, account, function_name, correlation_id)
+        except Exception as e:
+            log(f"Batch analysis of {len(pack.files)} files failed: {str(e)}")
+            return {packed_file.index: {"status": "error", "error": str(e), "details": []} for packed_file in pack.files}, \
+                account.get('operation_cost', 0.0)
+
+        findings_by_file = split_findings(response['details'], pack)
+
+        return {index: {"status": "bugsfound" if len(findings) > 0 else "nobugsfound", "details": findings}
+                for index, findings in findings_by_file.items()}, account.get('operation_cost', 0.0)
+
+    # a batch of files is billed per file - each file is charged its share of the pack's usage
+    def report_usage_cost(self, account, function_name, success, billing_metrics):
+        pack = current_batch_pack.get()
+        if pack is None:
+            if incremental_hunk_analysis.get():
+                return self.report_hunk_usage_cost(account, success, billing_metrics)
+            return super().report_usage_cost(account, function_name, success, billing_metrics)
+
+        # (the first usage notification and account status invalidation run once for the batch, in process_batch_input)
+        billed_cost = 0.0
+        if 'subscription_item' in account:
+            for share in file_shares(pack):
+                billed_cost += update_usage(account['subscription_item'],
+                                            round(billing_metrics.user_messages_size * share) + round(billing_metrics.output_size * share),
+                                            success)
+
+        account['operation_cost'] = billed_cost
+        return billed_cost
+
+    # a hunk of an incremental analysis is charged its usage, but the account is notified once for the request, in
+    #   process_incremental_input
+    def report_hunk_usage_cost(self, account, success, billing_metrics):
+        billed_cost = 0.0
+        if 'subscription_item' in account:
+            billed_cost = update_usage(account['subscription_item'],
+                                       billing_metrics.user_messages_size + billing_metrics.output_size,
+                                       success)
+
+        account['operation_cost'] = billed_cost
+        return billed_cost
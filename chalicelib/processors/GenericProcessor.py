@@ -6,6 +6,9 @@ import math
 import time
 import requests
 import concurrent.futures
+import contextvars
+import asyncio
+import aiohttp
 import threading
 import random
 import json
@@ -22,12 +25,14 @@ from chalicelib.markdown import markdown_emphasize
 from chalicelib.telemetry import capture_metric, InfoMetrics, CostMetrics
 from chalicelib.usage import (
     get_openai_usage_per_token,
-    get_openai_usage_per_string,
     max_tokens_for_model,
     OpenAIDefaults,
-    num_tokens_from_string,
     decode_string_from_input,
-    tokens_from_function)
+    newline_token_boundaries,
+    chunk_end_at_line_boundary,
+    tokens_from_function,
+    get_token_ledger,
+    token_ledger_scope)
 from chalicelib.storage import (
     get_file,
     get_file_time,
@@ -37,12 +42,49 @@ from chalicelib.payments import update_usage_for_text
 from chalicelib.log import mins_and_secs
 from chalicelib.openai_throttler import (
     Throttler,
+    AsyncThrottler,
     max_timeout_seconds_for_all_openai_calls_default,
     max_timeout_seconds_for_single_openai_call_default,
     total_analysis_time_buffer_default,
 )
 
+from chalicelib.rate_limit_backend import get_rate_limit_backend
+from chalicelib.openai_rate_limits import (
+    make_rate_limit_trace_config,
+    openai_request_model,
+    record_rate_limit_headers,
+    rate_limit_retry_after
+)
+from chalicelib.openai_latency import openai_latency_model, record_openai_latency
+from chalicelib.chunk_scheduler import ChunkScheduler
+from chalicelib.openai_streaming import StreamedResponse
+from chalicelib.prompt_template import PromptTemplate, SafeDict
+from chalicelib.result_cache import get_result_cache, make_result_cache_key
+from chalicelib.single_flight import (
+    analysis_flights,
+    get_analysis_lease,
+    analysis_lease_poll_interval
+)
+from chalicelib.openai_session import (
+    get_openai_session,
+    ensure_openai_pool_size,
+    get_openai_pool_size,
+    openai_connection_stats
+)
 from chalicelib.aws import get_current_lambda_cost
+from chalicelib.disk_cache import disk_cache_stats
+
+# when the request's time for OpenAI calls runs out (wall time) - each chunk runs in a copy of the request's context
+openai_calls_deadline = contextvars.ContextVar('openai_calls_deadline', default=None)
+
+# errors that end a streamed OpenAI call early - by either transport (requests, or aiohttp for the async engine)
+streaming_call_errors = (TimeoutError, asyncio.TimeoutError, openai.error.OpenAIError, requests.exceptions.RequestException, aiohttp.ClientError)
+
+
+def check_streaming_timeout(start_time, timeBufferRemaining):
+    if time.time() - start_time > timeBufferRemaining:
+        raise TimeoutError(f"Timeout exceeded for OpenAI streaming call: {mins_and_secs(timeBufferRemaining)}")
+
 
 key_ChunkedInputs = 'chunked_inputs'
 key_ChunkPrefix = 'chunk_prefix'
@@ -53,11 +95,20 @@ key_ChunkingPrompt = 'chunking'
 # Define the directory where prompt files are stored
 PROMPT_DIR = "prompts"
 
-secret_json = pvsecret.get_secrets()
 
-# TEMP - put this back to the polyverse key once gpt-4 access is approved there
-openai_key = secret_json["openai-personal"]
-openai.api_key = openai_key
+# every thread shares one pooled, keep-alive session for OpenAI calls (which also records the rate limits OpenAI reports)
+openai.requestssession = get_openai_session
+
+
+# the OpenAI key is loaded from the secret store on the first OpenAI call (not at import), to keep cold starts fast
+def init_openai_api_key():
+    if openai.api_key is not None:
+        return
+
+    secret_json = pvsecret.get_secrets()
+
+    # TEMP - put this back to the polyverse key once gpt-4 access is approved there
+    openai.api_key = secret_json["openai-personal"]
 
 
 class AnalysisOutputFormat:
@@ -152,6 +203,9 @@ class GenericProcessor:
 
         print(f"{self.__class__.__name__}_api_version: ", self.api_version)
 
+        # processors are shared across calls in a warm container, so prompt refreshes are serialized
+        self.prompts_lock = threading.RLock()
+
         self.prompts = None
         self.load_prompts()
 
@@ -159,6 +213,10 @@ class GenericProcessor:
         return get_file(os.path.join(PROMPT_DIR, prompt_filename))
 
     def load_prompts(self):
+        with self.prompts_lock:
+            self.load_prompts_locked()
+
+    def load_prompts_locked(self):
 
         # if prompts already loaded and file timestamps have not changed, do nothing
         if self.prompts is not None and not self.check_prompt_files_changed():
@@ -168,39 +226,45 @@ class GenericProcessor:
         # otherwise load the prompts
         prompts = []
 
-        # load prompts specified in 'prompt_filenames'
+        # load prompts specified in 'prompt_filenames' - each prompt is compiled once here, so it doesn't need to be
+        #   parsed again for each request
         for prompt_filename in self.prompt_filenames:
-            prompts.append([prompt_filename, self.load_prompt(prompt_filename[1])])
+            prompts.append([prompt_filename, PromptTemplate(self.load_prompt(prompt_filename[1]))])
 
         # load numbered prompts
-        for prompt_key in self.numbered_prompt_keys if self.numbered_prompt_keys is not None else []:
-            # if the definition is a prompt & response pairing, load both files and process in order
-            if prompt_key[0] == 'response':
-                for file in search_storage(PROMPT_DIR, f"{prompt_key[1]}-user-*.prompt"):
-
-                    response_user_prompt_filename = os.path.basename(file)
-
-                    # response has a user prompt....
-                    prompts.append([["user", response_user_prompt_filename], get_file(file)])
-
-                    # construct the corresponding assistant file name
-                    assistant_file = file.replace("-user-", "-assistant-")
-                    response_assistant_prompt_filename = os.path.basename(assistant_file)
-
-                    prompts.append([["assistant", response_assistant_prompt_filename], get_file(assistant_file)])
-            else:
-                file_list = search_storage(PROMPT_DIR, f"{prompt_key[1]}-{prompt_key[0]}-*.prompt")
-
-                for file in file_list:
-                    dynamic_filename = os.path.basename(file)
-                    prompts.append([[prompt_key[0], dynamic_filename], get_file(file)])
+        for role, file in self.numbered_prompt_files():
+            prompts.append([[role, os.path.basename(file)], PromptTemplate(get_file(file))])
 
         self.prompts = prompts
 
         # Store the last modification timestamps in the cache
         self.cache_prompt_files_timestamps()
 
+    # the numbered prompt files in storage, as [role, file] in prompt order - the patterns are resolved against the
+    #   storage listing index, so this doesn't list storage again until the listing is refreshed
+    def numbered_prompt_files(self):
+        files = []
+        for prompt_key in self.numbered_prompt_keys if self.numbered_prompt_keys is not None else []:
+            # if the definition is a prompt & response pairing, include both files in order
+            if prompt_key[0] == 'response':
+                for file in search_storage(PROMPT_DIR, f"{prompt_key[1]}-user-*.prompt"):
+                    # response has a user prompt, and the corresponding assistant file
+                    files.append(["user", file])
+                    files.append(["assistant", file.replace("-user-", "-assistant-")])
+            else:
+                for file in search_storage(PROMPT_DIR, f"{prompt_key[1]}-{prompt_key[0]}-*.prompt"):
+                    files.append([prompt_key[0], file])
+
+        return files
+
     def check_prompt_files_changed(self):
+        # numbered prompts added or removed since the prompts were loaded
+        loaded_numbered_prompts = [prompt[0] for prompt in self.prompts[len(self.prompt_filenames):]]
+        numbered_prompts = [[role, os.path.basename(file)] for role, file in self.numbered_prompt_files()]
+        if numbered_prompts != loaded_numbered_prompts:
+            print(f"{self.__class__.__name__}: Numbered prompts have changed: {[prompt[1] for prompt in numbered_prompts]}")
+            return True
+
         # since prompts contains dynamic prompts, we'll build a temporary list
         #   of static and dynamic prompt filenames to check for changes
         prompts_to_check = self.prompt_filenames.copy()
@@ -241,8 +305,8 @@ class GenericProcessor:
     def cache_prompt_files_timestamps(self):
         # Store the last modification timestamps in the cache
         self.prompt_files_timestamps = {}
-        for prompt_filename in self.prompt_filenames:
-            file_path = os.path.join(PROMPT_DIR, prompt_filename[1])
+        for prompt in self.prompts:
+            file_path = os.path.join(PROMPT_DIR, prompt[0][1])
             self.prompt_files_timestamps[file_path] = get_file_time(file_path)
 
     def insert_context(self, data, newContext):
@@ -256,8 +320,10 @@ class GenericProcessor:
         data['context'].append(newContext)
 
     def optimize_content(self, this_messages: List[Dict[str, Any]], data) -> Tuple[List[Dict[str, Any]], int]:
+        ledger = get_token_ledger()
+
         def truncate_system_message(sys_message, index, total_system_buffer, total_system_tokens):
-            sys_token_count, sys_tokens = num_tokens_from_string(sys_message['content'], data.get('model'))
+            sys_token_count, sys_tokens = ledger.num_tokens_from_string(sys_message['content'], data.get('model'))
             proportion = sys_token_count / total_system_tokens
             min_quota = max(min_token_quota, int(total_system_buffer * min_quota_percent))
             retained_tokens = int(min(max_quota, max(min_quota, int(total_system_buffer * proportion))))
@@ -277,9 +343,9 @@ class GenericProcessor:
         training_messages = [message for message in system_messages if message['role'] != 'system']
 
         # count total token length in all non-empty messages excluding the first and last messages
-        total_system_tokens = sum(num_tokens_from_string(message['content'], data.get('model'))[0]
+        total_system_tokens = sum(ledger.num_tokens_from_string(message['content'], data.get('model'))[0]
                                   for message in this_messages)
-        total_training_tokens = sum(num_tokens_from_string(message['content'], data.get('model'))[0]
+        total_training_tokens = sum(ledger.num_tokens_from_string(message['content'], data.get('model'))[0]
                                     for message in this_messages if message['role'] != 'system')
 
         total_system_buffer = self.calculate_system_message_token_buffer(data.get('max_tokens', self.get_default_max_tokens(data)))
@@ -392,6 +458,8 @@ class GenericProcessor:
                                          extra_non_message_content_size,
                                          ) -> Tuple[List[Tuple[List[dict[str, any]], int, int]], int]:
 
+        ledger = get_token_ledger()
+
         truncation = 0
         # get the ideal full prompt - then we'll figure out if we need to break it up further
         this_messages = self.generate_messages(data, prompt_format_args)
@@ -399,7 +467,7 @@ class GenericProcessor:
         truncation += this_truncation
 
         full_message_content_tokens_count = sum(
-            num_tokens_from_string(message["content"], data.get('model'))[0] for message in this_messages)
+            ledger.num_tokens_from_string(message["content"], data.get('model'))[0] for message in this_messages)
 
         # if we can fit the chunk into one token buffer, we'll process and be done
         max_tokens = self.get_default_max_tokens(data)
@@ -422,7 +490,7 @@ class GenericProcessor:
         # we're going to extract ONLY the bit of user-content (not the prompt wrapper) that we can try and break up
         chunkable_input = prompt_format_args[self.get_chunkable_input()]
         is_chunked_list = isinstance(data[self.get_chunkable_input()], list)
-        chunkable_user_content_token_count, chunkable_user_content_tokens = num_tokens_from_string(
+        chunkable_user_content_token_count, chunkable_user_content_tokens = ledger.num_tokens_from_string(
             chunkable_input, data.get('model'))
 
         # let's figure out how big the non-user content is... since we'll create user chunks that can accomodate the non-user content added back
@@ -458,6 +526,9 @@ class GenericProcessor:
 
         this_messages_chunked = []
 
+        # for list inputs, find all the line boundaries in one pass, so each chunk end is a single lookup
+        newline_boundaries = newline_token_boundaries(chunkable_user_content_tokens, data.get('model')) if is_chunked_list else []
+
         i = 0
         # process all the tokens in the user content to create the chunks
         while i < len(chunkable_user_content_tokens):
@@ -469,27 +540,18 @@ class GenericProcessor:
                 end_idx = len(chunkable_user_content_tokens)
 
             # if we're using a list as input, then break on newlines
-            # if we're not at the end of the tokens, adjust end_idx based on the decoding result
+            # if we're not at the end of the tokens, move end_idx back to the last newline token in this chunk
+            #   (the newline token is included in this chunk, and the next chunk starts after it)
             # note the last token may not be a newline
             if is_chunked_list and end_idx != len(chunkable_user_content_tokens):
-                decoded_token = decode_string_from_input([chunkable_user_content_tokens[end_idx - 1]], data.get('model'))
-
-                # move the boundary backward until we hit a token that decodes to a newline or the beginning of the chunk
-                while end_idx > i and '\n' not in decoded_token:
-                    end_idx -= 1
-                    decoded_token = decode_string_from_input([chunkable_user_content_tokens[end_idx - 1]], data.get('model'))
-
-                # If the token has text followed by a newline, then we should include that token in the current chunk
-                # and start the next chunk after it.
-                if decoded_token.endswith('\n'):
-                    end_idx += 1
+                end_idx = chunk_end_at_line_boundary(newline_boundaries, i, end_idx)
 
             # decode this smaller chunk of the original user content
             user_chunk_tokens = chunkable_user_content_tokens[i:end_idx]
             user_chunk_text = decode_string_from_input(user_chunk_tokens, data.get('model'))
 
             # we use the unbuffered count of the actual tokens (e.g. excluding the tokenization variance buffer)
-            these_tokens_count = len(num_tokens_from_string(user_chunk_text, data.get('model'))[1])
+            these_tokens_count = len(ledger.tokens_from_string(user_chunk_text, data.get('model')))
             chunk_decoded_size_change = these_tokens_count - (end_idx - i)
             # if the increase is larger than our boundary deviation, we're going to fail
             if chunk_decoded_size_change / (end_idx - i) > token_boundary_deviation_variance:
@@ -508,7 +570,7 @@ class GenericProcessor:
             truncation += this_truncation
 
             these_tokens_count = sum(
-                num_tokens_from_string(message["content"], data.get('model'))[0] for message in this_messages)
+                ledger.num_tokens_from_string(message["content"], data.get('model'))[0] for message in this_messages)
 
             if these_tokens_count > input_token_buffer:
                 message_regeneration_variance = (these_tokens_count - input_token_buffer) / input_token_buffer
@@ -587,6 +649,8 @@ class GenericProcessor:
         return ensure_max_output_token_limit(data, desired_output_size)
 
     def truncate_user_messages(self, messages: List[dict[str, any]], input_token_buffer, data):
+        ledger = get_token_ledger()
+
         truncated_token_count = 0
         discarded_token_count = 0
         discard_future_messages = False  # Flag to indicate if further messages should be discarded
@@ -600,12 +664,12 @@ class GenericProcessor:
                 continue
 
             if discard_future_messages:
-                discarded_token_count += num_tokens_from_string(message["content"], data.get('model'))[0]
+                discarded_token_count += ledger.num_tokens_from_string(message["content"], data.get('model'))[0]
                 discarded_messages += 1
                 message['content'] = ""
                 continue
 
-            token_count, user_tokens = num_tokens_from_string(message["content"], data.get('model'))
+            token_count, user_tokens = ledger.num_tokens_from_string(message["content"], data.get('model'))
 
             if truncated_token_count + token_count > input_token_buffer:
                 remaining_tokens = input_token_buffer - truncated_token_count
@@ -637,10 +701,12 @@ class GenericProcessor:
         else:
             input_token_buffer = 0
 
+        ledger = get_token_ledger()
+
         truncated = 0
 
         # calculate the size of the function-related content for input buffer usage
-        function_content_size = tokens_from_function(params, data.get('model'))
+        function_content_size = tokens_from_function(params, data.get('model'), ledger)
 
         model_max_tokens = self.get_default_max_tokens(data)
 
@@ -649,7 +715,7 @@ class GenericProcessor:
             this_messages = self.generate_messages(data, prompt_format_args)
             this_messages = self.optimize_content(this_messages, data)[0]
 
-            input_tokens_count = sum(num_tokens_from_string(
+            input_tokens_count = sum(ledger.num_tokens_from_string(
                 message["content"], data.get('model'))[0] for message in this_messages if 'content' in message)
 
             # reduce the input_token_buffer by the size of the function input content, since its fixed
@@ -748,12 +814,7 @@ class GenericProcessor:
         raise NotImplementedError
 
     def safe_format(self, string, **kwargs):
-        class SafeDict(dict):
-            def __missing__(self, key):
-                return ''
-
-        safe_dict = SafeDict(kwargs)
-        return string.format_map(safe_dict)
+        return string.format_map(SafeDict(kwargs))
 
     def safe_dict(self, d):
         return {k: v if v is not None else '' for k, v in d.items()}
@@ -782,13 +843,13 @@ class GenericProcessor:
             # context prompts are special - they are only included if the tags are present
             #   and they can replicate depending on number of context inputs
             if prompt[0][1].startswith('context-'):
-                if any(tag not in prompt_format_args for tag in re.findall(r'\{(.+?)\}', prompt[1])):
+                if any(tag not in prompt_format_args for tag in prompt[1].tag_set):
                     print(f"Skipping {prompt[0][0]} prompt {prompt[0][1]} due to missing tags")
                     continue
 
             expandedList = 0
             # Check if this prompt text contains a '{tag}' that exists in our reformatting args
-            for tag in re.findall(r'\{(.+?)\}', prompt[1]):
+            for tag in prompt[1].tags:
                 if tag not in prompt_format_args:
                     continue
 
@@ -799,12 +860,9 @@ class GenericProcessor:
                 role, content_list = prompt_format_args[tag]
                 for content in content_list:
 
-                    def expand_prompt_content(raw_prompt, prompt_format_args, role, content):
+                    def expand_prompt_content(prompt_template, prompt_format_args, role, content):
                         # inject each piece of custom content into the prompt
-                        this_prompt_format_args = prompt_format_args.copy()
-
-                        this_prompt_format_args[tag] = content
-                        formatted_content = self.safe_format(raw_prompt, **this_prompt_format_args)
+                        formatted_content = prompt_template.render(prompt_format_args, tag, content)
 
                         if str.isspace(formatted_content):
                             print(f"Skipping empty prompt for role {role}")
@@ -844,7 +902,7 @@ class GenericProcessor:
 
                 continue
 
-            content = self.safe_format(prompt[1], **prompt_format_args)
+            content = prompt[1].render(prompt_format_args)
             # skip empty content
             if str.isspace(content):
                 print(f"Skipping empty {prompt[0][0]} prompt {prompt[0][1]}")
@@ -860,7 +918,7 @@ class GenericProcessor:
             raise ValueError("Main (User) prompt is required but not found")
 
         # Check if main prompt contains a '{tag}' that exists in data
-        for tag in re.findall(r'\{(.+?)\}', main_prompt):
+        for tag in main_prompt.tags:
             if isinstance(prompt_format_args.get(tag), list):
                 new_format_arg = ""
                 _, content_list = prompt_format_args[tag]
@@ -873,68 +931,238 @@ class GenericProcessor:
         # 'main' is always the last message and it's always from the 'user'
         this_messages.append({
             "role": "user",
-            "content": self.safe_format(main_prompt, **prompt_format_args)
+            "content": main_prompt.render(prompt_format_args)
         })
 
         return this_messages
 
-    def makeOpenAICall(self, function_name, attempt, timeBufferRemaining, params) -> dict:
+    # the log line for the start or finish of an OpenAI call - shared by the threaded and async calls, which differ
+    #   only in their log prefix (the thread or task making the call)
+    def openai_call_message(self, log_prefix, status, params, attempt, start_time, streaming=False, details="") -> str:
+        call_kind = "streaming API call" if streaming else "API call"
+        return (f"{log_prefix}:{status}:Finished OpenAI {params.get('model', 'unknown')} {call_kind} "
+                f"(Attempt {attempt + 1} in {mins_and_secs(time.time() - start_time)}{details})")
+
+    def startOpenAICall(self, log_prefix, attempt, timeBufferRemaining, params, streaming=False) -> float:
+
+        init_openai_api_key()
 
         due_time = datetime.datetime.now() + datetime.timedelta(seconds=timeBufferRemaining)
 
-        print(f"Thread-{threading.current_thread().ident}-{function_name}:Starting OpenAI {params.get('model', 'unknown')} API call attempt {attempt + 1},Time Allotted {mins_and_secs(timeBufferRemaining)}, Due By {due_time})")
+        call_kind = "streaming API call" if streaming else "API call"
+        print(f"{log_prefix}:Starting OpenAI {params.get('model', 'unknown')} {call_kind} attempt {attempt + 1},Time Allotted {mins_and_secs(timeBufferRemaining)}, Due By {due_time})")
 
-        start_time = time.time()
+        return time.time()
+
+    def finishOpenAICall(self, log_prefix, attempt, params, response, start_time):
+        record_openai_latency(params.get('model'), response, time.time() - start_time)
+
+        print(self.openai_call_message(log_prefix, "SUCCESS", params, attempt, start_time))
+
+    # the result of a streamed call that failed - the partial result if tokens had arrived, otherwise the error is raised
+    def handleStreamingError(self, e, log_prefix, attempt, params, streamed, start_time) -> dict:
+        if not isinstance(e, streaming_call_errors) or not streamed.received_tokens:
+            print(self.openai_call_message(log_prefix, f"ERROR({str(e)})", params, attempt, start_time, streaming=True))
+            raise e
+
+        print(self.openai_call_message(log_prefix, f"PARTIAL({str(e)})", params, attempt, start_time, streaming=True))
+        return streamed.result(params, partial=True)
+
+    def finishOpenAICallStreaming(self, log_prefix, attempt, params, streamed, start_time) -> dict:
+        result = streamed.result(params)
+        openai_latency_model.record(params.get('model'), result['input_tokens'], result['output_tokens'], time.time() - start_time)
+
+        print(self.openai_call_message(log_prefix, "SUCCESS", params, attempt, start_time, streaming=True,
+                                       details=f", first token in {mins_and_secs(streamed.time_to_first_token or 0)}"))
+
+        return result
+
+    def makeOpenAICall(self, function_name, attempt, timeBufferRemaining, params) -> dict:
+        log_prefix = f"Thread-{threading.current_thread().ident}-{function_name}"
+
+        start_time = self.startOpenAICall(log_prefix, attempt, timeBufferRemaining, params)
         try:
             response = openai.ChatCompletion.create(**params, timeout=timeBufferRemaining, request_timeout=timeBufferRemaining)
 
-            print(f"Thread-{threading.current_thread().ident}-{function_name}:SUCCESS:Finished OpenAI {params.get('model', 'unknown')} API call (Attempt {attempt + 1} in {mins_and_secs(time.time() - start_time)})")
+        except Exception as e:
+            print(self.openai_call_message(log_prefix, f"ERROR({str(e)})", params, attempt, start_time))
+            raise
 
-            return response
+        self.finishOpenAICall(log_prefix, attempt, params, response, start_time)
+        return response
+
+    # Streaming version of makeOpenAICall, returning the runAnalysis result - if the call runs out of its allotted time
+    #   (or the stream fails) after tokens have arrived, the partial result is returned instead of raising
+    def makeOpenAICallStreaming(self, function_name, attempt, timeBufferRemaining, params) -> dict:
+        log_prefix = f"Thread-{threading.current_thread().ident}-{function_name}"
+
+        start_time = self.startOpenAICall(log_prefix, attempt, timeBufferRemaining, params, streaming=True)
+        streamed = StreamedResponse(start_time)
+        try:
+            stream = openai.ChatCompletion.create(**params, stream=True, timeout=timeBufferRemaining, request_timeout=timeBufferRemaining)
+            try:
+                for chunk in stream:
+                    streamed.add(chunk)
+                    check_streaming_timeout(start_time, timeBufferRemaining)
+            finally:
+                stream.close()
 
         except Exception as e:
-            print(f"Thread-{threading.current_thread().ident}-{function_name}:ERROR({str(e)}):Finished OpenAI {params.get('model', 'unknown')} API call (Attempt {attempt + 1} in {mins_and_secs(time.time() - start_time)})")
-            raise
+            return self.handleStreamingError(e, log_prefix, attempt, params, streamed, start_time)
+
+        return self.finishOpenAICallStreaming(log_prefix, attempt, params, streamed, start_time)
+
+    # capture how quickly a streamed call started responding, and whether it was cut off
+    def capture_streaming_metrics(self, result, account, function_name, correlation_id):
+        metrics = []
+        if result.get('time_to_first_token') is not None:
+            metrics.append({"name": InfoMetrics.OPENAI_TIME_TO_FIRST_TOKEN, "value": round(result['time_to_first_token'] * 1000), "unit": "Milliseconds"})
+        if result.get('partial'):
+            metrics.append({"name": InfoMetrics.OPENAI_PARTIAL_RESPONSE, "value": 1, "unit": "Count"})
+
+        if metrics:
+            capture_metric(account['customer'], account['email'], function_name, correlation_id, *metrics)
+
+    # how long the next OpenAI call of an analysis may take - at most the per-call max, or what's remaining of the
+    #   total calls buffer
+    def get_call_time_allotment(self, start_time, log) -> float:
+        singlecall_timeout, allcalls_timeout, service_timeout = self.get_call_timeout_settings(None)
+
+        now = time.time()
+        time_buffer_remaining = round(service_timeout - (now - start_time), 2)
+
+        if time_buffer_remaining < 0:
+            raise TimeoutError(f"Timeout exceeded for all Service calls: {mins_and_secs(service_timeout)}")
+
+        openai_calltime_buffer_remaining = round(allcalls_timeout - (now - start_time), 2)
+
+        # nor may it run past the request's deadline for its OpenAI calls
+        request_deadline = openai_calls_deadline.get()
+        if request_deadline is not None:
+            openai_calltime_buffer_remaining = min(openai_calltime_buffer_remaining, round(request_deadline - now, 2))
+
+        if openai_calltime_buffer_remaining < 0:
+            raise TimeoutError(f"Timeout exceeded for total OpenAI calls: {mins_and_secs(allcalls_timeout)}")
+
+        allotted_time_buffer_for_this_openai_call = round(min(
+            openai_calltime_buffer_remaining,
+            singlecall_timeout), 2)
+
+        log(f"Time Settings: "
+            f"TotalAnalysisTimeBuffer:{mins_and_secs(service_timeout)}, "
+            f"OverallTimeRemaining:{mins_and_secs(time_buffer_remaining)}, "
+            f"AllottedOpenAICallTime:{mins_and_secs(allotted_time_buffer_for_this_openai_call)}, "
+            f"OpenAICallTimeRemaining:{mins_and_secs(openai_calltime_buffer_remaining)}")
+
+        return allotted_time_buffer_for_this_openai_call
+
+    # the runAnalysis result for a (non-streamed) OpenAI response
+    def analysis_result(self, response, attempt, log) -> dict:
+        if attempt > 0:
+            log(f"Succeeded after {attempt} retries")
+
+        return dict(
+            message=response.choices[0].message,
+            response=response.choices[0].message.content,
+            finish=response.choices[0].finish_reason,
+            input_tokens=response.usage.prompt_tokens,
+            output_tokens=response.usage.completion_tokens)
+
+    def streamed_analysis_result(self, result, attempt, account, function_name, correlation_id, log) -> dict:
+        self.capture_streaming_metrics(result, account, function_name, correlation_id)
+
+        if attempt > 0:
+            log(f"Succeeded after {attempt} retries")
+
+        return result
+
+    # we're going to retry on intermittent network issues
+    # e.g. throttling, connection issues, service down, etc..
+    # Note that with RateLimit error, we could actually make it worse...
+    #    So for rate limit we wait a lot longer to retry (e.g. 30-60 seconds)
+    # https://platform.openai.com/docs/guides/error-codes/python-library-error-types
+    #
+    # Yields each wait before the next attempt of a failed OpenAI call - the caller sleeps (in its thread, or on the
+    #   event loop) - and raises the error once it shouldn't be retried
+    def retry_waits(self, e, attempt, max_retries, start_time, params, account, function_name, correlation_id, log):
+        _, _, service_timeout = self.get_call_timeout_settings(None)
+
+        if isinstance(e, (openai.error.Timeout, requests.exceptions.Timeout, asyncio.TimeoutError, TimeoutError)):
+            error_type = "Timeout"
+        elif isinstance(e, openai.error.ServiceUnavailableError):
+            error_type = "Service Unavailable"
+        elif isinstance(e, (openai.error.APIConnectionError, openai.error.APIError)):
+            error_type = "API"
+        elif isinstance(e, openai.error.RateLimitError):
+            error_type = "Rate Limit"
+        else:
+            raise e
+
+        error_msg = str(e)
+
+        # when OpenAI reports exactly how long to wait, the call is retried as soon as that wait is over
+        exact_wait = False
+
+        if error_type == "Rate Limit":
+            exact_wait = rate_limit_retry_after(e) is not None
+            randomSleep = self.get_rate_limit_retry_wait(e, params)
+
+            log(f"RateLimitError, sleeping for {mins_and_secs(randomSleep)} before retry")
+
+            # if we hit the rate limit, send a cloudwatch alert and raise the error
+            capture_metric(
+                account['customer'], account['email'], function_name, correlation_id,
+                {"name": InfoMetrics.OPENAI_RATE_LIMIT, "value": 1, "unit": "None"})
+
+            timeBufferRemaining = service_timeout - (time.time() - start_time)
+
+            if timeBufferRemaining < 0:
+                raise Exception(f"Timeout exceeded for OpenAI call: {mins_and_secs(service_timeout)}")
+
+            yield randomSleep
+
+        if attempt < max_retries and (time.time() - start_time + (0 if exact_wait else random.uniform(2, 5))) < service_timeout:
+
+            timeBufferRemaining = service_timeout - (time.time() - start_time)
+
+            if timeBufferRemaining < 0:
+                raise TimeoutError(f"Timeout exceeded for OpenAI call: {mins_and_secs(service_timeout)}")
+
+            if exact_wait:
+                log(f"OpenAPI:Retrying after {error_type}: {error_msg}")
+                return
+
+            randomSleep = random.uniform(2, 5)
+            log(f"OpenAPI:Retrying in {mins_and_secs(randomSleep)} after {error_type}: {error_msg}")
+            yield randomSleep
+        else:
+            log(f"FAILED after {attempt} retries:Error: {error_type}: {error_msg}")
+            raise e
 
     def runAnalysis(self, params, account, function_name, correlation_id) -> dict:
 
         def log(message):
             print(f"Thread-{threading.current_thread().ident}-{function_name}:RunAnalysis:{message}")
 
+        # stream responses (so calls that run out of time keep their partial results) only if enabled in environment variable
+        useOpenAIStreaming = True if "useOpenAIStreaming" in os.environ and os.environ["useOpenAIStreaming"] == "True" else False
+
         max_retries = 3
         start_time = time.time()
 
-        # we're going to retry on intermittent network issues
-        # e.g. throttling, connection issues, service down, etc..
-        # Note that with RateLimit error, we could actually make it worse...
-        #    So for rate limit we wait a lot longer to retry (e.g. 30-60 seconds)
-        # https://platform.openai.com/docs/guides/error-codes/python-library-error-types
         for attempt in range(max_retries + 1):
 
             try:
-                singlecall_timeout, allcalls_timeout, service_timeout = self.get_call_timeout_settings(None)
-
-                now = time.time()
-                time_buffer_remaining = round(service_timeout - (now - start_time), 2)
+                allotted_time_buffer_for_this_openai_call = self.get_call_time_allotment(start_time, log)
 
-                if time_buffer_remaining < 0:
-                    raise TimeoutError(f"Timeout exceeded for all Service calls: {mins_and_secs(service_timeout)}")
+                if useOpenAIStreaming:
+                    result = self.makeOpenAICallStreaming(
+                        function_name,
+                        attempt,
+                        allotted_time_buffer_for_this_openai_call,
+                        params)
 
-                openai_calltime_buffer_remaining = round(allcalls_timeout - (now - start_time), 2)
-                if openai_calltime_buffer_remaining < 0:
-                    raise TimeoutError(f"Timeout exceeded for total OpenAI calls: {mins_and_secs(allcalls_timeout)}")
-
-                # we'll let the OpenAI call take at most the per-call max, or what's remaining
-                #       of the total calls buffer
-                allotted_time_buffer_for_this_openai_call = round(min(
-                    openai_calltime_buffer_remaining,
-                    singlecall_timeout), 2)
-
-                log(f"Time Settings: "
-                    f"TotalAnalysisTimeBuffer:{mins_and_secs(service_timeout)}, "
-                    f"OverallTimeRemaining:{mins_and_secs(time_buffer_remaining)}, "
-                    f"AllottedOpenAICallTime:{mins_and_secs(allotted_time_buffer_for_this_openai_call)}, "
-                    f"OpenAICallTimeRemaining:{mins_and_secs(openai_calltime_buffer_remaining)}")
+                    return self.streamed_analysis_result(result, attempt, account, function_name, correlation_id, log)
 
                 response = self.makeOpenAICall(
                     function_name,
@@ -942,85 +1170,212 @@ class GenericProcessor:
                     allotted_time_buffer_for_this_openai_call,
                     params)
 
-                if attempt > 0:
-                    log(f"Succeeded after {attempt} retries")
+                return self.analysis_result(response, attempt, log)
 
-                return dict(
-                    message=response.choices[0].message,
-                    response=response.choices[0].message.content,
-                    finish=response.choices[0].finish_reason,
-                    input_tokens=response.usage.prompt_tokens,
-                    output_tokens=response.usage.completion_tokens)
+            except Exception as e:
+                for wait in self.retry_waits(e, attempt, max_retries, start_time, params,
+                                             account, function_name, correlation_id, log):
+                    time.sleep(wait)
 
-            except (openai.error.Timeout, requests.exceptions.Timeout, TimeoutError) as e:
-                error = e
-                error_msg = str(e)
-                error_type = "Timeout"
+    # how long to wait before retrying a rate limited call - exactly as long as OpenAI reports, if it does
+    def get_rate_limit_retry_wait(self, e, params) -> float:
+        record_rate_limit_headers(params.get('model'), getattr(e, 'headers', None))
 
-            except (openai.error.ServiceUnavailableError) as e:
-                error = e
-                error_msg = str(e)
-                error_type = "Service Unavailable"
+        retry_after = rate_limit_retry_after(e)
+        if retry_after is not None:
+            # a little jitter so chunks waiting on the same reset don't all retry at the same instant
+            return retry_after + random.uniform(0, 1)
 
-            except (openai.error.APIConnectionError, openai.error.APIError) as e:
-                error = e
-                error_msg = str(e)
-                error_type = "API"
+        if "40000 / min" in str(e):
+            return random.uniform(30, 60)
+        else:
+            return random.uniform(5, 15)
 
-            except openai.error.RateLimitError as e:
-                error = e
+    def handleFinalCallError(self, e, input_tokens, log):
+        return None
 
-                error_msg = str(e)
-                error_type = "Rate Limit"
+    # result for a chunk the scheduler didn't start, because it wasn't expected to finish before the deadline - recorded
+    #   as an incomplete result (like a timed out call), but without the cost of the call
+    def skippedChunkResult(self, i, scheduler, account, function_name, correlation_id, log) -> dict:
+        log(f"Chunk {i} skipped - not expected to finish (in {mins_and_secs(scheduler.estimates[i])}) before the deadline of {mins_and_secs(scheduler.deadline_seconds)} for OpenAI calls")
+
+        capture_metric(
+            account['customer'], account['email'], function_name, correlation_id,
+            {"name": InfoMetrics.CHUNK_SKIPPED, "value": 1, "unit": "Count"})
+
+        result = self.handleFinalCallError(TimeoutError(f"Chunk {i} skipped before the deadline for OpenAI calls: {mins_and_secs(scheduler.deadline_seconds)}"), 0, log)
+        if result is None:
+            result = dict(
+                message={'role': 'assistant', 'content': ''},
+                response='',
+                finish=None,
+                input_tokens=0,
+                output_tokens=0)
+
+        result['skipped'] = True
+        return result
 
-                if "40000 / min" in error_msg:
-                    randomSleep = random.uniform(30, 60)
-                else:
-                    randomSleep = random.uniform(5, 15)
+    # the params for a chunk's OpenAI call
+    def get_prompt_params(self, this_messages, max_output_tokens, params_template) -> dict:
+        params = params_template.copy()  # Create a copy of the template to avoid side effects
 
-                log(f"RateLimitError, sleeping for {mins_and_secs(randomSleep)} before retry")
+        if max_output_tokens != 0:
+            params["max_tokens"] = int(max_output_tokens)
 
-                # if we hit the rate limit, send a cloudwatch alert and raise the error
-                capture_metric(
-                    account['customer'], account['email'], function_name, correlation_id,
-                    {"name": InfoMetrics.OPENAI_RATE_LIMIT, "value": 1, "unit": "None"})
+        params['messages'] = this_messages
 
-                timeBufferRemaining = service_timeout - (time.time() - start_time)
+        return params
 
-                if timeBufferRemaining < 0:
-                    raise Exception(f"Timeout exceeded for OpenAI call: {mins_and_secs(service_timeout)}")
+    # identical OpenAI calls (for the same prompt file versions) have the same key
+    def analysis_key(self, params) -> str:
+        return make_result_cache_key(params, getattr(self, 'prompt_files_timestamps', None))
 
-                time.sleep(randomSleep)
+    # the cached result for a chunk's OpenAI call, if analysis results are cached (see result_cache.py) and the same
+    #   call has been made before - otherwise None
+    def get_cached_result(self, params, log) -> dict:
+        cache = get_result_cache()
+        if cache is None:
+            return None
 
-            if attempt < max_retries and (time.time() - start_time + random.uniform(2, 5)) < service_timeout:
+        try:
+            result = cache.get(self.analysis_key(params))
+        # never fail an analysis because the cache is unavailable
+        except Exception as e:
+            log(f"Unable to read analysis result cache: {str(e)}")
+            return None
 
-                timeBufferRemaining = service_timeout - (time.time() - start_time)
+        if result is not None:
+            log("Analysis result cache hit - skipping OpenAI call")
+            result['cached'] = True
 
-                if timeBufferRemaining < 0:
-                    raise TimeoutError(f"Timeout exceeded for OpenAI call: {mins_and_secs(service_timeout)}")
+        return result
 
-                randomSleep = random.uniform(2, 5)
-                log(f"OpenAPI:Retrying in {mins_and_secs(randomSleep)} after {error_type}: {error_msg}")
-                time.sleep(randomSleep)
-            else:
-                log(f"FAILED after {attempt} retries:Error: {error_type}: {error_msg}")
-                raise error
+    # cache a completed (not partial or truncated) result for a chunk's OpenAI call
+    def cache_result(self, params, result, log):
+        cache = get_result_cache()
+        if cache is None or result is None or result.get('cached') or result.get('partial') or result['finish'] not in ['stop', 'function_call']:
+            return
 
-    def handleFinalCallError(self, e, input_tokens, log):
-        return None
+        try:
+            cache.put(self.analysis_key(params), result)
+        except Exception as e:
+            log(f"Unable to update analysis result cache: {str(e)}")
+
+    # the result of an identical analysis already in flight in this container, if any (see single_flight.py)
+    def join_analysis_in_flight(self, params, log) -> dict:
+        result = analysis_flights.join(self.analysis_key(params))
+        if result is not None:
+            log("Shared the result of an identical analysis in flight")
+            result['coalesced'] = True
+        return result
 
-    def runAnalysisForPrompt(self, i, this_messages, max_output_tokens, input_tokens,
-                             params_template, account, function_name, correlation_id) -> dict:
-        params = params_template.copy()  # Create a copy of the template to avoid side effects
+    # run the analysis for a chunk's OpenAI call - unless an identical call is already in flight, in this container
+    #   or in another container holding the analysis lease, in which case its result is shared
+    def runAnalysisCoalesced(self, params, account, function_name, correlation_id, log) -> dict:
+        key = self.analysis_key(params)
 
-        if max_output_tokens != 0:
-            params["max_tokens"] = int(max_output_tokens)
+        result, coalesced = analysis_flights.do(key, lambda: self.runAnalysisWithLease(key, params, account, function_name, correlation_id, log))
+        if coalesced:
+            log("Shared the result of an identical analysis in flight")
+            result['coalesced'] = True
 
-        params['messages'] = this_messages
+        return result
+
+    def runAnalysisWithLease(self, key, params, account, function_name, correlation_id, log) -> dict:
+        def run_analysis():
+            result = self.runAnalysis(params, account, function_name, correlation_id)
+            self.cache_result(params, result, log)
+            return result
+
+        lease, acquired = self.acquire_analysis_lease(key, log)
+        if lease is None:
+            return run_analysis()
+
+        if acquired:
+            try:
+                return run_analysis()
+            finally:
+                self.release_analysis_lease(lease, key, log)
+
+        deadline = self.get_analysis_lease_wait_deadline(lease, log)
+        while time.time() < deadline:
+            time.sleep(max(0.0, min(analysis_lease_poll_interval, deadline - time.time())))
+
+            result, waiting = self.poll_leased_analysis(lease, key, params, log)
+            if result is not None:
+                return result
+            if not waiting:
+                break
+
+        # the other container's call failed (or wasn't cacheable), so make the call ourselves
+        result = self.get_shared_cached_result(params, log)
+        if result is not None:
+            return result
+
+        return run_analysis()
+
+    # takes the lease on an analysis, so other containers wait for its result - returns the lease (None if leases
+    #   aren't used, or can't be taken), and whether it was acquired
+    def acquire_analysis_lease(self, key, log):
+        # other containers can only share the result through the result cache
+        lease = get_analysis_lease() if get_result_cache() is not None else None
+        if lease is None:
+            return None, False
+
+        try:
+            return lease, lease.acquire(key)
+        except Exception as e:
+            log(f"Unable to acquire analysis lease, running analysis without it: {str(e)}")
+            return None, False
+
+    def release_analysis_lease(self, lease, key, log):
+        try:
+            lease.release(key)
+        except Exception as e:
+            log(f"Unable to release analysis lease: {str(e)}")
+
+    # another container is making this call - wait for its result to be cached, while it holds the lease, but no
+    #   longer than this call would be allowed to take, or than the request has left
+    def get_analysis_lease_wait_deadline(self, lease, log) -> float:
+        singlecall_timeout, _, _ = self.get_call_timeout_settings(None)
+        deadline = time.time() + min(lease.ttl, singlecall_timeout)
+        request_deadline = openai_calls_deadline.get()
+        if request_deadline is not None:
+            deadline = min(deadline, request_deadline)
+
+        log(f"Identical analysis in flight in another container - waiting up to {mins_and_secs(max(0.0, deadline - time.time()))} for its result")
+        return deadline
+
+    # the leased analysis's result, if cached yet - and whether it's still worth waiting for
+    def poll_leased_analysis(self, lease, key, params, log):
+        result = self.get_shared_cached_result(params, log)
+        if result is not None:
+            return result, False
+
+        try:
+            return None, lease.is_held(key)
+        except Exception as e:
+            log(f"Unable to check analysis lease: {str(e)}")
+            return None, False
+
+    def get_shared_cached_result(self, params, log) -> dict:
+        result = self.get_cached_result(params, log)
+        if result is not None:
+            result['coalesced'] = True
+        return result
+
+    def runAnalysisForPrompt(self, i, this_messages, max_output_tokens, input_tokens,
+                             params_template, account, function_name, correlation_id, check_cache=True) -> dict:
+        params = self.get_prompt_params(this_messages, max_output_tokens, params_template)
 
         def log(message):
             print(f"Thread-{threading.current_thread().ident}-{function_name}:runAnalysisForPrompt:Chunk {i}:{message}")
 
+        if check_cache:
+            cached_result = self.get_cached_result(params, log)
+            if cached_result is not None:
+                return cached_result
+
         start_time = time.monotonic()
 
         log("Starting processing")
@@ -1028,7 +1383,7 @@ class GenericProcessor:
         result = None
         error = ""
         try:
-            result = self.runAnalysis(params, account, function_name, correlation_id)
+            result = self.runAnalysisCoalesced(params, account, function_name, correlation_id, log)
 
         except Exception as e:
             result = self.handleFinalCallError(e, input_tokens, log)
@@ -1052,6 +1407,289 @@ class GenericProcessor:
 
         return result
 
+    # asyncio chunk engine (enabled with useAsyncEngine) - the async versions of makeOpenAICall, runAnalysis and
+    #   runAnalysisForPrompt run every chunk as a task on one event loop, instead of one thread per chunk
+
+    async def makeOpenAICallAsync(self, function_name, attempt, timeBufferRemaining, params, task_name) -> dict:
+        log_prefix = f"{task_name}-{function_name}"
+
+        start_time = self.startOpenAICall(log_prefix, attempt, timeBufferRemaining, params)
+        try:
+            openai_request_model.set(params.get('model'))  # for the rate limit trace (see openai_rate_limits.py)
+            response = await openai.ChatCompletion.acreate(**params, timeout=timeBufferRemaining, request_timeout=timeBufferRemaining)
+
+        except Exception as e:
+            print(self.openai_call_message(log_prefix, f"ERROR({str(e)})", params, attempt, start_time))
+            raise
+
+        self.finishOpenAICall(log_prefix, attempt, params, response, start_time)
+        return response
+
+    async def makeOpenAICallStreamingAsync(self, function_name, attempt, timeBufferRemaining, params, task_name) -> dict:
+        log_prefix = f"{task_name}-{function_name}"
+
+        start_time = self.startOpenAICall(log_prefix, attempt, timeBufferRemaining, params, streaming=True)
+        streamed = StreamedResponse(start_time)
+        try:
+            openai_request_model.set(params.get('model'))  # for the rate limit trace (see openai_rate_limits.py)
+            stream = await openai.ChatCompletion.acreate(**params, stream=True, timeout=timeBufferRemaining, request_timeout=timeBufferRemaining)
+            try:
+                async for chunk in stream:
+                    streamed.add(chunk)
+                    check_streaming_timeout(start_time, timeBufferRemaining)
+            finally:
+                await stream.aclose()
+
+        except Exception as e:
+            return self.handleStreamingError(e, log_prefix, attempt, params, streamed, start_time)
+
+        return self.finishOpenAICallStreaming(log_prefix, attempt, params, streamed, start_time)
+
+    async def runAnalysisAsync(self, params, account, function_name, correlation_id, task_name) -> dict:
+
+        def log(message):
+            print(f"{task_name}-{function_name}:RunAnalysis:{message}")
+
+        # stream responses only if enabled in environment variable (see runAnalysis)
+        useOpenAIStreaming = True if "useOpenAIStreaming" in os.environ and os.environ["useOpenAIStreaming"] == "True" else False
+
+        max_retries = 3
+        start_time = time.time()
+
+        # same retry policy as runAnalysis, but waiting between retries doesn't block other chunks
+        for attempt in range(max_retries + 1):
+
+            try:
+                allotted_time_buffer_for_this_openai_call = self.get_call_time_allotment(start_time, log)
+
+                if useOpenAIStreaming:
+                    result = await self.makeOpenAICallStreamingAsync(
+                        function_name,
+                        attempt,
+                        allotted_time_buffer_for_this_openai_call,
+                        params,
+                        task_name)
+
+                    return self.streamed_analysis_result(result, attempt, account, function_name, correlation_id, log)
+
+                response = await self.makeOpenAICallAsync(
+                    function_name,
+                    attempt,
+                    allotted_time_buffer_for_this_openai_call,
+                    params,
+                    task_name)
+
+                return self.analysis_result(response, attempt, log)
+
+            except Exception as e:
+                for wait in self.retry_waits(e, attempt, max_retries, start_time, params,
+                                             account, function_name, correlation_id, log):
+                    await asyncio.sleep(wait)
+
+    # the async versions of runAnalysisCoalesced and runAnalysisWithLease - chunks share calls with the identical
+    #   chunks of other requests in this container (threaded or async), and with other containers. The result cache
+    #   and lease are read and written off the event loop
+    async def runAnalysisCoalescedAsync(self, params, account, function_name, correlation_id, task_name, log) -> dict:
+        key = self.analysis_key(params)
+
+        result, coalesced = await analysis_flights.do_async(
+            key, lambda: self.runAnalysisWithLeaseAsync(key, params, account, function_name, correlation_id, task_name, log))
+        if coalesced:
+            log("Shared the result of an identical analysis in flight")
+            result['coalesced'] = True
+
+        return result
+
+    async def runAnalysisWithLeaseAsync(self, key, params, account, function_name, correlation_id, task_name, log) -> dict:
+        async def run_analysis():
+            result = await self.runAnalysisAsync(params, account, function_name, correlation_id, task_name)
+            if get_result_cache() is not None:
+                await asyncio.to_thread(self.cache_result, params, result, log)
+            return result
+
+        # without a result cache there's no cache or lease to wait on (so no need to leave the event loop)
+        if get_result_cache() is None:
+            return await run_analysis()
+
+        lease, acquired = await asyncio.to_thread(self.acquire_analysis_lease, key, log)
+        if lease is None:
+            return await run_analysis()
+
+        if acquired:
+            try:
+                return await run_analysis()
+            finally:
+                await asyncio.to_thread(self.release_analysis_lease, lease, key, log)
+
+        deadline = self.get_analysis_lease_wait_deadline(lease, log)
+        while time.time() < deadline:
+            await asyncio.sleep(max(0.0, min(analysis_lease_poll_interval, deadline - time.time())))
+
+            result, waiting = await asyncio.to_thread(self.poll_leased_analysis, lease, key, params, log)
+            if result is not None:
+                return result
+            if not waiting:
+                break
+
+        # the other container's call failed (or wasn't cacheable), so make the call ourselves
+        result = await asyncio.to_thread(self.get_shared_cached_result, params, log)
+        if result is not None:
+            return result
+
+        return await run_analysis()
+
+    async def runAnalysisForPromptAsync(self, i, this_messages, max_output_tokens, input_tokens,
+                                        params_template, account, function_name, correlation_id, throttler,
+                                        scheduler=None, concurrency=None) -> dict:
+        # limit how many chunks run at once, if the scheduler chose a concurrency
+        if concurrency is not None:
+            async with concurrency:
+                return await self.runAnalysisForPromptAsync(i, this_messages, max_output_tokens, input_tokens, params_template,
+                                                            account, function_name, correlation_id, throttler, scheduler)
+
+        params = self.get_prompt_params(this_messages, max_output_tokens, params_template)
+
+        task_name = f"Task-{i}"
+
+        def log(message):
+            print(f"{task_name}-{function_name}:runAnalysisForPrompt:Chunk {i}:{message}")
+
+        # a cached result doesn't need to wait for the rate limit (or the scheduler)
+        cached_result = await asyncio.to_thread(self.get_cached_result, params, log) if get_result_cache() is not None else None
+        if cached_result is not None:
+            return cached_result
+
+        # nor does an identical chunk's result
+        shared_result = await analysis_flights.join_async(self.analysis_key(params))
+        if shared_result is not None:
+            log("Shared the result of an identical analysis in flight")
+            shared_result['coalesced'] = True
+            return shared_result
+
+        total_tokens = max_output_tokens + input_tokens
+
+        if scheduler is not None and not scheduler.can_start(i):
+            return self.skippedChunkResult(i, scheduler, account, function_name, correlation_id, log)
+
+        # if we have no defined max, then no throttling - since tuning is disabled
+        delay = -1
+        if OpenAIDefaults.boost_max_tokens_default != 0:
+            delay = await throttler.wait_for_tokens(total_tokens, time.time(), input_tokens, log)
+            if delay < 0:
+                log("Processing without throttling due to overall wait time")
+
+        # waiting for the rate limit may have used up the time this chunk needed
+        if scheduler is not None and not scheduler.can_start(i):
+            if delay == 0:
+                throttler.return_tokens(total_tokens)
+            return self.skippedChunkResult(i, scheduler, account, function_name, correlation_id, log)
+
+        start_time = time.monotonic()
+
+        log("Starting processing")
+
+        result = None
+        error = ""
+        try:
+            result = await self.runAnalysisCoalescedAsync(params, account, function_name, correlation_id, task_name, log)
+
+            # it made no call of its own, so its tokens go back
+            if result.get('coalesced') and delay == 0:
+                throttler.return_tokens(total_tokens)
+
+        except asyncio.CancelledError:
+            error = "::error:cancelled"
+            raise
+
+        except Exception as e:
+            result = self.handleFinalCallError(e, input_tokens, log)
+            if result is None:
+                error = f"::error:{str(e)}"
+                raise
+        finally:
+            # only refill if we used the throttler and didn't bypass rate limiting
+            if delay >= 0:
+                throttler.refill(total_tokens)
+
+            end_time = time.monotonic()
+
+            finish = 'Incomplete' if (result is None or result['finish'] is None or result['finish'] == 'length'
+                                      or result['finish'] == 'content_filter') else 'Complete'
+
+            if result is None:
+                log(f"Error processing after {mins_and_secs(end_time - start_time)}:"
+                    f"Finish:{finish}{error}")
+            else:
+                log(f"SUCCESS processing in {mins_and_secs(end_time - start_time)}:"
+                    f"Finish:{finish}{error}")
+
+        return result
+
+    # Run all chunks concurrently on one event loop - chunks still running when the OpenAI call deadline
+    #   (from get_call_timeout_settings) is exhausted are cancelled
+    #   with schedule_chunks, chunks are started in the ChunkScheduler's order and concurrency, and chunks that can't
+    #   finish before the deadline are skipped - results are always returned in prompt_set order
+    async def runAnalysisForPromptsAsync(self, prompt_set, data, params, account, function_name, correlation_id, log,
+                                         schedule_chunks=False) -> List[dict]:
+        single_ai_call_timeout, all_ai_calls_timeout, whole_service_call_timeout = self.get_remaining_call_timeout_settings(data)
+
+        throttler = AsyncThrottler(None,
+                                   single_ai_call_timeout,
+                                   all_ai_calls_timeout,
+                                   whole_service_call_timeout,
+                                   rate_limit_backend=get_rate_limit_backend(),
+                                   model=params.get('model'),
+                                   latency_model=openai_latency_model)
+
+        scheduler = None
+        concurrency = None
+        chunk_order = range(len(prompt_set))
+        if schedule_chunks:
+            scheduler = self.scheduleChunks(prompt_set, params, all_ai_calls_timeout, throttler, log)
+            concurrency = asyncio.Semaphore(scheduler.schedule.concurrency) if scheduler.schedule.concurrency is not None else None
+            chunk_order = scheduler.schedule.order
+
+        # all chunks share one HTTP session (and its connection pool) for their OpenAI calls
+        async with aiohttp.ClientSession(trace_configs=[make_rate_limit_trace_config()]) as session:
+            openai.aiosession.set(session)
+
+            # tasks are created (and so start) in chunk order, but are kept in prompt_set order
+            tasks = [None] * len(prompt_set)
+            for index in chunk_order:
+                prompt = prompt_set[index]
+                tasks[index] = asyncio.create_task(self.runAnalysisForPromptAsync(index, prompt[0], prompt[1], prompt[2], params,
+                                                                                  account, function_name, correlation_id, throttler,
+                                                                                  scheduler, concurrency),
+                                                   name=f"Chunk-{index}")
+
+            done, pending = await asyncio.wait(tasks, timeout=all_ai_calls_timeout, return_when=asyncio.FIRST_EXCEPTION)
+
+            failed = next((task for task in tasks if task in done and task.exception() is not None), None)
+
+            # if a chunk failed, or the deadline is exhausted, there's no point running the remaining chunks
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        if failed is not None:
+            raise failed.exception()
+
+        results = []
+        for index, task in enumerate(tasks):
+            if task in pending:
+                log(f"Chunk {index} cancelled - deadline of {mins_and_secs(all_ai_calls_timeout)} for OpenAI calls exhausted")
+                timeout_error = TimeoutError(f"Timeout exceeded for total OpenAI calls: {mins_and_secs(all_ai_calls_timeout)}")
+                result = self.handleFinalCallError(timeout_error, prompt_set[index][2], log)
+                if result is None:
+                    raise timeout_error
+            else:
+                result = task.result()
+
+            results.append(result)
+
+        return results
+
     def initialize_from_data(self, log, data, account, function_name, correlation_id, prompt_format_args, params) -> Tuple[dict, dict]:
 
         # enable user to override the model to gpt-3 or gpt-4
@@ -1197,6 +1835,35 @@ class GenericProcessor:
     def get_call_timeout_settings(self, data) -> Tuple[float, float, float]:
         return max_timeout_seconds_for_single_openai_call_default, max_timeout_seconds_for_all_openai_calls_default, total_analysis_time_buffer_default
 
+    # the call timeout settings, with the time for all OpenAI calls cut to what's left before the deadline already set
+    #   for them (e.g. by a batch, whose packs all share one deadline)
+    def get_remaining_call_timeout_settings(self, data) -> Tuple[float, float, float]:
+        single_ai_call_timeout, all_ai_calls_timeout, whole_service_call_timeout = self.get_call_timeout_settings(data)
+
+        deadline = openai_calls_deadline.get()
+        if deadline is not None:
+            all_ai_calls_timeout = max(0.0, min(all_ai_calls_timeout, deadline - time.time()))
+
+        return single_ai_call_timeout, all_ai_calls_timeout, whole_service_call_timeout
+
+    # plan the order and concurrency of the chunks (prompts of messages, output tokens, input tokens), so the most
+    #   chunks finish before the deadline for OpenAI calls
+    def scheduleChunks(self, prompt_set, params, deadline_seconds, throttler, log) -> ChunkScheduler:
+        scheduler = ChunkScheduler([(prompt[2], prompt[1]) for prompt in prompt_set],
+                                   deadline_seconds,
+                                   throttler.rate_limit_tokens_per_minute,
+                                   openai_latency_model,
+                                   params.get('model'))
+
+        schedule = scheduler.schedule
+        if schedule.predicted_finish:
+            log(f"Scheduled {len(prompt_set)} chunks on {schedule.concurrency} workers, predicted to finish in {mins_and_secs(max(schedule.predicted_finish.values()))}, "
+                f"skipping {len(schedule.skipped)} chunks: {sorted(schedule.skipped)}")
+        else:
+            log(f"Scheduled {len(prompt_set)} chunks largest first, on the default workers (no latency estimates for {params.get('model')} yet)")
+
+        return scheduler
+
     BillingMetrics = namedtuple('BillingMetrics', [
         'user_input_size',
         'output_size',
@@ -1218,10 +1885,32 @@ class GenericProcessor:
         return update_usage_for_text(account, billing_metrics.user_messages_size + billing_metrics.output_size, function_name, success)
 
     def process_input(self, data, account, function_name, correlation_id, prompt_format_args) -> dict:
+        # the deadline for this request's OpenAI calls - within any deadline the caller already set (e.g. for a batch)
+        _, all_ai_calls_timeout, _ = self.get_remaining_call_timeout_settings(data)
+        deadline_token = openai_calls_deadline.set(time.time() + all_ai_calls_timeout)
+
+        # all token counting for this request (content optimization, chunking, prompt building and billing)
+        #   shares one ledger, so each message is only tokenized once
+        with token_ledger_scope() as ledger:
+            try:
+                return self.process_input_with_token_ledger(data, account, function_name, correlation_id, prompt_format_args)
+            finally:
+                print(f"{function_name}:{correlation_id}:TokenLedger: {ledger.summary()}")
+                openai_calls_deadline.reset(deadline_token)
+
+    def process_input_with_token_ledger(self, data, account, function_name, correlation_id, prompt_format_args) -> dict:
 
         # enable new throttler by default unless disabled in environment variable
         useNewThrottler = False if "useNewThrottler" in os.environ and os.environ["useNewThrottler"] == "False" else True
 
+        # run chunks as asyncio tasks (instead of one thread per chunk) only if enabled in environment variable
+        useAsyncEngine = True if "useAsyncEngine" in os.environ and os.environ["useAsyncEngine"] == "True" else False
+
+        connection_stats_at_start = openai_connection_stats.snapshot()
+
+        # schedule chunks around the OpenAI call deadline by default unless disabled in environment variable
+        useDeadlineScheduler = False if "useDeadlineScheduler" in os.environ and os.environ["useDeadlineScheduler"] == "False" else True
+
         self.load_prompts()
 
         email = account['email']
@@ -1256,16 +1945,37 @@ class GenericProcessor:
             if chunked:
                 log(f"Chunked user input - {len(prompt_set)} chunks")
 
-                if useNewThrottler:
-                    single_ai_call_timeout, all_ai_calls_timeout, whole_service_call_timeout = self.get_call_timeout_settings(data)
+                scheduler = None
+                chunk_concurrency = None  # default thread pool size, unless the chunks are scheduled
+
+                if useAsyncEngine:
+                    if useDeadlineScheduler:
+                        results = asyncio.run(self.runAnalysisForPromptsAsync(prompt_set, data, params, account, function_name, correlation_id, log, schedule_chunks=True))
+                    else:
+                        # Sort prompt set based on total tokens (input tokens + output tokens)
+                        sorted_prompt_set = sorted(prompt_set, key=lambda p: p[1] + p[2]) if OpenAIDefaults.boost_max_tokens_default != 0 else prompt_set
+
+                        results = asyncio.run(self.runAnalysisForPromptsAsync(sorted_prompt_set, data, params, account, function_name, correlation_id, log))
+
+                elif useNewThrottler:
+                    single_ai_call_timeout, all_ai_calls_timeout, whole_service_call_timeout = self.get_remaining_call_timeout_settings(data)
 
                     throttler = Throttler(None,
                                           single_ai_call_timeout,
                                           all_ai_calls_timeout,
-                                          whole_service_call_timeout)
-
-                    # Sort prompt set based on total tokens (input tokens + output tokens)
-                    sorted_prompt_set = sorted(prompt_set, key=lambda p: p[1] + p[2]) if OpenAIDefaults.boost_max_tokens_default != 0 else prompt_set
+                                          whole_service_call_timeout,
+                                          rate_limit_backend=get_rate_limit_backend(),
+                                          model=params.get('model'),
+                                          latency_model=openai_latency_model)
+
+                    if useDeadlineScheduler:
+                        # start the longest chunks first, on enough threads for the most chunks to finish before the deadline
+                        scheduler = self.scheduleChunks(prompt_set, params, all_ai_calls_timeout, throttler, log)
+                        chunk_order = scheduler.schedule.order
+                        chunk_concurrency = scheduler.schedule.concurrency
+                    else:
+                        # Sort prompt set based on total tokens (input tokens + output tokens)
+                        chunk_order = sorted(range(len(prompt_set)), key=lambda index: prompt_set[index][1] + prompt_set[index][2]) if OpenAIDefaults.boost_max_tokens_default != 0 else range(len(prompt_set))
 
                     def runAnalysisForPromptThrottled(prompt_iteration):
 
@@ -1278,6 +1988,16 @@ class GenericProcessor:
 
                         log(f"Chunk {index} (input={input_tokens},output={output_tokens},function={function_tokens},total={input_tokens+output_tokens})")
 
+                        # a cached result doesn't need to wait for the rate limit (or the scheduler), nor does an
+                        #   identical analysis already in flight
+                        prompt_params = self.get_prompt_params(messages, output_tokens, params)
+                        cached_result = self.get_cached_result(prompt_params, log) or self.join_analysis_in_flight(prompt_params, log)
+                        if cached_result is not None:
+                            return cached_result
+
+                        if scheduler is not None and not scheduler.can_start(index):
+                            return self.skippedChunkResult(index, scheduler, account, function_name, correlation_id, log)
+
                         try:
                             if OpenAIDefaults.boost_max_tokens_default == 0:
                                 # if we have no defined max, then no delay and no throttling - since tuning is disabled
@@ -1316,7 +2036,17 @@ class GenericProcessor:
 
                                         break  # run analysis immediately as we've been unblocked by bucket availability
 
-                            analysisResult = self.runAnalysisForPrompt(index, messages, output_tokens, input_tokens, params, account, function_name, correlation_id)
+                            # waiting for the rate limit may have used up the time this chunk needed
+                            if scheduler is not None and not scheduler.can_start(index):
+                                if OpenAIDefaults.boost_max_tokens_default != 0 and delay == 0:
+                                    throttler.return_tokens(output_tokens + input_tokens)
+                                return self.skippedChunkResult(index, scheduler, account, function_name, correlation_id, log)
+
+                            analysisResult = self.runAnalysisForPrompt(index, messages, output_tokens, input_tokens, params, account, function_name, correlation_id, check_cache=False)
+
+                            # a chunk that shared another call's result made no call of its own, so its tokens go back
+                            if OpenAIDefaults.boost_max_tokens_default != 0 and delay == 0 and analysisResult is not None and analysisResult.get('coalesced'):
+                                throttler.return_tokens(output_tokens + input_tokens)
 
                         # need to ensure we re-fill in case of an error
                         finally:
@@ -1327,7 +2057,7 @@ class GenericProcessor:
 
                         return analysisResult
                 else:
-                    sorted_prompt_set = prompt_set
+                    chunk_order = range(len(prompt_set))
 
                     totalChunks = len(prompt_set)
                     tokensPerChunk = OpenAIDefaults.rate_limit_tokens_per_minute / totalChunks
@@ -1362,8 +2092,24 @@ class GenericProcessor:
 
                 # launch all the parallel threads to run analysis with the unique chunked prompt for each
                 # Throttling the rate of file processing
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    results = list(executor.map(runAnalysisForPromptThrottled, enumerate(sorted_prompt_set)))
+                if not useAsyncEngine:
+                    # each chunk runs in the request's context, so it shares the request's token ledger and metrics buffer
+                    request_context = contextvars.copy_context()
+
+                    def runAnalysisForPromptInRequestContext(prompt_with_index):
+                        return request_context.copy().run(runAnalysisForPromptThrottled, prompt_with_index)
+
+                    # keep a pooled connection alive for each chunk thread
+                    if chunk_concurrency is not None:
+                        ensure_openai_pool_size(chunk_concurrency)
+
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=chunk_concurrency) as executor:
+                        results = list(executor.map(runAnalysisForPromptInRequestContext, [(index, prompt_set[index]) for index in chunk_order]))
+
+                    # scheduled chunks run out of order, but their results are reassembled in input order
+                    if scheduler is not None:
+                        results_by_index = dict(zip(chunk_order, results))
+                        results = [results_by_index[index] for index in range(len(prompt_set))]
 
             # otherwise, run once
             else:
@@ -1406,6 +2152,12 @@ class GenericProcessor:
                         log(f"Unexpected finish reason {r['finish']}")
                         return True
 
+                # the function call arguments salvaged from a streamed call that was cut off, if any
+                def salvaged_arguments(r):
+                    if not r.get('partial') or not r['message'].get('function_call'):
+                        return None
+                    return r['message']['function_call'].get('arguments') or None
+
                 incomplete_responses = [0 if did_complete(r) else 1 for r in results]
 
                 # calculate only the count of incompletions, not the total length of the incomplete responses
@@ -1415,7 +2167,7 @@ class GenericProcessor:
                     return False, None, sum(incomplete_responses), None
 
                 # if every call failed, then just throw an error, as we have no useful results
-                if len(results) == total_incompletions:
+                if len(results) == total_incompletions and not any(salvaged_arguments(r) for r in results):
                     raise TimeoutError(f"{function_name} failed with incomplete or empty results - retry your call")
 
                 items = []
@@ -1429,6 +2181,16 @@ class GenericProcessor:
 
                         # keep the result since its complete
                         reassembled_results.append(r)
+                    elif salvaged_arguments(r):
+                        json_items = json.loads(salvaged_arguments(r))
+                        for key, value in json_items.items():
+                            items.append({key: value})
+
+                        # keep the complete part of a result that was cut off
+                        reassembled_results.append(r)
+                        incomplete_responses[index] = r['discarded']
+
+                        log(f"Chunk {index} incomplete Function data - salvaged {len(salvaged_arguments(r))} JSON bytes, discarded {r['discarded']} JSON bytes")
                     else:
                         if 'function_call' in r['message'] and r['message']['function_call'] is not None:
                             incomplete_responses[index] = len(r['message']['function_call']['arguments']) if 'arguments' in r['message']['function_call'] else incomplete_responses[index]
@@ -1496,15 +2258,22 @@ class GenericProcessor:
             try:
                 user_input = self.collate_all_user_input(prompt_format_args)
                 user_input_size = len(user_input)
-                openai_customerinput_tokens, openai_customerinput_cost = get_openai_usage_per_string(user_input, True, data.get('model'))
+                openai_customerinput_tokens, openai_customerinput_cost = get_token_ledger().get_openai_usage_per_string(user_input, True, data.get('model'))
+
+                # results from the analysis result cache (or shared with an identical analysis) didn't cost an
+                #   OpenAI call, so they're recorded separately
+                openai_results = [r for r in results if not r.get('cached') and not r.get('coalesced')] if results is not None else None
+                cached_results = [r for r in results if r.get('cached')] if results is not None else []
+                coalesced_results = [r for r in results if r.get('coalesced')] if results is not None else []
+
                 openai_input_tokens, openai_input_cost = get_openai_usage_per_token(
-                    sum([r['input_tokens'] for r in results]), True, data.get('model')) if results is not None else (0, 0)
+                    sum([r['input_tokens'] for r in openai_results]), True, data.get('model')) if openai_results is not None else (0, 0)
 
                 # Get the cost of the outputs and prior inputs - so we have visibiity into our cost per user API
                 output_size = len(result) if result is not None else 0
 
                 openai_output_tokens, openai_output_cost = get_openai_usage_per_token(
-                    sum([r['output_tokens'] for r in results]), False, data.get('model')) if results is not None else (0, 0)
+                    sum([r['output_tokens'] for r in openai_results]), False, data.get('model')) if openai_results is not None else (0, 0)
                 openai_tokens = openai_input_tokens + openai_output_tokens
                 openai_cost = openai_input_cost + openai_output_cost
 
@@ -1603,6 +2372,38 @@ class GenericProcessor:
                                {'name': CostMetrics.OPENAI_OUTPUT_TOKENS, 'value': openai_output_tokens, 'unit': 'Count'},
                                {'name': CostMetrics.OPENAI_TOKENS, 'value': openai_tokens, 'unit': 'Count'})
 
+                if cached_results:
+                    cached_input_tokens, cached_input_cost = get_openai_usage_per_token(
+                        sum([r['input_tokens'] for r in cached_results]), True, data.get('model'))
+                    cached_output_tokens, cached_output_cost = get_openai_usage_per_token(
+                        sum([r['output_tokens'] for r in cached_results]), False, data.get('model'))
+
+                    log(f"Analysis result cache hits: {len(cached_results)} of {len(results)} results, saving ~${round(cached_input_cost + cached_output_cost, 5)} of OpenAI cost")
+
+                    capture_metric(customer, email, function_name, correlation_id,
+                                   {'name': InfoMetrics.RESULT_CACHE_HITS, 'value': len(cached_results), 'unit': 'Count'},
+                                   {'name': CostMetrics.CACHED_OPENAI_TOKENS, 'value': cached_input_tokens + cached_output_tokens, 'unit': 'Count'},
+                                   {'name': CostMetrics.CACHED_OPENAI_COST, 'value': round(cached_input_cost + cached_output_cost, 5), 'unit': 'None'})
+
+                if results:
+                    capture_metric(customer, email, function_name, correlation_id,
+                                   {'name': InfoMetrics.COALESCED_ANALYSES, 'value': len(coalesced_results), 'unit': 'Count'},
+                                   {'name': InfoMetrics.COALESCING_RATE, 'value': round(100 * len(coalesced_results) / len(results), 2), 'unit': 'Percent'})
+
+                # OpenAI connections opened (and handshake time) vs. pooled connections reused for this request
+                connection_stats = openai_connection_stats.since(connection_stats_at_start)
+                capture_metric(customer, email, function_name, correlation_id,
+                               {'name': InfoMetrics.OPENAI_CONNECTION_POOL_SIZE, 'value': get_openai_pool_size(), 'unit': 'Count'},
+                               {'name': InfoMetrics.OPENAI_NEW_CONNECTIONS, 'value': connection_stats['connections'], 'unit': 'Count'},
+                               {'name': InfoMetrics.OPENAI_REUSED_CONNECTIONS, 'value': connection_stats['reused'], 'unit': 'Count'},
+                               {'name': InfoMetrics.OPENAI_HANDSHAKE_TIME, 'value': round(connection_stats['handshake_seconds'] * 1000), 'unit': 'Milliseconds'})
+
+                # prompts, storage listings and tokenizer data served from the sandbox's disk cache vs. fetched remotely
+                disk_cache_usage = disk_cache_stats.take()
+                capture_metric(customer, email, function_name, correlation_id,
+                               {'name': InfoMetrics.DISK_CACHE_HITS, 'value': disk_cache_usage['hits'], 'unit': 'Count'},
+                               {'name': InfoMetrics.REMOTE_FETCHES, 'value': disk_cache_usage['remote_fetches'], 'unit': 'Count'})
+
             except Exception:
                 exception_info = traceback.format_exc().replace('\n', ' ')
                 log(f"Error capturing metrics: {exception_info}", False, True)
@@ -12,3 +12,6 @@ class PerformanceFunctionProcessor(BugFunctionGenericProcessor):
 
     def check_performance(self, data, account, function_name, correlation_id):
         return self.process_input_with_function_output(data, account, function_name, correlation_id)
+
+    def check_performance_batch(self, data, account, function_name, correlation_id):
+        return self.process_batch_input(data, account, function_name, correlation_id)
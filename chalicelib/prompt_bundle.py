@@ -0,0 +1,150 @@
+import fnmatch
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# Prompt bundles - all of a stage's prompt files packed into one versioned archive, so a container loads every
+#   prompt with one S3 fetch instead of probing and fetching each file (see client/build_prompt_bundle.py)
+#
+# A bundle is:
+#   bundle_magic
+#   the manifest length (8 bytes, big-endian)
+#   the manifest (JSON) - the bundle's version, the prefix it covers (e.g. 'prompts'), and the offset, length,
+#       SHA-256 and timestamp of each file
+#   the contents of the files, concatenated
+
+bundle_magic = b'BOOSTPROMPTBUNDLE1\n'
+
+# the bundle's object name within each stage
+prompt_bundle_name = 'prompts.bundle'
+
+
+# files is {path: (contents as bytes, timestamp)} - paths are relative to the storage root, e.g. 'prompts/x.prompt'
+def build_prompt_bundle(files, prefix, version=None):
+    manifest_files = {}
+    data = bytearray()
+    for path in sorted(files):
+        contents, timestamp = files[path]
+        manifest_files[path] = {'offset': len(data),
+                                'length': len(contents),
+                                'sha256': hashlib.sha256(contents).hexdigest(),
+                                'time': timestamp}
+        data += contents
+
+    content_hash = hashlib.sha256(json.dumps({path: manifest_file['sha256'] for path, manifest_file in manifest_files.items()},
+                                             sort_keys=True).encode('utf-8')).hexdigest()
+
+    manifest = {
+        'version': version or f"{time.strftime('%Y%m%d%H%M%S', time.gmtime())}-{content_hash[:12]}",
+        'content_hash': content_hash,
+        'prefix': prefix,
+        'files': manifest_files,
+    }
+    manifest_bytes = json.dumps(manifest, sort_keys=True).encode('utf-8')
+
+    return bundle_magic + struct.pack('>Q', len(manifest_bytes)) + manifest_bytes + bytes(data)
+
+
+class PromptBundle:
+    # buffer is the bundle's bytes - or a memory map of the bundle file, so only the files read are paged in
+    def __init__(self, buffer):
+        if buffer[:len(bundle_magic)] != bundle_magic:
+            raise ValueError("Not a prompt bundle")
+
+        manifest_start = len(bundle_magic) + 8
+        manifest_length, = struct.unpack('>Q', buffer[len(bundle_magic):manifest_start])
+        self.manifest = json.loads(buffer[manifest_start:manifest_start + manifest_length].decode('utf-8'))
+        self.data_start = manifest_start + manifest_length
+        self.buffer = buffer
+
+        self.version = self.manifest['version']
+        self.prefix = self.manifest['prefix']
+        self.files = self.manifest['files']
+
+    # whether the bundle is the whole set of files under the path's prefix
+    def covers(self, path):
+        return os.path.normpath(path) == self.prefix or path.startswith(self.prefix + '/')
+
+    # the file's (contents, timestamp), or None if it isn't in the bundle
+    def get(self, path):
+        manifest_file = self.files.get(path)
+        if manifest_file is None:
+            return None
+
+        start = self.data_start + manifest_file['offset']
+        contents = self.buffer[start:start + manifest_file['length']]
+        if hashlib.sha256(contents).hexdigest() != manifest_file['sha256']:
+            raise ValueError(f"Prompt bundle {self.version} is corrupt: {path} does not match its hash")
+
+        return contents.decode('utf-8'), manifest_file['time']
+
+    def search(self, prefix, pattern=None):
+        return sorted(path for path in self.files
+                      if path.startswith(prefix) and (pattern is None or fnmatch.fnmatch(path, os.path.join(prefix, pattern))))
+
+
+# Fetches a stage's bundle into a local file and memory-maps it - after the TTL, the bundle is revalidated with a
+#   conditional GET, and only fetched again if its ETag changed
+class PromptBundleLoader:
+    def __init__(self, client, bucket, stage, directory, ttl, clock=time.monotonic):
+        self.client = client
+        self.bucket = bucket
+        self.stage = stage
+        self.directory = directory
+        self.ttl = ttl
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.bundle = None
+        self.etag = None
+        self.checked = None
+
+    # the stage's bundle, or None if the stage doesn't have one
+    def get(self):
+        with self.lock:
+            now = self.clock()
+            if self.checked is not None and now - self.checked < self.ttl:
+                return self.bundle
+
+            conditions = {'IfNoneMatch': self.etag} if self.bundle is not None else {}
+            try:
+                s3_object = self.client.get_object(Bucket=self.bucket, Key=f"{self.stage}/{prompt_bundle_name}", **conditions)
+            except ClientError as e:
+                error_code = e.response['Error']['Code']
+                if error_code in ('304', 'NotModified'):
+                    self.checked = now
+                    return self.bundle
+                if error_code in ('NoSuchKey', '404'):
+                    self.bundle, self.etag, self.checked = None, None, now
+                    return None
+                raise
+
+            self.bundle = self.map_bundle(s3_object['Body'])
+            self.etag = s3_object.get('ETag')
+            self.checked = now
+
+            print(f"Prompt bundle {self.bundle.version} loaded for {self.stage}: {len(self.bundle.files)} files")
+
+            return self.bundle
+
+    def map_bundle(self, body):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # write then rename, so a bundle already mapped by this container is never overwritten in place
+        with tempfile.NamedTemporaryFile('wb', dir=self.directory, suffix='.tmp', delete=False) as bundle_file:
+            shutil.copyfileobj(body, bundle_file)
+        bundle_path = os.path.join(self.directory, f"{self.stage}-{prompt_bundle_name}")
+        os.replace(bundle_file.name, bundle_path)
+
+        with open(bundle_path, 'rb') as bundle_file:
+            mapped = mmap.mmap(bundle_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return PromptBundle(mapped)
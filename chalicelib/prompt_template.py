@@ -0,0 +1,70 @@
+import re
+import string
+
+# Prompt templates are compiled once when their prompt file is loaded, so building the messages for each request
+#   (and each chunk of a chunked request) is a single join - instead of finding the tags with a regex and
+#   formatting the prompt with str.format_map every time
+#
+# Rendering matches formatting with str.format_map and a dict returning '' for missing tags, which is how prompts
+#   were formatted before they were compiled
+
+
+class SafeDict(dict):
+    def __missing__(self, key):
+        return ''
+
+
+class PromptTemplate:
+    def __init__(self, text):
+        self.text = text
+
+        # the tags in the prompt, in order
+        self.tags = re.findall(r'\{(.+?)\}', text)
+        self.tag_set = frozenset(self.tags)
+
+        # the literal text before each field, then the text after the last field:
+        #   text == literals[0] + field[0] + literals[1] + field[1] + ... + literals[-1]
+        self.literals = []
+        self.fields = []  # (tag, conversion, format spec)
+
+        # prompts that can't be compiled into a simple join (e.g. '{tag.attribute}', or unbalanced braces) are
+        #   formatted as before - and raise the same errors as before, when they're used
+        self.compiled = True
+        try:
+            literal = ''
+            for literal_text, field_name, format_spec, conversion in string.Formatter().parse(text):
+                literal += literal_text
+                if field_name is None:
+                    continue
+                if not re.fullmatch(r'\w+', field_name) or '{' in (format_spec or ''):
+                    self.compiled = False
+                    break
+                self.literals.append(literal)
+                self.fields.append((field_name, conversion, format_spec or ''))
+                literal = ''
+            self.literals.append(literal)
+        except ValueError:
+            self.compiled = False
+
+    # format the prompt with the args (missing tags are empty) - with the expansion slot, if given, taking the
+    #   place of the args value for one tag (e.g. one entry of a list of context)
+    def render(self, args, slot_tag=None, slot_value=None):
+        if not self.compiled:
+            format_args = SafeDict(args)
+            if slot_tag is not None:
+                format_args[slot_tag] = slot_value
+            return self.text.format_map(format_args)
+
+        parts = [self.literals[0]]
+        for (tag, conversion, format_spec), literal in zip(self.fields, self.literals[1:]):
+            value = slot_value if tag == slot_tag else args.get(tag, '')
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion == 's':
+                value = str(value)
+            elif conversion == 'a':
+                value = ascii(value)
+            parts.append(value if type(value) is str and not format_spec else format(value, format_spec))
+            parts.append(literal)
+
+        return ''.join(parts)
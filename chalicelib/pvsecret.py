@@ -1,10 +1,49 @@
 import json
 import boto3
 import os
+import time
+import threading
 from botocore.exceptions import ClientError, EndpointConnectionError
+from cachetools import TTLCache
 
 secret_json = None
 
+region_name = "us-west-2"
+
+# Secrets Manager client shared by all secret lookups in this container
+secrets_client = None
+secrets_client_lock = threading.Lock()
+
+# JWT signing keys are cached (keyed by private) - a rotated key is picked up when the cached key expires,
+#   or sooner if a signature fails to verify with the cached key (see get_jwt_signing_key refresh)
+jwt_signing_key_ttl = int(os.environ.get('JWT_SIGNING_KEY_TTL', 3600))
+jwt_signing_key_cache = TTLCache(maxsize=2, ttl=jwt_signing_key_ttl)
+jwt_signing_key_lock = threading.Lock()
+jwt_signing_key_fetch_time = {}
+
+# minimum time between forced refreshes of a signing key, so a stream of bad signatures can't turn
+#   into a stream of Secrets Manager calls
+jwt_signing_key_min_refresh = 60
+
+# local stand-in for the Secrets Manager signing keys (e.g. for tests), keyed by private - see set_local_jwt_signing_key
+local_jwt_signing_keys = {}
+
+
+def get_secrets_client():
+    global secrets_client
+
+    if secrets_client is None:
+        with secrets_client_lock:
+            if secrets_client is None:
+                # Create a Secrets Manager client
+                session = boto3.session.Session()
+                secrets_client = session.client(
+                    service_name='secretsmanager',
+                    region_name=region_name
+                )
+
+    return secrets_client
+
 
 def get_secrets(stage='prod'):
     global secret_json
@@ -12,14 +51,8 @@ def get_secrets(stage='prod'):
         return secret_json
 
     secret_name = "exetokendev"
-    region_name = "us-west-2"
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+    client = get_secrets_client()
 
     try:
         get_secret_value_response = client.get_secret_value(
@@ -48,21 +81,46 @@ def get_secrets(stage='prod'):
     return secret_json
 
 
-def get_jwt_signing_key(private=False):
+# Use a local signing key instead of Secrets Manager (e.g. for tests); pass None to go back to Secrets Manager
+def set_local_jwt_signing_key(jwt_signing_key, private=False):
+    with jwt_signing_key_lock:
+        if jwt_signing_key is None:
+            local_jwt_signing_keys.pop(private, None)
+        else:
+            local_jwt_signing_keys[private] = jwt_signing_key
+        jwt_signing_key_cache.pop(private, None)
+        jwt_signing_key_fetch_time.pop(private, None)
+
+
+# Returns the (cached) JWT signing key
+#   refresh - refetch the key, e.g. because it may have been rotated; ignored if the key was fetched very recently
+def get_jwt_signing_key(private=False, refresh=False):
+    with jwt_signing_key_lock:
+        if private in local_jwt_signing_keys:
+            return local_jwt_signing_keys[private]
+
+        jwt_signing_key = jwt_signing_key_cache.get(private)
+        if jwt_signing_key is not None:
+            if not refresh or time.monotonic() - jwt_signing_key_fetch_time[private] < jwt_signing_key_min_refresh:
+                return jwt_signing_key
+            print(f"Refreshing JWT signing key (private={private}) - key may have been rotated")
+
+        jwt_signing_key = fetch_jwt_signing_key(private)
+
+        jwt_signing_key_cache[private] = jwt_signing_key
+        jwt_signing_key_fetch_time[private] = time.monotonic()
+
+        return jwt_signing_key
+
+
+def fetch_jwt_signing_key(private=False):
 
     if not private:
         secret_name = 'boost-sara/sara-client-public-key'
     else:
         secret_name = 'boost-sara/sara-client-private-key'
 
-    region_name = "us-west-2"
-
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+    client = get_secrets_client()
 
     try:
         get_secret_value_response = client.get_secret_value(
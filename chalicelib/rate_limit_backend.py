@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+# Shared token buckets for OpenAI tokens-per-minute - so concurrent invocations (in different containers) using the
+#   same OpenAI key share one rate limit, instead of each assuming it has the full limit to itself
+#
+# Selected with the OPENAI_RATE_LIMIT_BACKEND environment variable:
+#   dynamodb:<table name>  - DynamoDB table with a string partition key named 'key'
+#   sqlite:<file path>     - local SQLite file (e.g. for tests, or processes sharing a machine)
+#   (unset)                - no shared backend; each Throttler only limits its own calls
+
+# allowance for floating point error, so a caller that waited exactly the wait time isn't asked to wait again
+bucket_tolerance = 1e-6
+
+# buckets are keyed by this name, so services with different OpenAI keys can use separate buckets in the same table
+rate_limit_bucket_key = os.environ.get('OPENAI_RATE_LIMIT_KEY', 'openai-tokens-per-minute')
+
+
+class RateLimitBackend:
+    def __init__(self, clock=time.time):
+        self.clock = clock  # shared across containers, so this must be wall clock time
+
+    # Take tokens_needed from the shared bucket - returns 0 if the tokens were taken, or else the seconds until the
+    #   shared bucket will hold them. Like the Throttler, a call larger than the bucket runs once the bucket is full,
+    #   and leaves the bucket in debt
+    def try_acquire(self, key, tokens_needed, capacity, rate) -> float:
+        raise NotImplementedError
+
+    def acquire_from_bucket(self, tokens, updated, now, tokens_needed, capacity, rate):
+        tokens = capacity if tokens is None else min(capacity, tokens + max(0.0, now - updated) * rate)
+
+        tokens_required = min(tokens_needed, capacity)
+        if tokens + bucket_tolerance >= tokens_required:
+            return tokens - tokens_needed, 0.0
+
+        return tokens, (tokens_required - tokens) / rate
+
+
+class SQLiteRateLimitBackend(RateLimitBackend):
+    def __init__(self, path, clock=time.time):
+        super().__init__(clock)
+        self.path = path
+
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS rate_limit_buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def try_acquire(self, key, tokens_needed, capacity, rate) -> float:
+        connection = self.connect()
+        try:
+            # lock the database for the read-modify-write, so concurrent processes can't both take the same tokens
+            connection.execute("BEGIN IMMEDIATE")
+
+            row = connection.execute("SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?", (key,)).fetchone()
+            now = self.clock()
+            tokens, wait_time = self.acquire_from_bucket(row[0] if row else None, row[1] if row else now,
+                                                         now, tokens_needed, capacity, rate)
+
+            connection.execute("INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            connection.execute("COMMIT")
+
+            return wait_time
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+
+
+class DynamoDBRateLimitBackend(RateLimitBackend):
+    max_conflict_retries = 5
+
+    def __init__(self, table_name, client=None, clock=time.time):
+        super().__init__(clock)
+        self.table_name = table_name
+        self.client = client
+        self.client_lock = threading.Lock()
+
+    def get_client(self):
+        if self.client is None:
+            with self.client_lock:
+                if self.client is None:
+                    self.client = boto3.client('dynamodb')
+        return self.client
+
+    def try_acquire(self, key, tokens_needed, capacity, rate) -> float:
+        client = self.get_client()
+
+        # optimistic concurrency - the update only succeeds if no one else updated the bucket since we read it
+        for _ in range(self.max_conflict_retries):
+            item = client.get_item(TableName=self.table_name, Key={'key': {'S': key}}, ConsistentRead=True).get('Item')
+
+            now = self.clock()
+            previous_updated = item['updated']['N'] if item else None
+            tokens, wait_time = self.acquire_from_bucket(float(item['tokens']['N']) if item else None,
+                                                         float(previous_updated) if item else now,
+                                                         now, tokens_needed, capacity, rate)
+
+            # each update bumps the version - the updated time alone isn't unique, since two updates can read the
+            #   same clock time
+            previous_version = item['version']['N'] if item and 'version' in item else None
+            if previous_version is not None:
+                condition = {'ConditionExpression': '#version = :previous_version',
+                             'ExpressionAttributeNames': {'#version': 'version'},
+                             'ExpressionAttributeValues': {':previous_version': {'N': previous_version}}}
+            elif item:
+                condition = {'ConditionExpression': 'attribute_not_exists(#version) AND #updated = :previous_updated',
+                             'ExpressionAttributeNames': {'#version': 'version', '#updated': 'updated'},
+                             'ExpressionAttributeValues': {':previous_updated': {'N': previous_updated}}}
+            else:
+                condition = {'ConditionExpression': 'attribute_not_exists(#key)',
+                             'ExpressionAttributeNames': {'#key': 'key'}}
+
+            version = int(previous_version) + 1 if previous_version is not None else 1
+
+            try:
+                client.put_item(TableName=self.table_name,
+                                Item={'key': {'S': key}, 'tokens': {'N': repr(float(tokens))}, 'updated': {'N': repr(float(now))},
+                                      'version': {'N': str(version)}},
+                                **condition)
+                return wait_time
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+
+        raise Exception(f"Rate limit bucket {key} is too contended: {self.max_conflict_retries} conflicting updates")
+
+
+rate_limit_backend = None
+rate_limit_backend_lock = threading.Lock()
+
+
+# Returns the shared rate limit backend configured for this container, or None if there isn't one
+def get_rate_limit_backend():
+    global rate_limit_backend
+
+    backend_setting = os.environ.get('OPENAI_RATE_LIMIT_BACKEND')
+    if not backend_setting:
+        return None
+
+    with rate_limit_backend_lock:
+        if rate_limit_backend is None:
+            backend_type, _, location = backend_setting.partition(':')
+            if backend_type == 'dynamodb':
+                rate_limit_backend = DynamoDBRateLimitBackend(location)
+            elif backend_type == 'sqlite':
+                rate_limit_backend = SQLiteRateLimitBackend(location)
+            else:
+                raise ValueError(f"Unsupported OPENAI_RATE_LIMIT_BACKEND: {backend_setting}")
+            print(f"OpenAI rate limit shared via {backend_setting}")
+
+    return rate_limit_backend
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+# Analysis result cache - a completed OpenAI analysis is cached by the hash of everything that determines its output
+#   (the final messages, model, temperature, function schema and prompt file timestamps), so re-running the same
+#   analysis on unchanged code returns the cached result without calling OpenAI
+#
+# Disabled unless the ANALYSIS_RESULT_CACHE environment variable selects a backend:
+#   local:<directory>      - files on local disk (e.g. /tmp, for a single container or for testing)
+#   s3:<bucket>/<prefix>   - S3 objects (expire old entries with a bucket lifecycle rule as well as the TTL)
+#   dynamodb:<table name>  - DynamoDB table with a string partition key named 'key' (enable TTL on 'expires')
+
+result_cache_ttl = int(os.environ.get('ANALYSIS_RESULT_CACHE_TTL', 24 * 60 * 60))  # 1 day
+
+# the local cache keeps at most this many results, evicting the least recently used
+result_cache_max_entries = int(os.environ.get('ANALYSIS_RESULT_CACHE_MAX_ENTRIES', 1000))
+
+# results larger than this aren't cached (DynamoDB items are limited to 400KB)
+result_cache_max_entry_bytes = int(os.environ.get('ANALYSIS_RESULT_CACHE_MAX_ENTRY_BYTES', 350 * 1024))
+
+# the parts of a runAnalysis result that are cached
+cached_result_fields = ['message', 'response', 'finish', 'input_tokens', 'output_tokens']
+
+
+# key for an OpenAI call's parameters, and the timestamps of the prompt files its messages were built from
+def make_result_cache_key(params, prompt_files_timestamps=None):
+    keyed = {
+        'model': params.get('model'),
+        'temperature': params.get('temperature'),
+        'top_p': params.get('top_p'),
+        'max_tokens': params.get('max_tokens'),
+        'messages': params.get('messages'),
+        'functions': params.get('functions'),
+        'function_call': params.get('function_call'),
+        'prompt_files_timestamps': prompt_files_timestamps or {},
+    }
+    return hashlib.sha256(json.dumps(keyed, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ResultCacheBackend:
+    def __init__(self, ttl=result_cache_ttl, max_entry_bytes=result_cache_max_entry_bytes, clock=time.time,
+                 fields=cached_result_fields):
+        self.ttl = ttl
+        self.fields = fields  # None stores the whole result
+        self.max_entry_bytes = max_entry_bytes
+        self.clock = clock
+
+    # the cached result for the key, or None if there isn't one (or it has expired)
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, result):
+        raise NotImplementedError
+
+    def encode(self, result):
+        entry = json.dumps({'expires': self.clock() + self.ttl,
+                            'result': result if self.fields is None else {field: result.get(field) for field in self.fields}})
+        return entry if len(entry) <= self.max_entry_bytes else None
+
+    def decode(self, entry):
+        entry = json.loads(entry)
+        return entry['result'] if entry['expires'] > self.clock() else None
+
+
+class LocalResultCache(ResultCacheBackend):
+    def __init__(self, directory, max_entries=result_cache_max_entries, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'r') as entry_file:
+                result = self.decode(entry_file.read())
+        except FileNotFoundError:
+            return None
+
+        if result is None:
+            self.remove(key)
+        else:
+            # recently used entries are evicted last
+            os.utime(self.path(key))
+
+        return result
+
+    def put(self, key, result):
+        entry = self.encode(result)
+        if entry is None:
+            return False
+
+        # write then rename, so a reader never sees a partially written entry
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, suffix='.tmp', delete=False) as entry_file:
+            entry_file.write(entry)
+        os.replace(entry_file.name, self.path(key))
+
+        self.evict()
+        return True
+
+    def remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    # remove the least recently used entries beyond max_entries
+    def evict(self):
+        with self.lock:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.json')]
+            if len(entries) <= self.max_entries:
+                return
+
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries) - self.max_entries]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+class S3ResultCache(ResultCacheBackend):
+    def __init__(self, bucket, prefix='', client=None, **kwargs):
+        super().__init__(**kwargs)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client or boto3.client('s3')
+
+    def object_key(self, key):
+        return f"{self.prefix}/{key}.json" if self.prefix else f"{key}.json"
+
+    def get(self, key):
+        try:
+            s3_object = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+
+        return self.decode(s3_object['Body'].read().decode('utf-8'))
+
+    def put(self, key, result):
+        entry = self.encode(result)
+        if entry is None:
+            return False
+
+        self.client.put_object(Bucket=self.bucket, Key=self.object_key(key), Body=entry.encode('utf-8'),
+                               ContentType='application/json')
+        return True
+
+
+class DynamoDBResultCache(ResultCacheBackend):
+    def __init__(self, table_name, client=None, **kwargs):
+        super().__init__(**kwargs)
+        self.table_name = table_name
+        self.client = client or boto3.client('dynamodb')
+
+    def get(self, key):
+        item = self.client.get_item(TableName=self.table_name, Key={'key': {'S': key}}).get('Item')
+        return self.decode(item['entry']['S']) if item else None
+
+    def put(self, key, result):
+        entry = self.encode(result)
+        if entry is None:
+            return False
+
+        self.client.put_item(TableName=self.table_name,
+                             Item={'key': {'S': key},
+                                   'entry': {'S': entry},
+                                   'expires': {'N': str(int(self.clock() + self.ttl))}})
+        return True
+
+
+result_cache = None
+result_cache_lock = threading.Lock()
+
+
+# Returns the result cache configured for this container, or None if result caching is disabled
+def get_result_cache():
+    global result_cache
+
+    cache_setting = os.environ.get('ANALYSIS_RESULT_CACHE')
+    if not cache_setting:
+        return None
+
+    with result_cache_lock:
+        if result_cache is None:
+            result_cache = make_result_cache_backend(cache_setting, 'ANALYSIS_RESULT_CACHE')
+            print(f"Analysis results cached in {cache_setting}")
+
+    return result_cache
+
+
+# Creates the backend selected by a <type>:<location> setting (see above) - kwargs are passed to the backend
+def make_result_cache_backend(setting, setting_name, **kwargs):
+    backend_type, _, location = setting.partition(':')
+    if backend_type == 'local':
+        return LocalResultCache(location, **kwargs)
+    elif backend_type == 's3':
+        bucket, _, prefix = location.partition('/')
+        return S3ResultCache(bucket, prefix, **kwargs)
+    elif backend_type == 'dynamodb':
+        return DynamoDBResultCache(location, **kwargs)
+    else:
+        raise ValueError(f"Unsupported {setting_name}: {setting}")
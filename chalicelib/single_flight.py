@@ -0,0 +1,203 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+
+import boto3
+from botocore.exceptions import ClientError
+
+# Coalescing identical concurrent analyses - calls with the same key (the analysis result cache key, see
+#   result_cache.py) share one OpenAI call instead of each making their own:
+#   SingleFlight       - threads (and asyncio chunk engine tasks) in this container wait for the first caller's result
+#   AnalysisLease      - across containers, the first caller takes a lease on the key, and the others wait for its
+#                        result to appear in the result cache. Enabled with ANALYSIS_LEASE=dynamodb:<table name>
+#                        (string partition key named 'key'), and only used when the result cache is enabled
+
+analysis_lease_ttl = int(os.environ.get('ANALYSIS_LEASE_TTL', 6 * 60))  # the longest a single OpenAI call is allowed
+
+# how often a caller waiting on another container's lease checks the result cache
+analysis_lease_poll_interval = float(os.environ.get('ANALYSIS_LEASE_POLL_INTERVAL', 1.0))
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = []  # (event loop, future) of each task waiting for the result
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    # returns fn's result, and whether it came from another caller's call of fn for the same key
+    def do(self, key, fn):
+        flight, leader = self.start(key)
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return dict(flight.result), True
+
+        try:
+            flight.result = fn()
+            return flight.result, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self.finish(key, flight)
+
+    # do for tasks on an event loop (the asyncio chunk engine) - fn is a coroutine function. Tasks share calls with
+    #   threads in this container (and the other way around), and wait for a result without blocking the loop
+    async def do_async(self, key, fn):
+        flight, leader = self.start(key)
+
+        if not leader:
+            await self.wait(flight)
+            if flight.error is not None:
+                raise flight.error
+            return dict(flight.result), True
+
+        try:
+            flight.result = await fn()
+            return flight.result, False
+        except asyncio.CancelledError:
+            # the callers waiting for it make their own call (or give up) - they aren't cancelled with this task
+            flight.error = TimeoutError("Identical analysis in flight was cancelled")
+            raise
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self.finish(key, flight)
+
+    # wait for a call already in flight for the key and return its result - or None if there isn't one, or it failed
+    #   (so the caller can make the call itself)
+    def join(self, key):
+        with self.lock:
+            flight = self.flights.get(key)
+
+        if flight is None:
+            return None
+
+        flight.done.wait()
+        return dict(flight.result) if flight.error is None else None
+
+    async def join_async(self, key):
+        with self.lock:
+            flight = self.flights.get(key)
+
+        if flight is None:
+            return None
+
+        await self.wait(flight)
+        return dict(flight.result) if flight.error is None else None
+
+    # returns the flight for the key, and whether the caller leads it (makes the call)
+    def start(self, key):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        return flight, leader
+
+    def finish(self, key, flight):
+        with self.lock:
+            del self.flights[key]
+            flight.done.set()
+            waiters = flight.waiters
+
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(set_flight_done, future)
+            except RuntimeError:
+                pass  # the waiting task's event loop has already closed, so there's no one to tell
+
+    async def wait(self, flight):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if flight.done.is_set():
+                return
+            flight.waiters.append((loop, future))
+
+        # a waiting task that's cancelled stops waiting, without affecting the flight
+        await future
+
+
+def set_flight_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+# analyses in flight in this container
+analysis_flights = SingleFlight()
+
+
+class AnalysisLease:
+    def __init__(self, table_name, client=None, ttl=analysis_lease_ttl, clock=time.time):
+        self.table_name = table_name
+        self.client = client or boto3.client('dynamodb')
+        self.ttl = ttl
+        self.clock = clock
+        self.owner = str(uuid.uuid4())  # this container
+
+    # returns True if this container now holds the lease on the key (no one else does, or their lease expired)
+    def acquire(self, key):
+        now = self.clock()
+        try:
+            self.client.put_item(TableName=self.table_name,
+                                 Item={'key': {'S': key}, 'owner': {'S': self.owner}, 'expires': {'N': repr(now + self.ttl)}},
+                                 ConditionExpression='attribute_not_exists(#key) OR #expires < :now',
+                                 ExpressionAttributeNames={'#key': 'key', '#expires': 'expires'},
+                                 ExpressionAttributeValues={':now': {'N': repr(now)}})
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+
+    def release(self, key):
+        try:
+            self.client.delete_item(TableName=self.table_name,
+                                    Key={'key': {'S': key}},
+                                    ConditionExpression='#owner = :owner',
+                                    ExpressionAttributeNames={'#owner': 'owner'},
+                                    ExpressionAttributeValues={':owner': {'S': self.owner}})
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    # True if another container holds an unexpired lease on the key
+    def is_held(self, key):
+        item = self.client.get_item(TableName=self.table_name, Key={'key': {'S': key}}, ConsistentRead=True).get('Item')
+        return item is not None and float(item['expires']['N']) >= self.clock()
+
+
+analysis_lease = None
+analysis_lease_lock = threading.Lock()
+
+
+# Returns the lease for coalescing analyses across containers, or None if it isn't configured
+def get_analysis_lease():
+    global analysis_lease
+
+    lease_setting = os.environ.get('ANALYSIS_LEASE')
+    if not lease_setting:
+        return None
+
+    with analysis_lease_lock:
+        if analysis_lease is None:
+            backend_type, _, location = lease_setting.partition(':')
+            if backend_type != 'dynamodb':
+                raise ValueError(f"Unsupported ANALYSIS_LEASE: {lease_setting}")
+            analysis_lease = AnalysisLease(location)
+            print(f"Analyses coalesced across containers via {lease_setting}")
+
+    return analysis_lease
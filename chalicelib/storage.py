@@ -1,13 +1,39 @@
 import boto3
+from botocore.exceptions import ClientError
 import os
 from datetime import datetime
-import fnmatch
 import glob
+import json
+import tempfile
+import threading
+import time
+
+from chalicelib.prompt_bundle import PromptBundleLoader
+from chalicelib.disk_cache import get_disk_cache, disk_cache_stats
+from chalicelib.storage_index import StorageIndex, listing_version
 
 
 file_contents_cache = {}
 s3_storage_bucket_name = "polyverse-boost"
 
+# what we last learned about each S3 file (keyed by its stage and filename) - whether it exists in that stage, and
+#   the ETag of its contents. Within the TTL, a file is served from file_contents_cache with no S3 call at all;
+#   after it, the file is revalidated with a conditional GET, which only downloads the file if it changed
+s3_metadata_cache = {}
+s3_metadata_ttl = float(os.environ.get('STORAGE_METADATA_TTL', 60))
+
+s3_client = None
+s3_client_lock = threading.Lock()
+
+# each stage's prompt bundle is mapped from a local copy (see prompt_bundle.py)
+prompt_bundle_directory = os.environ.get('PROMPT_BUNDLE_DIRECTORY', os.path.join(tempfile.gettempdir(), 'prompt-bundles'))
+prompt_bundle_loaders = {}
+prompt_bundle_loaders_lock = threading.Lock()
+
+# the index of each stage's listing of a prefix (see storage_index.py) - keyed by (stage, prefix)
+storage_indexes = {}
+storage_indexes_lock = threading.Lock()
+
 LOCAL_BASE_FOLDER = 'chalicelib'
 
 SEARCH_STAGES = ['dev', 'test', 'staging', 'prod', 'local']
@@ -65,28 +91,25 @@ def get_file(filename) -> str:
             log(f"Found Local file: {os.path.join(LOCAL_BASE_FOLDER, filename)}")
             break
 
-        elif file_exists_in_s3(s3_storage_bucket_name, filename, stage):
-            log(f"Found S3({stage if stage is not None else 'any'}) file: {filename}")
-            s3 = boto3.client('s3')
-
-            s3_object = s3.get_object(Bucket=s3_storage_bucket_name, Key=os.path.join(stage, filename))
+        else:
+            # the stage's prompt bundle holds all of the files it covers, so there's nothing to fetch per file
+            prompt_bundle = get_prompt_bundle(stage)
+            if prompt_bundle is not None and prompt_bundle.covers(filename):
+                bundled_file = prompt_bundle.get(filename)
+                if bundled_file is None:
+                    continue
 
-            timestamp = s3_object['LastModified'].timestamp()
-
-            # first read the file cache
-            cached_file_contents = file_contents_cache.get(filename)
-            if cached_file_contents is not None:
-
-                # if the file has changed, then we need to reload it
-                if cached_file_contents['time'] != timestamp:
-                    log(f"S3 File {filename} has changed, reloading.")
+                file_content, timestamp = bundled_file
+                etag = None
+                break
 
-                # if the file hasn't changed, then we can just return the cached contents
-                else:
-                    log(f"S3 File {filename} has not changed, returning cached contents.")
-                    return cached_file_contents['contents']
+            s3_file = get_s3_file(filename, stage)
+            if s3_file is None:
+                continue
 
-            file_content = s3_object['Body'].read().decode('utf-8')
+            file_content, timestamp, etag, cached = s3_file
+            if cached:
+                return file_content
 
             break
     else:
@@ -95,7 +118,9 @@ def get_file(filename) -> str:
     # Cache the file contents globally for all services to use it, saving further S3 or filesystem calls
     file_contents_cache[filename] = {
         "contents": file_content,
-        "time": timestamp
+        "time": timestamp,
+        "stage": stage,
+        "etag": etag if stage != "local" else None
     }
     timestamp_pretty = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
 
@@ -105,18 +130,132 @@ def get_file(filename) -> str:
 
 
 def get_file_time(filename):
-    # note the cache is not aware of stages at this time, so if
-    #   the timestamp represents the first stage it was loaded from
-    #   if a different stage has a newer file at a later time, it won't
-    #   be refreshed in the cache
+    # the timestamp is of the file in the stage it was last loaded from (see get_file)
     if filename in file_contents_cache:
         return file_contents_cache.get(filename).get("time")
     else:
         raise FileNotFoundError(f"File {filename} not found in cache.")
 
 
+# Returns the S3 client shared by all storage calls in this container
+def get_s3_client():
+    global s3_client
+
+    if s3_client is None:
+        with s3_client_lock:
+            if s3_client is None:
+                s3_client = boto3.client('s3')
+
+    return s3_client
+
+
+# Returns the stage's prompt bundle, or None if the stage doesn't have one (or bundles aren't enabled)
+def get_prompt_bundle(stage):
+    # load prompts from per-stage bundles only if enabled in environment variable
+    usePromptBundle = True if "usePromptBundle" in os.environ and os.environ["usePromptBundle"] == "True" else False
+    if not usePromptBundle:
+        return None
+
+    with prompt_bundle_loaders_lock:
+        loader = prompt_bundle_loaders.get(stage)
+        if loader is None:
+            loader = prompt_bundle_loaders[stage] = PromptBundleLoader(get_s3_client(), s3_storage_bucket_name, stage,
+                                                                       prompt_bundle_directory, s3_metadata_ttl)
+
+    return loader.get()
+
+
+# Returns the file's (contents, timestamp, etag, whether the contents came from file_contents_cache) in the stage,
+#   or None if the stage doesn't have the file
+def get_s3_file(filename, stage):
+    key = os.path.join(stage, filename)
+    now = time.monotonic()
+
+    cached_file_contents = file_contents_cache.get(filename)
+    if cached_file_contents is not None and (cached_file_contents.get('stage') != stage or not cached_file_contents.get('etag')):
+        cached_file_contents = None  # cached from another stage (or locally), so it can't be revalidated here
+
+    metadata = s3_metadata_cache.get(key)
+
+    # a new process starts with what earlier processes in this sandbox fetched
+    disk_cache = get_disk_cache()
+    from_disk = False
+    checked_on_disk = False
+    if cached_file_contents is None and disk_cache is not None:
+        disk_cached = disk_cache.get(disk_cache_key(key))
+        if disk_cached is not None:
+            contents, disk_metadata = disk_cached
+            checked_ago = time.time() - disk_metadata['checked']
+            if metadata is None and checked_ago < s3_metadata_ttl:
+                metadata = s3_metadata_cache[key] = {'checked': now - checked_ago, 'exists': disk_metadata['exists'],
+                                                     'etag': disk_metadata['etag']}
+                checked_on_disk = True
+            if disk_metadata['exists']:
+                cached_file_contents = {'contents': contents.decode('utf-8'), 'time': disk_metadata['time'],
+                                        'stage': stage, 'etag': disk_metadata['etag']}
+                from_disk = True
+
+    if metadata is not None and now - metadata['checked'] < s3_metadata_ttl:
+        if not metadata['exists']:
+            if checked_on_disk:
+                disk_cache_stats.record_hit()
+            return None
+        if cached_file_contents is not None and cached_file_contents['etag'] == metadata['etag']:
+            log(f"S3 File {filename} checked {now - metadata['checked']:.0f}s ago, returning cached contents.", True)
+            if from_disk:
+                disk_cache_stats.record_hit()
+            return cached_file_contents['contents'], cached_file_contents['time'], metadata['etag'], not from_disk
+
+    # only download the file if it changed since we cached it
+    conditions = {'IfNoneMatch': cached_file_contents['etag']} if cached_file_contents is not None else {}
+    try:
+        s3_object = get_s3_client().get_object(Bucket=s3_storage_bucket_name, Key=key, **conditions)
+    except ClientError as e:
+        error_code = e.response['Error']['Code']
+        if error_code in ('304', 'NotModified'):
+            log(f"S3 File {filename} has not changed, returning cached contents.")
+            s3_metadata_cache[key] = {'checked': now, 'exists': True, 'etag': cached_file_contents['etag']}
+            if disk_cache is not None:
+                disk_cache.update_metadata(disk_cache_key(key), {'exists': True, 'etag': cached_file_contents['etag'],
+                                                                 'time': cached_file_contents['time'], 'checked': time.time()})
+            if from_disk:
+                disk_cache_stats.record_hit()
+            return cached_file_contents['contents'], cached_file_contents['time'], cached_file_contents['etag'], not from_disk
+
+        if error_code in ('NoSuchKey', '404'):
+            log(f"File not found in S3({stage}): {filename}", True)
+            s3_metadata_cache[key] = {'checked': now, 'exists': False, 'etag': None}
+            if disk_cache is not None:
+                disk_cache.put(disk_cache_key(key), b'', {'exists': False, 'etag': None, 'time': None, 'checked': time.time()})
+            return None
+
+        raise
+
+    if cached_file_contents is not None:
+        log(f"S3 File {filename} has changed, reloading.")
+    else:
+        log(f"Found S3({stage}) file: {filename}")
+
+    etag = s3_object.get('ETag')
+    s3_metadata_cache[key] = {'checked': now, 'exists': True, 'etag': etag}
+
+    contents = s3_object['Body'].read()
+    timestamp = s3_object['LastModified'].timestamp()
+
+    disk_cache_stats.record_remote_fetch()
+    if disk_cache is not None:
+        disk_cache.put(disk_cache_key(key), contents, {'exists': True, 'etag': etag, 'time': timestamp, 'checked': time.time()})
+
+    return contents.decode('utf-8'), timestamp, etag, False
+
+
+# the disk cache key for an object in the storage bucket
+def disk_cache_key(key):
+    return f"s3://{s3_storage_bucket_name}/{key}"
+
+
 def file_exists_in_s3(bucket_name, key_name, stage=None):
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
 
     response = s3.list_objects_v2(
         Bucket=bucket_name,
@@ -159,27 +298,94 @@ def search_storage(prefix, pattern=None) -> list:
 
 def search_storage_with_stage(stage, prefix, pattern=None) -> list:
     if stage == "local":
-        base_path = os.path.join(os.path.abspath(os.path.curdir), LOCAL_BASE_FOLDER, prefix)
-        unsorted_paths = glob.glob(os.path.join(base_path, pattern))
-        matched_files = [os.path.relpath(path, os.path.join(os.path.abspath(os.path.curdir), LOCAL_BASE_FOLDER)) for path in unsorted_paths]
+        # glob patterns that reach into subdirectories (or match hidden files) aren't in the directory's index
+        if pattern is not None and (os.sep in pattern or pattern.startswith('.')):
+            base_path = os.path.join(os.path.abspath(os.path.curdir), LOCAL_BASE_FOLDER, prefix)
+            unsorted_paths = glob.glob(os.path.join(base_path, pattern))
+            return sorted(os.path.relpath(path, os.path.join(os.path.abspath(os.path.curdir), LOCAL_BASE_FOLDER)) for path in unsorted_paths)
     else:
-        s3 = boto3.client('s3')
-        paginator = s3.get_paginator('list_objects_v2')
-
-        matched_files = []
-
-        for page in paginator.paginate(Bucket=s3_storage_bucket_name,
-                                       Prefix=os.path.join(stage, prefix),
-                                       PaginationConfig={
-                                           'MaxItems': 500,
-                                           'PageSize': 50}
-                                       ):
-            for obj in page.get('Contents', []):
-                actualFile = os.path.relpath(obj['Key'], stage)
-
-                # using fnmatch to filter results
-                if (pattern is None
-                        or fnmatch.fnmatch(obj['Key'], os.path.join(stage, prefix, pattern))):
-                    matched_files.append(actualFile)
-
-    return sorted(matched_files)
+        # the stage's prompt bundle lists all of the files it covers
+        prompt_bundle = get_prompt_bundle(stage)
+        if prompt_bundle is not None and prompt_bundle.covers(prefix):
+            return prompt_bundle.search(prefix, pattern)
+
+    return get_storage_index(stage, prefix).search(prefix, pattern)
+
+
+# Returns the index of everything under the prefix in the stage. S3 listings are refreshed after the metadata TTL -
+#   and if the relisting finds the same keys and ETags, the index (and the patterns it already resolved) is kept.
+#   Local listings are refreshed when the directory's modification time changes.
+def get_storage_index(stage, prefix):
+    with storage_indexes_lock:
+        cached_index = storage_indexes.get((stage, prefix))
+
+        if stage == "local":
+            base_path = os.path.join(os.path.abspath(os.path.curdir), LOCAL_BASE_FOLDER, prefix)
+            try:
+                version = os.stat(base_path).st_mtime_ns
+            except FileNotFoundError:
+                version = None
+
+            if cached_index is not None and cached_index['index'].version == version:
+                return cached_index['index']
+
+            paths = []
+            if version is not None and os.path.isdir(base_path):
+                # like glob, hidden files aren't matched by wildcards
+                paths = [os.path.normpath(os.path.join(prefix, name)) for name in os.listdir(base_path) if not name.startswith('.')]
+
+            index = StorageIndex(paths, version)
+            storage_indexes[(stage, prefix)] = {'index': index, 'checked': time.monotonic()}
+            return index
+
+        now = time.monotonic()
+        if cached_index is not None and now - cached_index['checked'] < s3_metadata_ttl:
+            return cached_index['index']
+
+        objects = list_s3_objects(stage, prefix)
+        version = listing_version(objects)
+
+        if cached_index is not None and cached_index['index'].version == version:
+            log(f"S3({stage}) listing of {prefix} has not changed, keeping its index.", True)
+            cached_index['checked'] = now
+            return cached_index['index']
+
+        index = StorageIndex([os.path.relpath(key, stage) for key, _ in objects], version)
+        storage_indexes[(stage, prefix)] = {'index': index, 'checked': now}
+
+        log(f"S3({stage}) listing of {prefix} indexed: {len(index.paths)} files", True)
+
+        return index
+
+
+# Returns the [key, etag] of each object under the prefix in the stage - listings are kept in the disk cache for the
+#   metadata TTL, so processes starting in a warm sandbox don't list the bucket again
+def list_s3_objects(stage, prefix):
+    listing_key = f"listing:{disk_cache_key(os.path.join(stage, prefix))}"
+
+    disk_cache = get_disk_cache()
+    if disk_cache is not None:
+        disk_cached = disk_cache.get(listing_key)
+        if disk_cached is not None and time.time() - disk_cached[1]['listed'] < s3_metadata_ttl:
+            disk_cache_stats.record_hit()
+            return json.loads(disk_cached[0].decode('utf-8'))
+
+    s3 = get_s3_client()
+    paginator = s3.get_paginator('list_objects_v2')
+
+    objects = []
+
+    for page in paginator.paginate(Bucket=s3_storage_bucket_name,
+                                   Prefix=os.path.join(stage, prefix),
+                                   PaginationConfig={
+                                       'MaxItems': 500,
+                                       'PageSize': 50}
+                                   ):
+        for obj in page.get('Contents', []):
+            objects.append([obj['Key'], obj.get('ETag')])
+
+    disk_cache_stats.record_remote_fetch()
+    if disk_cache is not None:
+        disk_cache.put(listing_key, json.dumps(objects).encode('utf-8'), {'listed': time.time()})
+
+    return objects
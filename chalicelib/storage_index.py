@@ -0,0 +1,47 @@
+import bisect
+import fnmatch
+import hashlib
+import json
+import os
+
+# Index of a storage listing - the full set of paths under a prefix in one stage, listed once, so glob patterns
+#   (e.g. 'guidelines-user-*.prompt') are resolved in memory instead of listing storage for each pattern
+#
+# Paths are relative to the stage (e.g. 'prompts/guidelines-user-1.prompt'). The version identifies the listing's
+#   contents (a hash of the listed keys and their ETags in S3, or the directory's modification time locally), so a
+#   relisting that finds nothing changed keeps the index, and its resolved patterns
+
+
+# the version of an S3 listing of [key, etag] pairs
+def listing_version(objects):
+    return hashlib.sha256(json.dumps(sorted(objects)).encode('utf-8')).hexdigest()
+
+
+class StorageIndex:
+    def __init__(self, paths, version):
+        self.paths = sorted(paths)
+        self.version = version
+
+        # resolved patterns, keyed by (prefix, pattern)
+        self.matches = {}
+
+    def search(self, prefix, pattern=None):
+        matched_files = self.matches.get((prefix, pattern))
+        if matched_files is None:
+            full_pattern = prefix if pattern is None else os.path.join(prefix, pattern)
+
+            # only the paths starting with the pattern's literal prefix can match it
+            literal = full_pattern
+            for wildcard in '*?[':
+                literal = literal.split(wildcard, 1)[0]
+
+            matched_files = []
+            for path in self.paths[bisect.bisect_left(self.paths, literal):]:
+                if not path.startswith(literal):
+                    break
+                if pattern is None or fnmatch.fnmatch(path, full_pattern):
+                    matched_files.append(path)
+
+            self.matches[(prefix, pattern)] = matched_files
+
+        return list(matched_files)
@@ -4,6 +4,12 @@ from aws_xray_sdk.core import patch_all
 import boto3
 import os
 import traceback
+import threading
+import json
+import time
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
 
 
 # If running under AWS Lambda - Patch all supported libraries for X-Ray tracing, enable CloudWatch
@@ -11,21 +17,51 @@ if 'AWS_CHALICE_CLI_MODE' not in os.environ and 'AWS_LAMBDA_FUNCTION_NAME' in os
     print('AWS Lambda Enabled: Setting up Telemetry, Tracing and CloudWatch')
     patch_all()
     print('patched all functions')
-    # Create a CloudWatch client to log metrics and errors
-    cloudwatch = boto3.client('cloudwatch')
+    # the CloudWatch client is created on first metric (see get_cloudwatch_client) to keep cold starts fast
+    aws_telemetry_enabled = True
     print('CloudWatch enabled')
 
     xray_recorder.configure(service='Boost', context_missing='LOG_ERROR')
     print('X-Ray configured')
 else:
-    cloudwatch = None
+    aws_telemetry_enabled = False
     print('AWS Lambda not detected, skipping X-Ray configuration.')
 
+cloudwatch = None
+cloudwatch_lock = threading.Lock()
+
+
+# Create a CloudWatch client to log metrics and errors - once per container, on first use
+def get_cloudwatch_client():
+    global cloudwatch
+
+    if not aws_telemetry_enabled:
+        return None
+
+    if cloudwatch is None:
+        with cloudwatch_lock:
+            if cloudwatch is None:
+                cloudwatch = boto3.client('cloudwatch')
+
+    return cloudwatch
+
 
 class InfoMetrics:
     GITHUB_ACCESS_NOT_FOUND = 'GitHubAccessNotFound'
     BILLING_USAGE_FAILURE = 'BillingUsageFailure'
     OPENAI_RATE_LIMIT = 'OpenAIRateLimit'
+    CHUNK_SKIPPED = 'ChunkSkipped'
+    OPENAI_CONNECTION_POOL_SIZE = 'OpenAIConnectionPoolSize'
+    OPENAI_NEW_CONNECTIONS = 'OpenAINewConnections'
+    OPENAI_REUSED_CONNECTIONS = 'OpenAIReusedConnections'
+    OPENAI_HANDSHAKE_TIME = 'OpenAIHandshakeTime'
+    OPENAI_TIME_TO_FIRST_TOKEN = 'OpenAITimeToFirstToken'
+    OPENAI_PARTIAL_RESPONSE = 'OpenAIPartialResponse'
+    RESULT_CACHE_HITS = 'ResultCacheHits'
+    COALESCED_ANALYSES = 'CoalescedAnalyses'
+    COALESCING_RATE = 'CoalescingRate'
+    DISK_CACHE_HITS = 'DiskCacheHits'
+    REMOTE_FETCHES = 'RemoteFetches'
     NEW_CUSTOMER = 'NewCustomer'
     NEW_CUSTOMER_ERROR = 'NewCustomerERROR'
 
@@ -47,11 +83,134 @@ class CostMetrics:
     OPENAI_INPUT_TOKENS = 'OpenAIInputTokens'
     OPENAI_CUSTOMERINPUT_TOKENS = 'OpenAICustomerInputTokens'
     OPENAI_OUTPUT_TOKENS = 'OpenAIOutputTokens'
+    CACHED_OPENAI_TOKENS = 'CachedOpenAITokens'
+    CACHED_OPENAI_COST = 'CachedOpenAICost'
 
 
 regularResolutionCloudWatchMetric = 60
 highResolutionCloudWatchMetric = 1
 
+cloudWatchMetricsNamespace = 'Boost/Lambda'
+
+# 'api' - metrics are sent with put_metric_data
+# 'emf' - metrics are written to the log in CloudWatch Embedded Metric Format, so no CloudWatch API call is made
+cloudWatchMetricsFormat = os.environ.get('CLOUD_WATCH_METRICS_FORMAT', 'api').lower()
+
+# CloudWatch limits - values per metric per put_metric_data entry, metric entries per put_metric_data call,
+#   and values per metric per Embedded Metric Format log line
+maxValuesPerMetricDatum = 150
+maxMetricDataPerPut = 1000
+maxValuesPerEmbeddedMetric = 100
+
+
+# Metrics captured during a request (e.g. an invocation) - aggregated by metric name, unit and dimensions,
+#   then emitted once at the end of the request (see metrics_buffer_scope)
+class MetricsBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def add(self, metric_data):
+        with self.lock:
+            for metric in metric_data:
+                key = (metric['MetricName'], metric['Unit'], metric['StorageResolution'],
+                       tuple((dimension['Name'], dimension['Value']) for dimension in metric['Dimensions']))
+                self.metrics.setdefault(key, []).append(metric['Value'])
+
+    def flush(self):
+        with self.lock:
+            metrics = self.metrics
+            self.metrics = {}
+
+        if not metrics:
+            return
+
+        if cloudWatchMetricsFormat == 'emf':
+            emit_embedded_metrics(metrics)
+        else:
+            put_buffered_metrics(metrics)
+
+
+def put_buffered_metrics(metrics):
+    metric_data = []
+    for (name, unit, resolution, dimensions), values in metrics.items():
+        # identical values (e.g. a count of 1) are sent once, with a count
+        value_counts = list(Counter(values).items())
+        for i in range(0, len(value_counts), maxValuesPerMetricDatum):
+            batch = value_counts[i:i + maxValuesPerMetricDatum]
+            metric_data.append({
+                'MetricName': name,
+                'Dimensions': [{'Name': dimension_name, 'Value': dimension_value} for dimension_name, dimension_value in dimensions],
+                'Unit': unit,
+                'Values': [value for value, _ in batch],
+                'Counts': [count for _, count in batch],
+                'StorageResolution': resolution
+            })
+
+    for i in range(0, len(metric_data), maxMetricDataPerPut):
+        get_cloudwatch_client().put_metric_data(Namespace=cloudWatchMetricsNamespace, MetricData=metric_data[i:i + maxMetricDataPerPut])
+
+
+# One log line per set of dimension values, containing every metric captured with those dimensions
+#   https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+def emit_embedded_metrics(metrics):
+    metrics_by_dimensions = {}
+    for (name, unit, resolution, dimensions), values in metrics.items():
+        metrics_by_dimensions.setdefault(dimensions, []).append((name, unit, resolution, values))
+
+    timestamp = int(time.time() * 1000)
+    for dimensions, dimension_metrics in metrics_by_dimensions.items():
+        # a metric can have at most 100 values per log line, so very busy metrics span multiple lines
+        for i in range(0, max(len(values) for _, _, _, values in dimension_metrics), maxValuesPerEmbeddedMetric):
+            log_line = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': cloudWatchMetricsNamespace,
+                        'Dimensions': [[dimension_name for dimension_name, _ in dimensions]],
+                        'Metrics': []
+                    }]
+                }
+            }
+            for dimension_name, dimension_value in dimensions:
+                log_line[dimension_name] = dimension_value
+
+            for name, unit, resolution, values in dimension_metrics:
+                line_values = [float(value) for value in values[i:i + maxValuesPerEmbeddedMetric]]
+                if not line_values:
+                    continue
+                log_line['_aws']['CloudWatchMetrics'][0]['Metrics'].append({'Name': name, 'Unit': unit, 'StorageResolution': resolution})
+                log_line[name] = line_values[0] if len(line_values) == 1 else line_values
+
+            print(json.dumps(log_line))
+
+
+def emit_metric_data(metric_data):
+    buffer = MetricsBuffer()
+    buffer.add(metric_data)
+    buffer.flush()
+
+
+# the metrics buffer for the current request - if there is no buffer, metrics are emitted as they are captured
+current_metrics_buffer = contextvars.ContextVar('current_metrics_buffer', default=None)
+
+
+# Buffer all metrics captured in this scope, and emit them once when the scope exits
+@contextmanager
+def metrics_buffer_scope():
+    buffer = MetricsBuffer()
+    token = current_metrics_buffer.set(buffer)
+    try:
+        yield buffer
+    finally:
+        current_metrics_buffer.reset(token)
+        try:
+            buffer.flush()
+        # Never fail on metrics
+        except Exception:
+            exception_info = traceback.format_exc().replace('\n', ' ')
+            print(f"capture_metric:FAILED:ERROR: Failed to emit buffered metrics: {exception_info}")
+
 
 # Capture a metric to CloudWatch or local console
 # Usage: capture_metric(customer, email, function_name, correlation_id, {'name': 'PromptSize', 'value': prompt_size, 'unit': 'Bytes'})
@@ -70,7 +229,7 @@ def capture_metric(customer, email, function_name: "capture_metric", correlation
             print(f"METRIC::[{customer['name']}:{customer['id']}:{email}]{function_name}({correlation_id}):{metric['name']}: {formatted_value} ({metric['unit']})")
 
         # if we're not running in AWS Lambda, don't try to log to CloudWatch
-        if cloudwatch is None:
+        if not aws_telemetry_enabled:
             return
 
         lambda_function = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', function_name)
@@ -109,7 +268,11 @@ def capture_metric(customer, email, function_name: "capture_metric", correlation
         if os.environ.get('CLOUD_WATCH_METRICS_ENABLED') is None:
             return
 
-        cloudwatch.put_metric_data(Namespace='Boost/Lambda', MetricData=metric_data)
+        buffer = current_metrics_buffer.get()
+        if buffer is not None:
+            buffer.add(metric_data)
+        else:
+            emit_metric_data(metric_data)
 
     # Never fail on metrics
     except Exception:
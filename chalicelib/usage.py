@@ -1,8 +1,15 @@
 import tiktoken
 import os
 import json
+import hashlib
+import threading
+import contextvars
+import bisect
+from contextlib import contextmanager
 from typing import Tuple, List
 
+from chalicelib.disk_cache import get_disk_cache, disk_cache_stats
+
 
 class OpenAIDefaults:
     boost_max_tokens_unlimited = 0
@@ -125,6 +132,15 @@ def load_encodings():
 
     encoding_loaded = True
 
+    # tiktoken's downloaded tokenizer files are kept in the sandbox's disk cache, so new processes don't download them
+    disk_cache = get_disk_cache()
+    cached_tokenizer_files = set()
+    if disk_cache is not None:
+        try:
+            cached_tokenizer_files = disk_cache.prepare_tiktoken_cache()
+        except OSError as error:
+            print("Failed to prepare tokenizer disk cache due to error: " + str(error))
+
     try:
         text_encoding = tiktoken.get_encoding(OpenAIDefaults.encoding_gpt4_and_gpt35)
         code_encoding = tiktoken.get_encoding(OpenAIDefaults.encoding_codex)
@@ -136,6 +152,14 @@ def load_encodings():
         print("Failed to load OpenAI encodings due to error: " + str(error))
         pass
 
+    if disk_cache is not None:
+        try:
+            downloaded_tokenizer_files = disk_cache.record_tiktoken_cache(cached_tokenizer_files)
+            disk_cache_stats.record_hit(len(cached_tokenizer_files))
+            disk_cache_stats.record_remote_fetch(len(downloaded_tokenizer_files))
+        except OSError as error:
+            print("Failed to record tokenizer disk cache due to error: " + str(error))
+
     # Don't run this under Chalice deployment
     if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
         print("Loaded OpenAI encodings")
@@ -225,6 +249,128 @@ def decode_string_from_input(input: list[int], model=OpenAIDefaults.boost_defaul
     return output
 
 
+# Returns the name of the tokenizer encoding used for a specific model
+def encoding_name_for_model(model=OpenAIDefaults.boost_default_gpt_model) -> str:
+    if model in [OpenAIDefaults.boost_model_cheap_fast_generic]:
+        return OpenAIDefaults.encoding_gpt3
+    elif model in [OpenAIDefaults.boost_model_codex, OpenAIDefaults.boost_model_gpt35_generic]:
+        return OpenAIDefaults.encoding_codex
+    else:
+        return OpenAIDefaults.encoding_gpt4_and_gpt35
+
+
+# Request-scoped memo of tokenized content, keyed by the content hash and the encoding used to tokenize it
+#   A single request tokenizes the same prompt messages many times (content optimization, chunking,
+#   prompt building and billing), so each unique piece of content is only run through tiktoken once
+# Note that the cached token arrays are shared - callers may slice them, but must not modify them
+class TokenLedger:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def content_key(self, string: str, model) -> Tuple[str, str]:
+        return encoding_name_for_model(model), hashlib.sha1(string.encode('utf-8')).hexdigest()
+
+    # Returns the number of tokens in a text string, and the encoded string - same as num_tokens_from_string
+    def num_tokens_from_string(self, string: str, model=OpenAIDefaults.boost_default_gpt_model) -> Tuple[int, List[int]]:
+        key = self.content_key(string, model)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+
+        entry = num_tokens_from_string(string, model)
+
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = entry
+
+        return entry
+
+    # Returns the cached token array for a text string, so callers can slice and decode it without re-tokenizing
+    def tokens_from_string(self, string: str, model=OpenAIDefaults.boost_default_gpt_model) -> List[int]:
+        return self.num_tokens_from_string(string, model)[1]
+
+    def get_openai_usage_per_string(self, payload: str, input: bool, model=OpenAIDefaults.boost_default_gpt_model) -> Tuple[int, float]:
+        token_count, _ = self.num_tokens_from_string(payload, model)
+
+        return get_openai_usage_per_token(token_count, input, model)
+
+    def summary(self) -> str:
+        return f"{len(self.entries)} unique strings tokenized, {self.hits} cache hits, {self.misses} cache misses"
+
+
+current_token_ledger = contextvars.ContextVar('current_token_ledger', default=None)
+
+
+# Scope a token ledger to the current request - all token counting in the scope shares the same ledger
+@contextmanager
+def token_ledger_scope():
+    ledger = TokenLedger()
+    reset_token = current_token_ledger.set(ledger)
+    try:
+        yield ledger
+    finally:
+        current_token_ledger.reset(reset_token)
+
+
+# Returns the token ledger for the current request - or an unshared ledger if no request scope is active
+def get_token_ledger() -> TokenLedger:
+    ledger = current_token_ledger.get()
+    return ledger if ledger is not None else TokenLedger()
+
+
+# Returns the loaded tokenizer encoding for a specific model
+def encoding_for_model(model=OpenAIDefaults.boost_default_gpt_model):
+    load_encodings()
+
+    encoding_name = encoding_name_for_model(model)
+    if encoding_name == OpenAIDefaults.encoding_gpt3:
+        encoding = original_encoding
+    elif encoding_name == OpenAIDefaults.encoding_codex:
+        encoding = code_encoding
+    else:
+        encoding = text_encoding
+
+    if encoding is None:
+        raise Exception(f"No {encoding_name} encoding available")
+
+    return encoding
+
+
+# per-encoding memo of whether a token id decodes to bytes containing a newline
+newline_token_cache = {}
+
+
+# Returns the sorted token positions immediately after each token that contains a newline - i.e. every position
+#   where a slice of the tokens can end on a line boundary. Each distinct token id is only decoded once per
+#   container, so this is a single pass over the tokens with no per-token decoding
+def newline_token_boundaries(tokens: List[int], model=OpenAIDefaults.boost_default_gpt_model) -> List[int]:
+    encoding = encoding_for_model(model)
+    is_newline_token = newline_token_cache.setdefault(encoding.name, {})
+
+    for token in set(tokens).difference(is_newline_token):
+        is_newline_token[token] = b'\n' in encoding.decode_single_token_bytes(token)
+
+    newline_tokens = {token for token, has_newline in is_newline_token.items() if has_newline}
+
+    return [index + 1 for index, token in enumerate(tokens) if token in newline_tokens]
+
+
+# Returns the end of the token slice [start, end) moved back to the last line boundary inside it
+#   if there is no line boundary inside the slice, the slice is left unchanged (and will split mid-line)
+def chunk_end_at_line_boundary(boundaries: List[int], start: int, end: int) -> int:
+    boundary_index = bisect.bisect_right(boundaries, end) - 1
+    if boundary_index >= 0 and boundaries[boundary_index] > start:
+        return boundaries[boundary_index]
+
+    return end
+
+
 def get_openai_usage_per_string(payload: str, input: bool, model=OpenAIDefaults.boost_default_gpt_model) -> Tuple[int, float]:
     token_count, _ = num_tokens_from_string(payload, model)
 
@@ -271,19 +417,21 @@ def get_boost_cost(payloadLength):
 
 # This doesn't appear to be highly accurate way to measure function token usage
 # it tends to overestimate the cost of functions - by at least 25-50%
-def tokens_from_function(params, model) -> int:
+def tokens_from_function(params, model, ledger: TokenLedger = None) -> int:
     use_aggressive_function_token_measure = True
 
+    count_tokens = ledger.num_tokens_from_string if ledger is not None else num_tokens_from_string
+
     function_content_size = 0
     for key in (['functions'] if use_aggressive_function_token_measure else ['functions', 'function_call']):
         if key in params:
             if not use_aggressive_function_token_measure:
-                function_content_size += num_tokens_from_string(json.dumps(params[key]), model)[0]
+                function_content_size += count_tokens(json.dumps(params[key]), model)[0]
             else:
                 for function in params[key]:
                     # note that the function-related params are stored as dictionaries, unlike other user content
                     for func_param in function['parameters']:
-                        function_content_size += num_tokens_from_string(json.dumps(function['parameters'][func_param]), model)[0]
-                    function_content_size += num_tokens_from_string(json.dumps(function['name']), model)[0]
+                        function_content_size += count_tokens(json.dumps(function['parameters'][func_param]), model)[0]
+                    function_content_size += count_tokens(json.dumps(function['name']), model)[0]
 
     return function_content_size
@@ -0,0 +1,253 @@
+import atexit
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+# Usage records are queued here and reported to Stripe in the background, instead of making a Stripe call at the
+#   end of every request. Each queued record is also appended to a local spool file, so that usage which could not be
+#   reported (e.g. Stripe is down) can be replayed later (see client/replay_usage_spool.py)
+#
+# Spool file (JSON lines):
+#   record   - a single usage record queued by a request
+#   batch    - queued records aggregated per subscription item, with the idempotency key used to report them
+#   reported - a batch that Stripe has accepted
+#
+# Idempotency keys are derived from the record ids in the batch, so a batch replayed after a partial failure can't be
+#   double-billed (Stripe keeps idempotency keys for 24 hours)
+
+useAsyncUsageReporting = False if os.environ.get("useAsyncUsageReporting") == "False" else True
+
+usage_spool_path = os.environ.get('BOOST_USAGE_SPOOL', os.path.join(tempfile.gettempdir(), 'boost_usage_spool.jsonl'))
+
+# how long the background flush waits after the first queued record, so concurrent requests are reported in one batch
+usage_flush_interval = float(os.environ.get('BOOST_USAGE_FLUSH_INTERVAL', 1.0))
+
+# how long the background flush waits before retrying batches that failed to report, when no new usage is queued
+usage_retry_interval = float(os.environ.get('BOOST_USAGE_RETRY_INTERVAL', 60.0))
+
+pending_usage_records = []  # records queued but not yet added to a batch
+pending_usage_batches = {}  # batches not yet reported, keyed by idempotency key
+usage_lock = threading.Condition()
+usage_flush_lock = threading.Lock()  # one flush at a time, so a batch isn't reported by the thread and atexit at once
+usage_flush_thread = None
+
+
+def append_to_spool(entries, spool_path=None):
+    with open(spool_path or usage_spool_path, 'a') as spool:
+        for entry in entries:
+            spool.write(json.dumps(entry) + '\n')
+        spool.flush()
+
+
+# Returns the records not yet in a batch, and the batches not yet reported, from a spool file
+def load_spool(spool_path=None):
+    spool_path = spool_path or usage_spool_path
+    if not os.path.exists(spool_path):
+        return [], {}
+
+    records = {}
+    batches = {}
+    reported = set()
+    with open(spool_path, 'r') as spool:
+        for line in spool:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # a partially written line, e.g. the container was stopped mid-write
+                print(f"USAGE_REPORTING:WARNING: Skipping corrupt spool entry: {line.strip()}")
+                continue
+
+            if entry['type'] == 'record':
+                records[entry['id']] = entry
+            elif entry['type'] == 'batch':
+                batches[entry['idempotency_key']] = entry
+            elif entry['type'] == 'reported':
+                reported.add(entry['idempotency_key'])
+
+    batched_record_ids = set()
+    for batch in batches.values():
+        batched_record_ids.update(batch['records'])
+
+    unbatched_records = [record for record_id, record in records.items() if record_id not in batched_record_ids]
+    unreported_batches = {key: batch for key, batch in batches.items() if key not in reported}
+
+    return unbatched_records, unreported_batches
+
+
+# Aggregate records into one batch per subscription item
+def batch_usage_records(records):
+    records_by_item = {}
+    for record in records:
+        records_by_item.setdefault(record['subscription_item'], []).append(record)
+
+    batches = []
+    for subscription_item, item_records in records_by_item.items():
+        record_ids = sorted(record['id'] for record in item_records)
+        batch_hash = hashlib.sha256(f"{subscription_item}:{','.join(record_ids)}".encode('utf-8')).hexdigest()
+        batches.append({
+            'type': 'batch',
+            'idempotency_key': f"boost-usage-{batch_hash}",
+            'subscription_item': subscription_item,
+            'quantity': sum(record['quantity'] for record in item_records),
+            'timestamp': max(record['timestamp'] for record in item_records),
+            'records': record_ids,
+        })
+
+    return batches
+
+
+def report_usage_batches(batches):
+    from chalicelib.payments import report_usage_record  # payments imports this module
+
+    reported = []
+    for batch in batches:
+        try:
+            report_usage_record(batch['subscription_item'], batch['quantity'], batch['timestamp'], batch['idempotency_key'])
+            reported.append(batch['idempotency_key'])
+        except Exception:
+            exception_info = traceback.format_exc().replace('\n', ' ')
+            print(f"USAGE_REPORTING:FAILED:: subscription_item:{batch['subscription_item']}, quantity:{batch['quantity']}, "
+                  f"records:{len(batch['records'])}, Error:{exception_info}")
+
+    return reported
+
+
+# Report all queued usage (and retry any batches that previously failed)
+#   returns the number of batches reported, and the number of batches that failed and remain queued
+def flush_usage_records():
+    with usage_flush_lock:
+        return flush_usage_records_locked()
+
+
+def flush_usage_records_locked():
+    with usage_lock:
+        new_batches = batch_usage_records(pending_usage_records)
+        pending_usage_records.clear()
+
+        if new_batches:
+            append_to_spool(new_batches)
+        for batch in new_batches:
+            pending_usage_batches[batch['idempotency_key']] = batch
+
+        batches = list(pending_usage_batches.values())
+
+    if not batches:
+        return 0, 0
+
+    start_time = time.monotonic()
+    reported = report_usage_batches(batches)
+
+    with usage_lock:
+        for idempotency_key in reported:
+            pending_usage_batches.pop(idempotency_key, None)
+
+        if not pending_usage_records and not pending_usage_batches:
+            # everything is reported, so start the next spool fresh
+            if os.path.exists(usage_spool_path):
+                os.remove(usage_spool_path)
+        elif reported:
+            append_to_spool([{'type': 'reported', 'idempotency_key': idempotency_key} for idempotency_key in reported])
+
+    print(f"USAGE_REPORTING: Reported {len(reported)} of {len(batches)} usage batches in {time.monotonic() - start_time:.3f} secs")
+
+    return len(reported), len(batches) - len(reported)
+
+
+def usage_flush_loop():
+    while True:
+        with usage_lock:
+            while not pending_usage_records:
+                if not pending_usage_batches:
+                    usage_lock.wait()
+                # batches that failed are retried on their own (e.g. once Stripe is back), but less often
+                elif not usage_lock.wait(usage_retry_interval):
+                    break
+
+        time.sleep(usage_flush_interval)
+
+        try:
+            flush_usage_records()
+        except Exception:
+            exception_info = traceback.format_exc().replace('\n', ' ')
+            print(f"USAGE_REPORTING:FAILED:: Error flushing usage records: {exception_info}")
+
+
+def start_usage_flush_thread_locked():
+    global usage_flush_thread
+
+    if usage_flush_thread is not None:
+        return
+
+    # pick up anything spooled but not reported by a previous process in this container
+    unbatched_records, unreported_batches = load_spool()
+    pending_usage_records.extend(unbatched_records)
+    pending_usage_batches.update(unreported_batches)
+    if unbatched_records or unreported_batches:
+        print(f"USAGE_REPORTING: Recovered {len(unbatched_records)} usage records and {len(unreported_batches)} usage batches from spool")
+
+    usage_flush_thread = threading.Thread(target=usage_flush_loop, name="usage_reporting", daemon=True)
+    usage_flush_thread.start()
+
+    atexit.register(flush_usage_records)
+
+
+# Start reporting usage left in the spool by an earlier invocation (or process) in this container - requests never
+#   report usage themselves, so Stripe latency (or an outage) never holds up a response
+def resume_usage_reporting():
+    if usage_flush_thread is not None or not os.path.exists(usage_spool_path):
+        return
+
+    with usage_lock:
+        start_usage_flush_thread_locked()
+
+
+# Queue a usage record to be reported to Stripe in the background
+def queue_usage_record(subscription_item_id, quantity):
+    record = {
+        'type': 'record',
+        'id': str(uuid.uuid4()),
+        'subscription_item': subscription_item_id,
+        'quantity': quantity,
+        'timestamp': int(time.time()),
+    }
+
+    with usage_lock:
+        start_usage_flush_thread_locked()
+
+        append_to_spool([record])
+        pending_usage_records.append(record)
+
+        usage_lock.notify()
+
+    return record
+
+
+# Report any usage left in a spool file (e.g. after Stripe failures), reusing the spooled idempotency keys
+#   returns the number of batches reported, and the number of batches that failed
+def replay_usage_spool(spool_path, dry_run=False):
+    unbatched_records, unreported_batches = load_spool(spool_path)
+
+    new_batches = batch_usage_records(unbatched_records)
+    if new_batches and not dry_run:
+        append_to_spool(new_batches, spool_path)
+
+    batches = list(unreported_batches.values()) + new_batches
+    for batch in batches:
+        print(f"{'Would report' if dry_run else 'Reporting'} usage: subscription_item:{batch['subscription_item']}, "
+              f"quantity:{batch['quantity']}, records:{len(batch['records'])}, idempotency_key:{batch['idempotency_key']}")
+
+    if dry_run or not batches:
+        return 0, 0
+
+    reported = report_usage_batches(batches)
+    if len(reported) == len(batches):
+        os.remove(spool_path)
+    elif reported:
+        append_to_spool([{'type': 'reported', 'idempotency_key': idempotency_key} for idempotency_key in reported], spool_path)
+
+    return len(reported), len(batches) - len(reported)
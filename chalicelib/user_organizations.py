@@ -3,7 +3,7 @@ import time
 
 from chalicelib.auth import extract_client_version, fetch_orgs, fetch_email_and_username, userorganizations_api_version
 from chalicelib.log import mins_and_secs
-from chalicelib.telemetry import cloudwatch, xray_recorder
+from chalicelib.telemetry import aws_telemetry_enabled, xray_recorder
 from chalicelib.app_utils import common_lambda_logic
 from chalicelib.auth import ExtendedUnauthorizedError
 
@@ -20,7 +20,7 @@ def user_organizations_handler(event, context):
             raise ExtendedUnauthorizedError("Invalid authentication/authorization", reason="InvalidSession")
 
         # Specific logic for user_organizations
-        if cloudwatch is not None:
+        if aws_telemetry_enabled:
             with xray_recorder.capture('get_user_organizations'):
                 orgs = fetch_orgs(json_data["session"])
                 organizations = "NONE FOUND" if orgs is None else f"({','.join(orgs)})"
@@ -0,0 +1,52 @@
+import argparse
+import glob
+import sys
+import os
+
+# Determine the parent directory's path.
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Append the parent directory to sys.path.
+sys.path.append(parent_dir)
+
+
+from chalicelib.prompt_bundle import build_prompt_bundle, PromptBundle, prompt_bundle_name  # noqa
+from chalicelib.storage import s3_storage_bucket_name, SEARCH_STAGES  # noqa
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack all prompt files into one prompt bundle, and optionally upload it to a stage (enable loading it in the service with usePromptBundle=True).")
+    parser.add_argument("--prompts", default=os.path.join(parent_dir, 'chalicelib', 'prompts'), help="Directory of prompt files to bundle. Defaults to chalicelib/prompts")
+    parser.add_argument("--output", default=prompt_bundle_name, help=f"Bundle file to write. Defaults to {prompt_bundle_name}")
+    parser.add_argument("--version", default=None, help="Version stamp for the bundle. Defaults to the build time and content hash")
+    parser.add_argument("--stage", choices=[stage for stage in SEARCH_STAGES if stage != 'local'], help=f"Upload the bundle to this stage in the {s3_storage_bucket_name} bucket")
+
+    args = parser.parse_args()
+
+    prefix = os.path.basename(os.path.normpath(args.prompts))
+
+    files = {}
+    for path in sorted(glob.glob(os.path.join(args.prompts, '*.prompt'))):
+        with open(path, 'rb') as prompt_file:
+            files[f"{prefix}/{os.path.basename(path)}"] = (prompt_file.read(), os.path.getmtime(path))
+
+    if not files:
+        print(f"No prompt files found in {args.prompts}")
+        sys.exit(1)
+
+    bundle = build_prompt_bundle(files, prefix, args.version)
+    with open(args.output, 'wb') as bundle_file:
+        bundle_file.write(bundle)
+
+    version = PromptBundle(bundle).version
+    print(f"Prompt bundle {version}: {len(files)} files, {len(bundle)} bytes written to {args.output}")
+
+    if args.stage:
+        import boto3
+
+        s3_key = f"{args.stage}/{prompt_bundle_name}"
+        boto3.client('s3').upload_file(args.output, s3_storage_bucket_name, s3_key)
+        print(f"Prompt bundle {version} uploaded to {s3_key} in {s3_storage_bucket_name}")
+
+
+if __name__ == "__main__":
+    main()
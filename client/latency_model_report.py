@@ -0,0 +1,68 @@
+import argparse
+import sys
+import os
+
+# Determine the parent directory's path.
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Append the parent directory to sys.path.
+sys.path.append(parent_dir)
+
+
+from chalicelib.openai_latency import LatencyModel, parse_latency_log_line, latency_log_prefix  # noqa
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f"Report how well the learned OpenAI latency model fits the latency samples ({latency_log_prefix} lines) in Boost service logs.")
+    parser.add_argument("logs", nargs="+", help="Log files to read samples from (e.g. exported from CloudWatch).")
+    parser.add_argument("--holdout", type=float, default=0.2, help="Fraction of each model's most recent samples held out to test the fit. Defaults to 0.2")
+    parser.add_argument("--min_samples", type=int, default=10, help="Minimum samples needed to fit a model. Defaults to 10")
+
+    args = parser.parse_args()
+
+    samples_by_model = {}
+    for log_path in args.logs:
+        with open(log_path, 'r') as log_file:
+            for line in log_file:
+                sample = parse_latency_log_line(line)
+                if sample is None:
+                    continue
+                samples_by_model.setdefault(sample['model'], []).append(sample)
+
+    if not samples_by_model:
+        print(f"No {latency_log_prefix} samples found")
+        return
+
+    for model, samples in sorted(samples_by_model.items()):
+        samples.sort(key=lambda sample: sample.get('timestamp', 0))
+        samples = [(sample['input_tokens'], sample['output_tokens'], sample['duration']) for sample in samples]
+
+        # fit on the older samples, and test on the newest - the way the service uses the model
+        holdout_count = int(len(samples) * args.holdout)
+        training_samples = samples[:len(samples) - holdout_count]
+        holdout_samples = samples[len(samples) - holdout_count:]
+
+        latency_model = LatencyModel(max_samples=len(training_samples), min_samples=args.min_samples)
+        for input_tokens, output_tokens, duration in training_samples:
+            latency_model.record(model, input_tokens, output_tokens, duration, log=False)
+
+        coefficients = latency_model.fit(model)
+        if coefficients is None:
+            print(f"{model}: {len(samples)} samples - not enough to fit")
+            continue
+
+        base, input_rate, output_rate = coefficients
+        print(f"{model}: {len(samples)} samples")
+        print(f"    duration = {base:.3f} secs + {input_rate * 1000:.4f} secs per 1000 input tokens + {output_rate * 1000:.4f} secs per 1000 output tokens")
+
+        training_quality = latency_model.fit_quality(model)
+        print(f"    training: {training_quality['samples']} samples, R^2 {training_quality['r_squared']:.3f}, "
+              f"RMSE {training_quality['rmse']:.2f} secs, MAE {training_quality['mae']:.2f} secs")
+
+        if holdout_samples:
+            holdout_quality = latency_model.fit_quality(model, holdout_samples)
+            print(f"    holdout:  {holdout_quality['samples']} samples, R^2 {holdout_quality['r_squared']:.3f}, "
+                  f"RMSE {holdout_quality['rmse']:.2f} secs, MAE {holdout_quality['mae']:.2f} secs")
+
+
+if __name__ == "__main__":
+    main()
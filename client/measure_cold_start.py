@@ -0,0 +1,106 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+# Determine the parent directory's path.
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# each lambda in app.py is declared with its name, and then (for most lambdas) gets its processor by class name from
+#   the registry - lambdas without a processor (e.g. customer_portal) only import app.py
+lambda_pattern = re.compile(r"@app\.lambda_function\(name='([\w-]+)'\)\s*\ndef \w+\(event, \w+\):\s*\n(?:\s*\w+ = get_processor\('(\w+)'\))?")
+lambda_decorator_pattern = re.compile(r"@app\.lambda_function\(")
+
+
+# python -X importtime output: "import time: self [us] | cumulative | imported package"
+importtime_pattern = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+default_budget_ms = int(os.environ.get('BOOST_COLD_START_BUDGET_MS', 3000))
+
+
+def lambda_processors():
+    with open(os.path.join(parent_dir, 'app.py'), 'r') as f:
+        app_source = f.read()
+
+    processors = dict(lambda_pattern.findall(app_source))
+
+    # a lambda declared in a way the pattern doesn't recognize would silently go unmeasured
+    declared = len(lambda_decorator_pattern.findall(app_source))
+    if len(processors) != declared:
+        raise Exception(f"Parsed {len(processors)} lambdas from app.py, but {declared} are declared with @app.lambda_function")
+
+    return processors
+
+
+# imports everything a cold start of this lambda imports: app.py itself, and then the lambda's own processor
+def measure_import_time(processor_name, simulate_lambda):
+    code = "import app"
+    if processor_name:
+        code += f"; from chalicelib.processor_registry import load_processor_class; load_processor_class('{processor_name}')"
+
+    env = os.environ.copy()
+    if simulate_lambda:
+        # enables the X-Ray patching done at import by chalicelib.telemetry
+        env['AWS_LAMBDA_FUNCTION_NAME'] = f"boost-cold-start-{processor_name or 'app'}"
+    else:
+        env.pop('AWS_LAMBDA_FUNCTION_NAME', None)
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=parent_dir, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"Failed to import {processor_name or 'app'}: {result.stderr[-2000:]}")
+
+    modules = []
+    for line in result.stderr.splitlines():
+        match = importtime_pattern.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, module = match.groups()
+        # top-level imports have a single space of indentation
+        modules.append((module, int(self_us), int(cumulative_us), len(indent) == 1))
+
+    total_ms = sum(cumulative_us for _, _, cumulative_us, top_level in modules if top_level) / 1000
+    return total_ms, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of a cold start for each Boost lambda, and fail if any lambda exceeds the budget.")
+    parser.add_argument("--endpoint", action="append", help="Lambda name to measure (may be repeated). Defaults to all lambdas in app.py.")
+    parser.add_argument("--budget_ms", type=int, default=default_budget_ms, help="Maximum import time per lambda in milliseconds (default from BOOST_COLD_START_BUDGET_MS, or 3000).")
+    parser.add_argument("--runs", type=int, default=3, help="Number of runs per lambda - the fastest run is reported, to discount bytecode compilation and disk caching.")
+    parser.add_argument("--top", type=int, default=0, help="Print the N slowest modules (by self time) for each lambda.")
+    parser.add_argument("--lambda_env", action="store_true", help="Simulate the AWS Lambda environment (enables X-Ray patching at import).")
+
+    args = parser.parse_args()
+
+    processors = lambda_processors()
+    endpoints = args.endpoint if args.endpoint else sorted(processors.keys())
+
+    over_budget = []
+    for endpoint in endpoints:
+        if endpoint not in processors:
+            print(f"Unknown lambda: {endpoint}")
+            sys.exit(2)
+
+        runs = [measure_import_time(processors[endpoint], args.lambda_env) for _ in range(max(args.runs, 1))]
+        total_ms, modules = min(runs, key=lambda run: run[0])
+
+        status = "OK" if total_ms <= args.budget_ms else "OVER BUDGET"
+        print(f"{endpoint:<20} {processors[endpoint] or '-':<35} {total_ms:8.1f} ms  {status}")
+
+        for module, self_us, _, _ in sorted(modules, key=lambda m: m[1], reverse=True)[:args.top]:
+            print(f"    {module:<60} {self_us / 1000:8.1f} ms")
+
+        if total_ms > args.budget_ms:
+            over_budget.append(endpoint)
+
+    if over_budget:
+        print(f"{len(over_budget)} lambda(s) exceeded the cold start import budget of {args.budget_ms} ms: {', '.join(over_budget)}")
+        sys.exit(1)
+
+    print(f"All {len(endpoints)} lambda(s) within the cold start import budget of {args.budget_ms} ms")
+
+
+if __name__ == "__main__":
+    main()
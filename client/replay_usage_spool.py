@@ -0,0 +1,38 @@
+import argparse
+import sys
+import os
+
+# Determine the parent directory's path.
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Append the parent directory to sys.path.
+sys.path.append(parent_dir)
+
+
+from chalicelib.usage_reporting import replay_usage_spool, usage_spool_path  # noqa
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay Boost usage records from a usage spool file that failed to be reported to Stripe.")
+    parser.add_argument("spool", nargs="?", default=usage_spool_path, help=f"The usage spool file to replay. Defaults to {usage_spool_path}")
+    parser.add_argument("--dry_run", action="store_true", help="Print the usage that would be reported, without reporting it.")
+    parser.add_argument("--stage", default="dev", help="The Stripe account to report to: dev or prod.")
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.spool):
+        print(f"Usage spool '{args.spool}' does not exist - nothing to replay")
+        return
+
+    # the Stripe key is chosen by service stage
+    os.environ['CHALICE_STAGE'] = args.stage
+
+    reported, failed = replay_usage_spool(args.spool, args.dry_run)
+    if not args.dry_run:
+        print(f"Reported {reported} usage batches, {failed} failed")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from chalicelib import payments
+from chalicelib.payments import check_valid_subscriber, update_usage_for_text, invalidate_account_status
+from chalicelib.auth import clean_account
+
+email = 'test@polyverse.com'
+org = 'polyverse-appsec'
+
+
+def account_status(signed, customer, deep=False):
+    return {'enabled': True, 'status': 'trial', 'usage_this_month': 1.00, 'org': org, 'deep': deep}
+
+
+@pytest.fixture(autouse=True)
+def stripe_calls():
+    payments.account_status_cache.clear()
+    with patch('chalicelib.payments.check_create_customer', return_value=MagicMock()) as mock_customer, \
+            patch('chalicelib.payments.check_create_subscription', side_effect=lambda signed, customer, email: None if signed else MagicMock()), \
+            patch('chalicelib.payments.check_create_subscription_item', return_value=MagicMock()), \
+            patch('chalicelib.payments.check_customer_account_status', side_effect=account_status) as mock_status:
+        yield mock_customer, mock_status
+
+
+def test_account_status_cached_for_repeat_calls(stripe_calls):
+    mock_customer, mock_status = stripe_calls
+
+    for _ in range(5):
+        account = check_valid_subscriber(False, email, org, 'test')
+        assert account['enabled']
+
+        # callers get their own copy of the account
+        account['operation_cost'] = 1.0
+
+    assert mock_customer.call_count == 1
+    assert mock_status.call_count == 1
+    assert 'operation_cost' not in check_valid_subscriber(False, email, org, 'test')
+
+    # signed users are cached separately
+    check_valid_subscriber(True, email, org, 'test')
+    assert mock_status.call_count == 2
+
+
+def test_deep_check_bypasses_and_refreshes_cache(stripe_calls):
+    _, mock_status = stripe_calls
+
+    check_valid_subscriber(False, email, org, 'test')
+    account = check_valid_subscriber(False, email, org, 'test', deep=True)
+    assert account['deep']
+    assert mock_status.call_count == 2
+
+    assert check_valid_subscriber(False, email, org, 'test')['deep']
+    assert mock_status.call_count == 2
+
+
+def test_disabled_account_not_cached(stripe_calls):
+    _, mock_status = stripe_calls
+    mock_status.side_effect = None
+    mock_status.return_value = {'enabled': False, 'status': 'suspended'}
+
+    check_valid_subscriber(False, email, org, 'test')
+    check_valid_subscriber(False, email, org, 'test')
+    assert mock_status.call_count == 2
+
+
+def test_usage_invalidates_unpaid_account(stripe_calls):
+    _, mock_status = stripe_calls
+
+    account = check_valid_subscriber(False, email, org, 'test')
+    with patch('chalicelib.payments.update_usage', return_value=0.01):
+        update_usage_for_text(account, 2048, 'test')
+
+    check_valid_subscriber(False, email, org, 'test')
+    assert mock_status.call_count == 2
+
+    invalidate_account_status(email, org)
+    check_valid_subscriber(False, email, org, 'test')
+    assert mock_status.call_count == 3
+
+
+def test_response_account_does_not_need_a_deep_check():
+    cached = {'enabled': True, 'status': 'paid', 'usage_this_month': 1.00, 'org': org, 'email': email, 'users': []}
+    deep = dict(cached, users=[email, 'other@polyverse.com'], balance_paid=20.00, operation_cost=0.25)
+    cached['operation_cost'] = 0.25
+
+    # the fields only a deep check computes are never returned with an analysis
+    assert clean_account(cached) == clean_account(deep)
+    assert set(clean_account(cached)) == {'enabled', 'status', 'operation_cost', 'operation_expense', 'org', 'email'}
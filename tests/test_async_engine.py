@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import openai
+import pytest
+
+from chalicelib.processors.GenericProcessor import GenericProcessor
+
+account = {'customer': {'name': 'polyverse-appsec', 'id': 'cus_test'}, 'email': 'test@polyverse.com'}
+
+
+def make_processor(timeouts):
+    # skip prompt loading - the engine only needs the call timeout settings
+    processor = GenericProcessor.__new__(GenericProcessor)
+    processor.get_call_timeout_settings = lambda data: timeouts
+    return processor
+
+
+def fake_acreate(delay, max_threads):
+    async def acreate(**params):
+        max_threads[0] = max(max_threads[0], threading.active_count())
+        await asyncio.sleep(delay)
+        message = SimpleNamespace(content=params['messages'][0]['content'])
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason='stop')],
+                               usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5))
+    return acreate
+
+
+def prompt_set(chunks):
+    return [([{'role': 'user', 'content': f"chunk {i}"}], 100, 200, 0) for i in range(chunks)]
+
+
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+@patch('chalicelib.usage.OpenAIDefaults.rate_limit_tokens_per_minute', 1000000)
+def test_hundreds_of_chunks_without_threads(_):
+    max_threads = [0]
+    processor = make_processor((60, 120, 180))
+    threads_before = threading.active_count()
+
+    with patch('openai.ChatCompletion.acreate', side_effect=fake_acreate(0.05, max_threads)):
+        start = time.monotonic()
+        results = asyncio.run(processor.runAnalysisForPromptsAsync(prompt_set(300), None, {'model': 'gpt-4'},
+                                                                   account, 'test', 'correlation-1', print))
+        elapsed = time.monotonic() - start
+
+    assert [result['response'] for result in results] == [f"chunk {i}" for i in range(300)]
+    assert max_threads[0] <= threads_before + 1
+    # chunks wait on the throttler and the (fake) OpenAI call concurrently
+    assert elapsed < 5
+
+
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+def test_chunks_cancelled_at_deadline(_):
+    # single call, all calls and service timeouts
+    processor = make_processor((5, 0.2, 5))
+
+    with patch('openai.ChatCompletion.acreate', side_effect=fake_acreate(2, [0])):
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            asyncio.run(processor.runAnalysisForPromptsAsync(prompt_set(10), None, {'model': 'gpt-4'},
+                                                             account, 'test', 'correlation-1', print))
+
+    assert time.monotonic() - start < 1
+
+
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+@patch('chalicelib.processors.GenericProcessor.capture_metric')
+def test_threaded_and_async_analysis_share_the_retry_policy(capture_metric, _):
+    processor = make_processor((60, 120, 180))
+    response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='analysis'), finish_reason='stop')],
+                               usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5))
+    errors = [openai.error.RateLimitError("Rate limit reached"), openai.error.APIError("server error")]
+    params = {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': 'chunk'}]}
+
+    def create(**kwargs):
+        if len(calls) < len(errors):
+            calls.append(kwargs)
+            raise errors[len(calls) - 1]
+        calls.append(kwargs)
+        return response
+
+    async def acreate(**kwargs):
+        return create(**kwargs)
+
+    async def no_wait(seconds):
+        waits.append(seconds)
+
+    with patch.object(GenericProcessor, 'get_rate_limit_retry_wait', return_value=7):
+        calls, waits = [], []
+        with patch('openai.ChatCompletion.create', side_effect=create), patch('time.sleep', side_effect=waits.append):
+            threaded = processor.runAnalysis(params, account, 'test', 'correlation-1')
+        threaded_waits = waits
+
+        calls, waits = [], []
+        with patch('openai.ChatCompletion.acreate', side_effect=acreate), patch('asyncio.sleep', side_effect=no_wait):
+            asynchronous = asyncio.run(processor.runAnalysisAsync(params, account, 'test', 'correlation-1', 'Task-1'))
+        async_waits = waits
+
+    assert threaded == asynchronous
+    assert threaded['response'] == 'analysis' and threaded['output_tokens'] == 5
+
+    # the rate limit wait, then a short retry wait after each error
+    for recorded in (threaded_waits, async_waits):
+        assert len(recorded) == 3
+        assert recorded[0] == 7
+        assert all(2 <= wait <= 5 for wait in recorded[1:])
+
+    assert capture_metric.call_count == 2
+
+
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+def test_unexpected_errors_are_not_retried(_):
+    processor = make_processor((60, 120, 180))
+    params = {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': 'chunk'}]}
+
+    with patch('openai.ChatCompletion.acreate', side_effect=ValueError("bad request")) as acreate:
+        with pytest.raises(ValueError):
+            asyncio.run(processor.runAnalysisAsync(params, account, 'test', 'correlation-1', 'Task-1'))
+
+    assert acreate.call_count == 1
+
+
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+@patch('chalicelib.processors.GenericProcessor.capture_metric')
+def test_reported_rate_limit_wait_is_not_extended(capture_metric, _):
+    processor = make_processor((60, 120, 180))
+    response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='analysis'), finish_reason='stop')],
+                               usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5))
+    params = {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': 'chunk'}]}
+    errors = [openai.error.RateLimitError("Rate limit reached", headers={'retry-after-ms': '1500'})]
+
+    def create(**kwargs):
+        if errors:
+            raise errors.pop()
+        return response
+
+    waits = []
+    with patch('openai.ChatCompletion.create', side_effect=create), patch('time.sleep', side_effect=waits.append):
+        result = processor.runAnalysis(params, account, 'test', 'correlation-1')
+
+    # only the reported wait (plus its jitter) - no retry backoff on top
+    assert result['response'] == 'analysis'
+    assert len(waits) == 1 and 1.5 <= waits[0] <= 2.5
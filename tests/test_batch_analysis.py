@@ -0,0 +1,163 @@
+import json
+import time
+from unittest.mock import patch
+
+from chalicelib.batch_analysis import current_batch_pack, file_header, pack_files, split_findings
+from chalicelib.processors.BugFunctionGenericProcessor import BugFunctionGenericProcessor
+from chalicelib.processors.FunctionGenericProcessor import FunctionGenericProcessor
+from chalicelib.processors.GenericProcessor import GenericProcessor, openai_calls_deadline
+
+account = {'customer': {'name': 'polyverse-appsec', 'id': 'cus_test'}, 'email': 'test@polyverse.com'}
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def code(name, lines):
+    return '\n'.join(f"{name} {i}" for i in range(lines))
+
+
+def test_small_files_share_packs():
+    files = [('a.py', code('a', 10), 1), ('b.py', code('b', 40), 1), ('c.py', code('c', 20), 1), ('d.py', code('d', 5), 1)]
+
+    # each line is two words, and each header four
+    packs = pack_files(files, count_words, 100)
+
+    assert [[packed_file.name for packed_file in pack.files] for pack in packs] == [['b.py', 'd.py'], ['a.py', 'c.py']]
+
+    pack = packs[1]
+    lines = pack.code.splitlines()
+    assert lines[0] == file_header('a.py')
+    for packed_file in pack.files:
+        assert lines[packed_file.start - 1] == file_header(packed_file.name)
+        assert lines[packed_file.start:packed_file.end] == dict((name, body) for name, body, _ in files)[packed_file.name].splitlines()
+
+
+def test_findings_are_split_back_to_their_files():
+    files = [('a.py', code('a', 10), 1), ('c.py', code('c', 20), 101)]
+    pack = pack_files(files, count_words, 1000)[0]
+
+    # a.py is on pack lines 2-11 and c.py on 13-32 (counting from 1)
+    findings = [{'lineNumber': 2, 'description': 'a 0'},
+                {'lineNumber': 11, 'description': 'a 9'},
+                {'lineNumber': 12, 'description': 'c header'},
+                {'lineNumber': 15, 'description': 'c 2'},
+                {'lineNumber': 99, 'description': 'past the end'}]
+
+    assert split_findings(findings, pack) == {
+        0: [{'lineNumber': 1, 'description': 'a 0'}, {'lineNumber': 10, 'description': 'a 9'}],
+        1: [{'lineNumber': 101, 'description': 'c header'}, {'lineNumber': 103, 'description': 'c 2'}],
+    }
+
+
+@patch('chalicelib.processors.BugFunctionGenericProcessor.batch_pack_max_tokens', 100)
+@patch('chalicelib.processors.BugFunctionGenericProcessor.token_ledger_scope')
+def test_batch_reports_findings_per_file(token_ledger_scope):
+    token_ledger_scope.return_value.__enter__.return_value.num_tokens_from_string = lambda text, model: (count_words(text), [])
+
+    processor = BugFunctionGenericProcessor.__new__(BugFunctionGenericProcessor)
+    analyzed = []
+
+    # reports a bug on every line ending in 3
+    def analyze(self, data, account, function_name, correlation_id):
+        analyzed.append(data['code'])
+        lineNumberBase = json.loads(data['inputMetadata'])['lineNumberBase']
+        return {'status': 'bugsfound', 'details': [{'lineNumber': lineNumberBase + i, 'description': line}
+                                                   for i, line in enumerate(data['code'].splitlines()) if line.endswith(' 3')]}
+
+    # files without a lineNumberBase are numbered from 1
+    files = [{'name': 'a.py', 'code': code('a', 10)},
+             {'name': 'b.py', 'code': code('b', 40), 'inputMetadata': json.dumps({'lineNumberBase': 50})},
+             {'name': 'c.py', 'code': code('c', 2)}]
+
+    with patch.object(FunctionGenericProcessor, 'process_input_with_function_output', analyze):
+        response = processor.process_batch_input({'files': files}, account, 'test', 'correlation-1')
+
+    assert len(analyzed) == 2
+    assert response['files'] == [
+        {'name': 'a.py', 'status': 'bugsfound', 'details': [{'lineNumber': 4, 'description': 'a 3'}]},
+        {'name': 'b.py', 'status': 'bugsfound', 'details': [{'lineNumber': 53, 'description': 'b 3'}]},
+        {'name': 'c.py', 'status': 'nobugsfound', 'details': []},
+    ]
+
+
+billing_metrics = GenericProcessor.BillingMetrics(user_input_size=400, output_size=200, user_messages_size=1000,
+                                                  openai_input_cost=0, openai_output_cost=0, boost_cost=0,
+                                                  openai_input_tokens=0, openai_customerinput_tokens=0,
+                                                  openai_output_tokens=0, openai_tokens=0)
+
+
+def test_batch_is_billed_per_file():
+    processor = BugFunctionGenericProcessor.__new__(BugFunctionGenericProcessor)
+    pack = pack_files([('a.py', 'x' * 300, 1), ('b.py', 'x' * 100, 1)], len, 10000)[0]
+
+    with patch('chalicelib.processors.BugFunctionGenericProcessor.update_usage', return_value=0.5) as update_usage, \
+            patch('chalicelib.processors.BugFunctionGenericProcessor.notify_account_usage') as notify_account_usage:
+        reset_token = current_batch_pack.set(pack)
+        try:
+            billed_cost = processor.report_usage_cost(dict(account, subscription_item='si_test'), 'test', True, billing_metrics)
+        finally:
+            current_batch_pack.reset(reset_token)
+
+    assert [call.args[1] for call in update_usage.call_args_list] == [900, 300]
+    assert billed_cost == 1.0
+    notify_account_usage.assert_not_called()
+
+
+@patch('chalicelib.processors.BugFunctionGenericProcessor.batch_pack_max_tokens', 100)
+@patch('chalicelib.processors.BugFunctionGenericProcessor.token_ledger_scope')
+@patch('chalicelib.processors.BugFunctionGenericProcessor.update_usage', return_value=0.5)
+@patch('chalicelib.payments.invalidate_account_status')
+@patch('chalicelib.payments.notify_customer_first_usage')
+def test_new_account_is_notified_once_per_batch(notify_customer_first_usage, invalidate_account_status, update_usage,
+                                                 token_ledger_scope):
+    token_ledger_scope.return_value.__enter__.return_value.num_tokens_from_string = lambda text, model: (count_words(text), [])
+
+    processor = BugFunctionGenericProcessor.__new__(BugFunctionGenericProcessor)
+
+    # each pack is billed as process_input bills it
+    def analyze(self, data, account, function_name, correlation_id):
+        processor.report_usage_cost(account, function_name, True, billing_metrics)
+        return {'status': 'nobugsfound', 'details': []}
+
+    new_account = dict(account, subscription_item='si_test', usage_this_month=0.0, status='trial', org='polyverse-appsec',
+                       organization='polyverse-appsec')
+    files = [{'name': f"{index}.py", 'code': code(str(index), 30)} for index in range(6)]
+
+    with patch.object(FunctionGenericProcessor, 'process_input_with_function_output', analyze):
+        processor.process_batch_input({'files': files}, new_account, 'test', 'correlation-1')
+
+    assert update_usage.call_count == 6
+    notify_customer_first_usage.assert_called_once_with('test@polyverse.com', 'polyverse-appsec', 'test')
+    invalidate_account_status.assert_called_once_with('test@polyverse.com', 'polyverse-appsec')
+
+
+@patch('chalicelib.processors.BugFunctionGenericProcessor.batch_pack_max_tokens', 100)
+@patch('chalicelib.processors.BugFunctionGenericProcessor.batch_max_concurrent_packs', 1)
+@patch('chalicelib.processors.BugFunctionGenericProcessor.token_ledger_scope')
+def test_packs_share_the_batch_deadline(token_ledger_scope):
+    token_ledger_scope.return_value.__enter__.return_value.num_tokens_from_string = lambda text, model: (count_words(text), [])
+
+    processor = BugFunctionGenericProcessor.__new__(BugFunctionGenericProcessor)
+    processor.get_call_timeout_settings = lambda data: (60, 0.2, 180)
+    time_for_calls = []
+
+    # the first pack uses up the batch's time for OpenAI calls
+    def analyze(self, data, account, function_name, correlation_id):
+        time_for_calls.append(processor.get_remaining_call_timeout_settings(data)[1])
+        time.sleep(0.3)
+        return {'status': 'nobugsfound', 'details': []}
+
+    files = [{'name': f"{index}.py", 'code': code(str(index), 30)} for index in range(3)]
+
+    with patch.object(FunctionGenericProcessor, 'process_input_with_function_output', analyze):
+        response = processor.process_batch_input({'files': files}, account, 'test', 'correlation-1')
+
+    # a pack's own process_input gets no more than the batch has left
+    assert len(time_for_calls) == 1 and time_for_calls[0] <= 0.2
+
+    # the packs that couldn't start in time are reported, rather than taking the batch past its deadline
+    assert sorted(file['status'] for file in response['files']) == ['error', 'error', 'nobugsfound']
+    assert all('ran out of time' in file['error'] for file in response['files'] if file['status'] == 'error')
+    assert openai_calls_deadline.get() is None
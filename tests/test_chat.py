@@ -1,7 +1,7 @@
 from chalice.test import Client
 import app as app_module
-from app import ChatProcessor
 import chalicelib.storage
+import chalicelib.processor_registry
 
 import json
 import os
@@ -133,7 +133,8 @@ def test_chat_with_s3_doc_boost_ignore():
         os.environ['CHALICE_STAGE'] = 'dev'
         try:
             chalicelib.storage.file_contents_cache = {}
-            app_module.chatProcessor = ChatProcessor()
+            # the chat lambda constructs a new processor, loading its prompts from the dev stage
+            chalicelib.processor_registry.processor_instances.pop('ChatProcessor', None)
 
             response = client.lambda_.invoke(
                 'chat', request_body)
@@ -0,0 +1,111 @@
+import time
+
+from . import test_utils  # noqa pylint: disable=unused-import
+
+from chalicelib.usage import (
+    OpenAIDefaults,
+    num_tokens_from_string,
+    decode_string_from_input,
+    newline_token_boundaries,
+    chunk_end_at_line_boundary
+)
+
+model = OpenAIDefaults.boost_default_gpt_model
+
+# typical chunk size for a gpt-4 list input after prompt overhead is removed
+chunk_size = 3000
+
+
+def build_file_list(target_size, line_length=None):
+    lines = []
+    size = 0
+    i = 0
+    while size < target_size:
+        line = f"src/packages/module_{i % 97}/components/widget_{i}/index_{i}.tsx" if line_length is None \
+            else ' '.join([f"word{i}_{j}" for j in range(line_length)])
+        lines.append(line)
+        size += len(line) + 1
+        i += 1
+    return '\n'.join(lines)
+
+
+# the original chunk boundary search - walks backwards one token at a time, decoding each token
+#   (the original also stepped one token past a boundary token ending in a newline; that quirk is omitted here)
+def legacy_chunk_ends(tokens):
+    ends = []
+    i = 0
+    while i < len(tokens):
+        end_idx = min(i + chunk_size, len(tokens))
+        if end_idx != len(tokens):
+            decoded_token = decode_string_from_input([tokens[end_idx - 1]], model)
+            while end_idx > i and '\n' not in decoded_token:
+                end_idx -= 1
+                decoded_token = decode_string_from_input([tokens[end_idx - 1]], model)
+        ends.append(end_idx)
+        i = end_idx if end_idx > i else i + chunk_size
+    return ends
+
+
+def indexed_chunk_ends(tokens):
+    boundaries = newline_token_boundaries(tokens, model)
+    ends = []
+    i = 0
+    while i < len(tokens):
+        end_idx = min(i + chunk_size, len(tokens))
+        if end_idx != len(tokens):
+            end_idx = chunk_end_at_line_boundary(boundaries, i, end_idx)
+        ends.append(end_idx)
+        i = end_idx
+    return ends
+
+
+def run_benchmark(file_list):
+    tokens = num_tokens_from_string(file_list, model)[1]
+
+    start = time.monotonic()
+    legacy_ends = legacy_chunk_ends(tokens)
+    legacy_time = time.monotonic() - start
+
+    start = time.monotonic()
+    indexed_ends = indexed_chunk_ends(tokens)
+    indexed_time = time.monotonic() - start
+
+    print(f"Chunk boundaries for {len(file_list)} bytes ({len(tokens)} tokens, {len(indexed_ends)} chunks): "
+          f"legacy={legacy_time:.3f}s, indexed={indexed_time:.3f}s, speedup={legacy_time / max(indexed_time, 1e-6):.1f}x")
+
+    return tokens, legacy_ends, indexed_ends
+
+
+def check_chunks_end_on_newlines(tokens, ends):
+    start = 0
+    for end in ends:
+        assert end > start
+        if end != len(tokens):
+            assert '\n' in decode_string_from_input([tokens[end - 1]], model)
+        start = end
+
+    assert ends[-1] == len(tokens)
+
+
+def test_chunk_boundaries_1mb_file_list():
+    tokens, legacy_ends, indexed_ends = run_benchmark(build_file_list(1024 * 1024))
+
+    check_chunks_end_on_newlines(tokens, indexed_ends)
+
+    # both approaches pick the same line boundaries
+    assert legacy_ends == indexed_ends
+
+
+def test_chunk_boundaries_1mb_long_lines():
+    # long lines force the legacy search to walk back hundreds of tokens per chunk
+    tokens, _, indexed_ends = run_benchmark(build_file_list(1024 * 1024, line_length=300))
+
+    check_chunks_end_on_newlines(tokens, indexed_ends)
+
+
+def test_chunk_boundary_without_newline_splits_mid_line():
+    boundaries = [10, 20]
+
+    assert chunk_end_at_line_boundary(boundaries, 0, 15) == 10
+    assert chunk_end_at_line_boundary(boundaries, 0, 20) == 20
+    assert chunk_end_at_line_boundary(boundaries, 20, 35) == 35
@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from chalicelib.chunk_scheduler import ChunkScheduler, plan_chunk_schedule, simulate_chunk_schedule
+from chalicelib.openai_latency import LatencyModel
+from chalicelib.processors.GenericProcessor import GenericProcessor
+
+account = {'customer': {'name': 'polyverse-appsec', 'id': 'cus_test'}, 'email': 'test@polyverse.com'}
+
+# a rate limit high enough that it never delays a chunk
+unlimited_tokens_per_minute = 100000000
+
+
+def test_longest_chunks_start_first():
+    schedule = plan_chunk_schedule([10, 50, 30, 20], [100] * 4, 600, unlimited_tokens_per_minute)
+
+    assert schedule.order == [1, 2, 3, 0]
+    assert not schedule.skipped
+
+
+def test_fewest_workers_that_meet_the_deadline():
+    # 4 chunks of 40 secs with a 100 sec deadline - 2 workers finish in 80 secs, 1 worker would take 160
+    schedule = plan_chunk_schedule([40, 40, 40, 40], [100] * 4, 100, unlimited_tokens_per_minute)
+
+    assert schedule.concurrency == 2
+    assert max(schedule.predicted_finish.values()) == 80
+
+
+def test_chunks_that_cannot_finish_are_skipped():
+    # a chunk longer than the deadline can never finish - the rest still can
+    schedule = plan_chunk_schedule([700, 60, 60], [100] * 3, 600, unlimited_tokens_per_minute)
+
+    assert schedule.skipped == {0}
+    assert schedule.order == [1, 2, 0]
+
+
+def test_rate_limit_delays_chunks():
+    # 6000 tokens per minute = 100 tokens per second, and the bucket starts with a minute of tokens
+    predicted_finish = simulate_chunk_schedule([0, 1], [10, 10], {0: 6000, 1: 3000}, 2, 6000)
+
+    assert predicted_finish == {0: 10, 1: 40}
+
+    # the second chunk can't get its tokens in time, so it's skipped rather than started
+    schedule = plan_chunk_schedule([10, 10], [6000, 3000], 30, 6000)
+    assert schedule.skipped == {1}
+
+
+def test_without_latency_estimates_nothing_is_skipped():
+    scheduler = ChunkScheduler([(100, 500), (2000, 500), (50, 10)], 1, unlimited_tokens_per_minute, LatencyModel(), 'gpt-4')
+
+    assert scheduler.schedule.order == [1, 0, 2]
+    # nor is the engine's usual concurrency (the thread pool's default) changed
+    assert scheduler.schedule.concurrency is None
+    assert all(scheduler.can_start(index) for index in range(3))
+
+
+def make_latency_model():
+    # every call takes 1 sec + 10 secs per 1000 output tokens
+    latency_model = LatencyModel()
+    for output_tokens in range(100, 1100, 100):
+        latency_model.record('gpt-4', 200, output_tokens, 1 + output_tokens / 100, log=False)
+    return latency_model
+
+
+def test_chunk_cannot_start_once_too_late():
+    now = [1000.0]
+    scheduler = ChunkScheduler([(200, 100)], 30, unlimited_tokens_per_minute, make_latency_model(), 'gpt-4',
+                               clock=lambda: now[0])
+
+    # ~2 secs, or 3 secs with the safety margin
+    assert scheduler.can_start(0)
+    now[0] += 26
+    assert scheduler.can_start(0)
+    now[0] += 2
+    assert not scheduler.can_start(0)
+
+
+@patch('chalicelib.processors.GenericProcessor.capture_metric')
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+def test_async_engine_skips_chunks_and_keeps_input_order(_, capture_metric):
+    processor = GenericProcessor.__new__(GenericProcessor)
+    processor.get_call_timeout_settings = lambda data: (60, 20, 60)
+
+    called = []
+
+    async def acreate(**params):
+        called.append(params['messages'][0]['content'])
+        message = SimpleNamespace(content=params['messages'][0]['content'])
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason='stop')],
+                               usage=SimpleNamespace(prompt_tokens=200, completion_tokens=10))
+
+    # chunk 1 is expected to take ~30 secs (x1.5) - longer than the 20 sec deadline
+    prompt_set = [([{'role': 'user', 'content': 'chunk 0'}], 100, 200, 0),
+                  ([{'role': 'user', 'content': 'chunk 1'}], 2000, 200, 0),
+                  ([{'role': 'user', 'content': 'chunk 2'}], 500, 200, 0)]
+
+    with patch('chalicelib.processors.GenericProcessor.openai_latency_model', make_latency_model()), \
+            patch('openai.ChatCompletion.acreate', side_effect=acreate):
+        results = asyncio.run(processor.runAnalysisForPromptsAsync(prompt_set, None, {'model': 'gpt-4'}, account,
+                                                                   'test', 'correlation-1', print, schedule_chunks=True))
+
+    # the longer chunk starts first, and the skipped chunk never calls OpenAI
+    assert called == ['chunk 2', 'chunk 0']
+
+    assert [result['response'] for result in results] == ['chunk 0', '', 'chunk 2']
+    assert results[1]['skipped'] and results[1]['finish'] is None and results[1]['input_tokens'] == 0
+    capture_metric.assert_called_once()
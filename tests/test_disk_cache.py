@@ -0,0 +1,135 @@
+import datetime
+import io
+import os
+from types import SimpleNamespace
+
+import pytest
+from botocore.exceptions import ClientError
+
+import chalicelib.disk_cache
+import chalicelib.storage
+from chalicelib.disk_cache import DiskCache, disk_cache_stats
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+    def put(self, key, body, etag):
+        self.objects[key] = (body, etag)
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.calls.append(('get', Key, IfNoneMatch))
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        body, etag = self.objects[Key]
+        if IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        return {'Body': io.BytesIO(body), 'ETag': etag,
+                'LastModified': datetime.datetime.fromtimestamp(1000.0)}
+
+    def get_paginator(self, operation):
+        def paginate(Bucket, Prefix, **kwargs):
+            self.calls.append(('list', Prefix, None))
+            return [{'Contents': [{'Key': key} for key in sorted(self.objects) if key.startswith(Prefix)]}]
+        return SimpleNamespace(paginate=paginate)
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setenv('CHALICE_STAGE', 'prod')
+    monkeypatch.setattr(chalicelib.disk_cache, 'disk_cache', DiskCache(str(tmp_path)))
+    monkeypatch.setattr(chalicelib.storage, 's3_client', s3)
+    monkeypatch.setattr(chalicelib.storage, 's3_metadata_cache', {})
+    monkeypatch.setattr(chalicelib.storage, 'file_contents_cache', {})
+    monkeypatch.setattr(chalicelib.storage, 'storage_indexes', {})
+    disk_cache_stats.take()
+    return s3
+
+
+# a new interpreter process in the same sandbox starts with empty in-memory caches
+def new_process(monkeypatch):
+    monkeypatch.setattr(chalicelib.storage, 's3_metadata_cache', {})
+    monkeypatch.setattr(chalicelib.storage, 'file_contents_cache', {})
+    monkeypatch.setattr(chalicelib.storage, 'storage_indexes', {})
+
+
+def test_contents_are_checked_against_their_hash(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.put('a', b'contents', {'time': 1})
+    assert cache.get('a') == (b'contents', {'time': 1})
+
+    entry = cache.get_entry('a')
+    with open(cache.blob_path(entry['hash']), 'wb') as blob_file:
+        blob_file.write(b'corrupt')
+
+    assert cache.get('a') is None
+    assert cache.get_entry('a') is None
+
+
+def test_new_process_loads_prompts_from_disk(storage, monkeypatch):
+    storage.put('prod/prompts/a.prompt', b'prompt', '"1"')
+
+    assert chalicelib.storage.get_file('prompts/a.prompt') == 'prompt'
+    assert disk_cache_stats.take() == {'hits': 0, 'remote_fetches': 1}
+
+    # within the TTL, the disk copy is used with no S3 call
+    new_process(monkeypatch)
+    storage.calls.clear()
+    assert chalicelib.storage.get_file('prompts/a.prompt') == 'prompt'
+    assert chalicelib.storage.get_file_time('prompts/a.prompt') == 1000.0
+    assert storage.calls == []
+    assert disk_cache_stats.take() == {'hits': 1, 'remote_fetches': 0}
+
+    # after it, the disk copy is revalidated instead of downloaded
+    new_process(monkeypatch)
+    monkeypatch.setattr(chalicelib.storage, 's3_metadata_ttl', 0)
+    assert chalicelib.storage.get_file('prompts/a.prompt') == 'prompt'
+    assert storage.calls == [('get', 'prod/prompts/a.prompt', '"1"')]
+    assert disk_cache_stats.take() == {'hits': 1, 'remote_fetches': 0}
+
+    # and a changed file is downloaded again
+    new_process(monkeypatch)
+    storage.put('prod/prompts/a.prompt', b'changed', '"2"')
+    assert chalicelib.storage.get_file('prompts/a.prompt') == 'changed'
+    assert disk_cache_stats.take() == {'hits': 0, 'remote_fetches': 1}
+
+
+def test_new_process_loads_listings_from_disk(storage, monkeypatch):
+    storage.put('prod/prompts/guidelines-user-1.prompt', b'one', '"1"')
+    storage.put('prod/prompts/main.prompt', b'main', '"1"')
+
+    assert chalicelib.storage.search_storage('prompts', 'guidelines-user-*.prompt') == ['prompts/guidelines-user-1.prompt']
+
+    new_process(monkeypatch)
+    storage.calls.clear()
+    assert chalicelib.storage.search_storage('prompts', '*.prompt') == ['prompts/guidelines-user-1.prompt', 'prompts/main.prompt']
+    assert storage.calls == []
+    assert disk_cache_stats.take() == {'hits': 1, 'remote_fetches': 1}
+
+
+def test_tokenizer_files_are_checked_against_their_hash(tmp_path, monkeypatch):
+    # prepare_tiktoken_cache sets TIKTOKEN_CACHE_DIR - set it here first, so the test's value is undone afterwards
+    monkeypatch.setenv('TIKTOKEN_CACHE_DIR', '')
+    monkeypatch.delenv('TIKTOKEN_CACHE_DIR')
+    cache = DiskCache(str(tmp_path))
+
+    assert cache.prepare_tiktoken_cache() == set()
+    assert os.environ['TIKTOKEN_CACHE_DIR'] == cache.tiktoken_directory()
+
+    # tiktoken downloads a file
+    with open(os.path.join(cache.tiktoken_directory(), 'encoding'), 'wb') as f:
+        f.write(b'ranks')
+    assert cache.record_tiktoken_cache(set()) == {'encoding'}
+
+    # a new process finds it
+    assert cache.prepare_tiktoken_cache() == {'encoding'}
+    assert cache.record_tiktoken_cache({'encoding'}) == set()
+
+    # but not if it was corrupted
+    with open(os.path.join(cache.tiktoken_directory(), 'encoding'), 'wb') as f:
+        f.write(b'ranks!')
+    assert cache.prepare_tiktoken_cache() == set()
+    assert not os.path.exists(os.path.join(cache.tiktoken_directory(), 'encoding'))
@@ -0,0 +1,166 @@
+import json
+from unittest.mock import patch
+
+from chalicelib import incremental_analysis
+from chalicelib.incremental_analysis import carry_forward_findings, plan_incremental_analysis
+from chalicelib.processors.BugFunctionGenericProcessor import BugFunctionGenericProcessor
+from chalicelib.processors.FunctionGenericProcessor import FunctionGenericProcessor
+from chalicelib.processors.GenericProcessor import GenericProcessor
+
+account = {'customer': {'name': 'polyverse-appsec', 'id': 'cus_test'}, 'email': 'test@polyverse.com', 'organization': 'polyverse-appsec'}
+other_account = {'customer': {'name': 'other-org', 'id': 'cus_other'}, 'email': 'test@other.com', 'organization': 'other-org'}
+
+old_code = '\n'.join(f"line {i}" for i in range(40))
+
+# two lines inserted after line 19, and line 30 edited
+new_lines = old_code.splitlines()
+new_lines[30] = 'line 30 edited'
+new_lines[20:20] = ['inserted a', 'inserted b']
+new_code = '\n'.join(new_lines)
+
+
+def test_plan_reanalyzes_changed_lines_with_context():
+    plan = plan_incremental_analysis(old_code, new_code, context_lines=2)
+
+    assert plan.hunks == [(18, 24), (30, 35)]
+
+    # unchanged lines after the insertion moved down two lines, and the edited line has no match
+    assert plan.line_map[5] == 5
+    assert plan.line_map[25] == 27
+    assert 30 not in plan.line_map
+
+
+def test_findings_on_unchanged_lines_are_moved():
+    plan = plan_incremental_analysis(old_code, new_code, context_lines=2)
+    findings = [{'lineNumber': 105, 'description': 'before the edits'},
+                {'lineNumber': 119, 'description': 'inside a re-analyzed hunk'},
+                {'lineNumber': 125, 'description': 'after the insertion'},
+                {'lineNumber': 130, 'description': 'on the edited line'}]
+
+    carried = carry_forward_findings(findings, plan, 100, 200)
+
+    assert carried == [{'lineNumber': 205, 'description': 'before the edits'},
+                       {'lineNumber': 227, 'description': 'after the insertion'}]
+
+
+def test_only_changed_hunks_are_reanalyzed(tmp_path, monkeypatch):
+    monkeypatch.setenv('INCREMENTAL_ANALYSIS_STORE', f"local:{tmp_path}")
+    monkeypatch.setattr(incremental_analysis, 'incremental_analysis_store', None)
+
+    processor = BugFunctionGenericProcessor.__new__(BugFunctionGenericProcessor)
+    analyzed = []
+
+    # reports a bug on the first line of whatever code it is given
+    def analyze(self, data, account, function_name, correlation_id):
+        analyzed.append(data['code'])
+        lineNumberBase = json.loads(data['inputMetadata'])['lineNumberBase']
+        return {'status': 'bugsfound', 'details': [{'lineNumber': lineNumberBase, 'description': data['code'].splitlines()[0]}]}
+
+    with patch.object(FunctionGenericProcessor, 'process_input_with_function_output', analyze), \
+            patch('chalicelib.processors.BugFunctionGenericProcessor.plan_incremental_analysis',
+                  side_effect=lambda old, new: plan_incremental_analysis(old, new, context_lines=2)):
+        first = processor.process_input_with_function_output(
+            {'code': old_code, 'inputMetadata': json.dumps({'lineNumberBase': 1})}, account, 'test', 'correlation-1')
+
+        second = processor.process_input_with_function_output(
+            {'code': new_code, 'inputMetadata': json.dumps({'lineNumberBase': 1}), 'previousAnalysisId': first['analysisId']},
+            account, 'test', 'correlation-2')
+
+    assert analyzed == [old_code, '\n'.join(new_lines[18:24]), '\n'.join(new_lines[30:35])]
+    assert second['details'] == [{'lineNumber': 1, 'description': 'line 0'},
+                                 {'lineNumber': 19, 'description': 'line 18'},
+                                 {'lineNumber': 31, 'description': 'line 28'}]
+    assert second['status'] == 'bugsfound'
+    assert second['analysisId'] != first['analysisId']
+
+
+def test_unknown_previous_analysis_is_analyzed_in_full(tmp_path, monkeypatch):
+    monkeypatch.setenv('INCREMENTAL_ANALYSIS_STORE', f"local:{tmp_path}")
+    monkeypatch.setattr(incremental_analysis, 'incremental_analysis_store', None)
+
+    processor = BugFunctionGenericProcessor.__new__(BugFunctionGenericProcessor)
+
+    with patch.object(FunctionGenericProcessor, 'process_input_with_function_output',
+                      return_value={'status': 'nobugsfound', 'details': []}) as analyze:
+        response = processor.process_input_with_function_output(
+            {'code': new_code, 'previousAnalysisId': '../../etc/passwd'}, account, 'test', 'correlation-1')
+
+    assert analyze.call_args.args[0]['code'] == new_code
+    assert response['analysisId']
+
+
+def test_another_accounts_analysis_is_analyzed_in_full(tmp_path, monkeypatch):
+    monkeypatch.setenv('INCREMENTAL_ANALYSIS_STORE', f"local:{tmp_path}")
+    monkeypatch.setattr(incremental_analysis, 'incremental_analysis_store', None)
+
+    processor = BugFunctionGenericProcessor.__new__(BugFunctionGenericProcessor)
+
+    with patch.object(FunctionGenericProcessor, 'process_input_with_function_output',
+                      return_value={'status': 'bugsfound', 'details': [{'lineNumber': 3, 'description': 'secret'}]}):
+        first = processor.process_input_with_function_output({'code': old_code}, account, 'test', 'correlation-1')
+
+    # the stored analysis holds the first org's code and findings - another org's request can't diff against it
+    with patch.object(FunctionGenericProcessor, 'process_input_with_function_output',
+                      return_value={'status': 'nobugsfound', 'details': []}) as analyze:
+        response = processor.process_input_with_function_output(
+            {'code': new_code, 'previousAnalysisId': first['analysisId']}, other_account, 'test', 'correlation-2')
+
+    assert analyze.call_args.args[0]['code'] == new_code
+    assert response['details'] == []
+
+
+def test_code_without_input_metadata_is_numbered_from_one(tmp_path, monkeypatch):
+    monkeypatch.setenv('INCREMENTAL_ANALYSIS_STORE', f"local:{tmp_path}")
+    monkeypatch.setattr(incremental_analysis, 'incremental_analysis_store', None)
+
+    processor = BugFunctionGenericProcessor.__new__(BugFunctionGenericProcessor)
+
+    # without a line number instruction, the model numbers the code from 1
+    def analyze(self, data, account, function_name, correlation_id):
+        lineNumberBase = json.loads(data['inputMetadata'])['lineNumberBase'] if 'inputMetadata' in data else 1
+        return {'status': 'bugsfound', 'details': [{'lineNumber': lineNumberBase, 'description': data['code'].splitlines()[0]}]}
+
+    with patch.object(FunctionGenericProcessor, 'process_input_with_function_output', analyze), \
+            patch('chalicelib.processors.BugFunctionGenericProcessor.plan_incremental_analysis',
+                  side_effect=lambda old, new: plan_incremental_analysis(old, new, context_lines=2)):
+        first = processor.process_input_with_function_output({'code': old_code}, account, 'test', 'correlation-1')
+        second = processor.process_input_with_function_output(
+            {'code': new_code, 'previousAnalysisId': first['analysisId']}, account, 'test', 'correlation-2')
+
+    # the hunks' findings line up with the findings carried forward from the full analysis
+    assert second['details'] == [{'lineNumber': 1, 'description': 'line 0'},
+                                 {'lineNumber': 19, 'description': 'line 18'},
+                                 {'lineNumber': 31, 'description': 'line 28'}]
+
+
+@patch('chalicelib.processors.BugFunctionGenericProcessor.update_usage', return_value=0.5)
+@patch('chalicelib.processors.BugFunctionGenericProcessor.notify_account_usage')
+def test_hunks_are_billed_as_one_request(notify_account_usage, update_usage, tmp_path, monkeypatch):
+    monkeypatch.setenv('INCREMENTAL_ANALYSIS_STORE', f"local:{tmp_path}")
+    monkeypatch.setattr(incremental_analysis, 'incremental_analysis_store', None)
+
+    processor = BugFunctionGenericProcessor.__new__(BugFunctionGenericProcessor)
+    billing_metrics = GenericProcessor.BillingMetrics(user_input_size=400, output_size=200, user_messages_size=1000,
+                                                      openai_input_cost=0, openai_output_cost=0, boost_cost=0,
+                                                      openai_input_tokens=0, openai_customerinput_tokens=0,
+                                                      openai_output_tokens=0, openai_tokens=0)
+
+    # each hunk is billed as process_input bills it
+    def analyze(self, data, account, function_name, correlation_id):
+        processor.report_usage_cost(account, function_name, True, billing_metrics)
+        return {'status': 'nobugsfound', 'details': []}
+
+    paid_account = dict(account, subscription_item='si_test')
+    with patch.object(FunctionGenericProcessor, 'process_input_with_function_output', return_value={'status': 'nobugsfound', 'details': []}):
+        first = processor.process_input_with_function_output({'code': old_code}, paid_account, 'test', 'correlation-1')
+
+    with patch.object(FunctionGenericProcessor, 'process_input_with_function_output', analyze), \
+            patch('chalicelib.processors.BugFunctionGenericProcessor.plan_incremental_analysis',
+                  side_effect=lambda old, new: plan_incremental_analysis(old, new, context_lines=2)):
+        processor.process_input_with_function_output(
+            {'code': new_code, 'previousAnalysisId': first['analysisId']}, paid_account, 'test', 'correlation-2')
+
+    # both hunks are charged, the response reports their total, and the account is notified once
+    assert [call.args[1] for call in update_usage.call_args_list] == [1200, 1200]
+    assert paid_account['operation_cost'] == 1.0
+    notify_account_usage.assert_called_once_with(paid_account, 'test')
@@ -0,0 +1,63 @@
+import json
+from unittest.mock import patch, MagicMock
+
+from chalicelib.telemetry import (
+    capture_metric,
+    metrics_buffer_scope,
+    CostMetrics,
+    InfoMetrics
+)
+
+customer = {'name': 'polyverse-appsec', 'id': 'cus_test'}
+email = 'test@polyverse.com'
+
+
+def capture_request_metrics():
+    with metrics_buffer_scope():
+        for _ in range(3):
+            capture_metric(customer, email, 'analyze', 'correlation-1',
+                           {"name": InfoMetrics.OPENAI_RATE_LIMIT, "value": 1, "unit": "None"})
+        capture_metric(customer, email, 'analyze', 'correlation-1',
+                       {'name': CostMetrics.OPENAI_INPUT_TOKENS, 'value': 1200, 'unit': 'Count'},
+                       {'name': CostMetrics.OPENAI_OUTPUT_TOKENS, 'value': 300, 'unit': 'Count'})
+
+
+@patch.dict('os.environ', {'CLOUD_WATCH_METRICS_ENABLED': 'true'})
+@patch('chalicelib.telemetry.aws_telemetry_enabled', True)
+def test_metrics_buffered_and_put_once():
+    cloudwatch = MagicMock()
+    with patch('chalicelib.telemetry.get_cloudwatch_client', return_value=cloudwatch), \
+            patch('chalicelib.telemetry.cloudWatchMetricsFormat', 'api'):
+        capture_request_metrics()
+
+    assert cloudwatch.put_metric_data.call_count == 1
+
+    metric_data = {metric['MetricName']: metric for metric in cloudwatch.put_metric_data.call_args.kwargs['MetricData']}
+    assert metric_data[InfoMetrics.OPENAI_RATE_LIMIT]['Values'] == [1]
+    assert metric_data[InfoMetrics.OPENAI_RATE_LIMIT]['Counts'] == [3]
+    assert metric_data[CostMetrics.OPENAI_INPUT_TOKENS]['Values'] == [1200]
+    assert {dimension['Name'] for dimension in metric_data[CostMetrics.OPENAI_INPUT_TOKENS]['Dimensions']} == \
+        {'Customer', 'AccountID', 'UserEmail', 'LambdaFunctionName', 'CorrelationID'}
+
+
+@patch.dict('os.environ', {'CLOUD_WATCH_METRICS_ENABLED': 'true'})
+@patch('chalicelib.telemetry.aws_telemetry_enabled', True)
+def test_metrics_emitted_as_embedded_metric_format():
+    cloudwatch = MagicMock()
+    with patch('chalicelib.telemetry.get_cloudwatch_client', return_value=cloudwatch), \
+            patch('chalicelib.telemetry.cloudWatchMetricsFormat', 'emf'), \
+            patch('builtins.print') as mock_print:
+        capture_request_metrics()
+
+    assert cloudwatch.put_metric_data.call_count == 0
+
+    emf_lines = [json.loads(call.args[0]) for call in mock_print.call_args_list if call.args[0].startswith('{"_aws"')]
+    assert len(emf_lines) == 1
+
+    emf = emf_lines[0]
+    assert emf['Customer'] == 'polyverse-appsec'
+    assert emf['CorrelationID'] == 'correlation-1'
+    assert emf[InfoMetrics.OPENAI_RATE_LIMIT] == [1.0, 1.0, 1.0]
+    assert emf[CostMetrics.OPENAI_OUTPUT_TOKENS] == 300.0
+    assert {metric['Name'] for metric in emf['_aws']['CloudWatchMetrics'][0]['Metrics']} == \
+        {InfoMetrics.OPENAI_RATE_LIMIT, CostMetrics.OPENAI_INPUT_TOKENS, CostMetrics.OPENAI_OUTPUT_TOKENS}
@@ -0,0 +1,76 @@
+import random
+
+from chalicelib.openai_latency import LatencyModel, parse_latency_log_line
+from chalicelib.openai_throttler import Throttler
+
+
+def make_latency_model(samples=50):
+    # duration = 0.5 secs + 0.1 secs per 1000 input tokens + 20 secs per 1000 output tokens, with a little noise
+    latency_model = LatencyModel()
+    generator = random.Random(7)
+    for _ in range(samples):
+        input_tokens = generator.randint(100, 8000)
+        output_tokens = generator.randint(10, 1000)
+        duration = 0.5 + 0.0001 * input_tokens + 0.02 * output_tokens + generator.uniform(-0.05, 0.05)
+        latency_model.record('gpt-4', input_tokens, output_tokens, duration, log=False)
+    return latency_model
+
+
+def test_fit_recovers_latency():
+    latency_model = make_latency_model()
+
+    base, input_rate, output_rate = latency_model.fit('gpt-4')
+    assert abs(base - 0.5) < 0.1
+    assert abs(input_rate - 0.0001) < 0.00002
+    assert abs(output_rate - 0.02) < 0.0002
+
+    assert abs(latency_model.predict('gpt-4', 2000, 500) - 10.7) < 0.2
+    assert latency_model.fit_quality('gpt-4')['r_squared'] > 0.99
+
+
+def test_no_estimate_without_enough_samples():
+    latency_model = make_latency_model(samples=5)
+
+    assert latency_model.predict('gpt-4', 2000, 500) is None
+    assert latency_model.predict('gpt-3.5-turbo', 2000, 500) is None
+
+
+def test_samples_are_rolling():
+    latency_model = LatencyModel(max_samples=20)
+    for _ in range(20):
+        latency_model.record('gpt-4', 1000, 100, 60.0, log=False)
+    for _ in range(20):
+        latency_model.record('gpt-4', 1000, 100, 3.0, log=False)
+
+    assert abs(latency_model.predict('gpt-4', 1000, 100) - 3.0) < 0.01
+
+
+def test_sample_log_line_round_trips(capsys):
+    LatencyModel().record('gpt-4', 1200, 300, 7.25)
+
+    sample = parse_latency_log_line(capsys.readouterr().out)
+    assert sample['model'] == 'gpt-4'
+    assert sample['input_tokens'] == 1200
+    assert sample['output_tokens'] == 300
+    assert sample['duration'] == 7.25
+
+    assert parse_latency_log_line("unrelated log line") is None
+
+
+def test_throttler_plans_deadline_with_learned_latency():
+    now = [1000.0]
+    latency_model = make_latency_model()
+
+    # 600 secs for all calls, 300 secs for a single call - without latency data, waiting more than 300 secs bypasses
+    without_latency = Throttler(6000, 300, 600, 60, clock=lambda: now[0], model='gpt-4')
+    with_latency = Throttler(6000, 300, 600, 60, clock=lambda: now[0], model='gpt-4', latency_model=latency_model)
+
+    first_wait = now[0]
+    now[0] += 400
+
+    assert without_latency.get_wait_time(1000, first_wait, 500) == -1
+    # the call is expected to take ~11 secs (x1.5 margin), so there's still time to wait for the rate limit
+    assert with_latency.get_wait_time(1000, first_wait, 500) == 0
+
+    now[0] += 190
+    assert with_latency.get_wait_time(1000, first_wait, 500) == -1
@@ -0,0 +1,100 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+from chalicelib import openai_rate_limits
+from chalicelib.openai_rate_limits import (
+    parse_duration,
+    rate_limit_retry_after,
+    capture_rate_limit_headers,
+    record_rate_limit_headers,
+    get_rate_limits,
+    make_trace_config_ctx,
+    on_aiohttp_request_end,
+    openai_request_model
+)
+from chalicelib.openai_throttler import Throttler
+
+
+@pytest.fixture(autouse=True)
+def clear_rate_limits():
+    openai_rate_limits.rate_limits.clear()
+    yield
+    openai_rate_limits.rate_limits.clear()
+
+
+# OpenAI reports the resolved snapshot of the requested model (e.g. gpt-4-0613 for gpt-4) in the openai-model header
+def openai_response(model, limit, remaining, reset, snapshot=None):
+    headers = {'openai-model': snapshot or f"{model}-0613",
+               'x-ratelimit-limit-tokens': str(limit),
+               'x-ratelimit-remaining-tokens': str(remaining),
+               'x-ratelimit-reset-tokens': reset}
+    return SimpleNamespace(headers=headers, request=SimpleNamespace(body=json.dumps({'model': model})))
+
+
+def test_parse_duration():
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("1.5s") == 1.5
+    assert parse_duration("20ms") == 0.02
+    assert parse_duration("1h2m3s") == 3723
+    assert parse_duration(None) is None
+
+
+def test_retry_after_from_error_headers():
+    assert rate_limit_retry_after(openai.error.RateLimitError("limited", headers={'retry-after-ms': '1500'})) == 1.5
+    assert rate_limit_retry_after(openai.error.RateLimitError("limited", headers={'Retry-After': '7'})) == 7
+    assert rate_limit_retry_after(openai.error.RateLimitError("limited", headers={'x-ratelimit-reset-tokens': '2s'})) == 2
+    assert rate_limit_retry_after(openai.error.RateLimitError("limited")) is None
+
+
+def test_response_headers_recorded_per_model():
+    capture_rate_limit_headers(openai_response('gpt-4', 300000, 295000, '1s', snapshot='gpt-4-0613'))
+
+    # by the requested model, which the Throttler looks limits up by - not the snapshot OpenAI resolved it to
+    assert get_rate_limits('gpt-4')['limit_tokens'] == 300000
+    assert get_rate_limits('gpt-4')['remaining_tokens'] == 295000
+    assert get_rate_limits('gpt-4-0613') is None
+    assert get_rate_limits('gpt-3.5-turbo') is None
+
+
+def test_async_responses_recorded_by_requested_model():
+    async def request():
+        openai_request_model.set('gpt-4')
+        trace_config_ctx = make_trace_config_ctx()
+        response = openai_response('gpt-4', 300000, 295000, '1s', snapshot='gpt-4-0613')
+        await on_aiohttp_request_end(None, trace_config_ctx, SimpleNamespace(response=response))
+
+    asyncio.run(request())
+
+    assert get_rate_limits('gpt-4')['remaining_tokens'] == 295000
+    assert get_rate_limits('gpt-4-0613') is None
+
+
+def test_throttler_tracks_reported_limits():
+    capture_rate_limit_headers(openai_response('gpt-4', 300000, 120000, '36s'))
+
+    # a higher tier key - the throttler uses the reported limit instead of the default
+    throttler = Throttler(40000, 600, 3600, 60, model='gpt-4')
+    assert throttler.capacity == 300000
+    assert throttler.rate == 5000
+    assert 120000 <= throttler.bucket < 121000
+
+    # OpenAI reports fewer tokens remaining (e.g. used by another container) - the bucket follows
+    capture_rate_limit_headers(openai_response('gpt-4', 300000, 10000, '58s'))
+    wait_time = throttler.get_wait_time(20000, throttler.clock(), 15000)
+    assert 1.9 < wait_time <= 2.0
+
+
+def test_observed_tokens_refill_on_the_throttler_clock():
+    now = [1000.0]
+    record_rate_limit_headers('gpt-4', {'x-ratelimit-limit-tokens': '60000', 'x-ratelimit-remaining-tokens': '0'}, now=now[0])
+
+    throttler = Throttler(40000, 600, 3600, 60, clock=lambda: now[0], model='gpt-4')
+    assert throttler.observed_remaining_tokens_locked() == 0
+
+    # 1000 tokens per second accrue on the injected clock, not the wall clock
+    now[0] += 2
+    assert throttler.observed_remaining_tokens_locked() == 2000
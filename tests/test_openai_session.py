@@ -0,0 +1,92 @@
+import concurrent.futures
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import pytest
+
+from chalicelib import openai_session
+from chalicelib.openai_session import ensure_openai_pool_size, get_openai_pool_size, get_openai_session, openai_connection_stats
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def fresh_session():
+    openai_session.openai_session = None
+    openai_session.openai_pool_size = 0
+    yield
+    if openai_session.openai_session is not None:
+        openai_session.openai_session.close_pool()
+    openai_session.openai_session = None
+    openai_session.openai_pool_size = 0
+
+
+def test_threads_share_pooled_connections(server):
+    session = get_openai_session()
+    stats_at_start = openai_connection_stats.snapshot()
+
+    def call(_):
+        # each thread gets the session the way the OpenAI client does
+        assert get_openai_session() is session
+        return session.get(server).status_code
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        for _ in range(5):
+            assert list(executor.map(call, range(4))) == [200] * 4
+
+    stats = openai_connection_stats.since(stats_at_start)
+    assert stats['requests'] == 20
+    assert stats['connections'] <= 4
+    assert stats['reused'] >= 16
+    assert stats['handshake_seconds'] > 0
+
+
+def test_closing_the_session_keeps_the_pool(server):
+    session = get_openai_session()
+    session.get(server)
+
+    stats_at_start = openai_connection_stats.snapshot()
+
+    # the OpenAI client closes its sessions every few minutes
+    session.close()
+    session.get(server)
+
+    assert openai_connection_stats.since(stats_at_start)['connections'] == 0
+
+
+def test_pool_grows_to_chunk_concurrency():
+    get_openai_session()
+    default_size = get_openai_pool_size()
+    replaced_adapter = get_openai_session().get_adapter('https://api.openai.com')
+
+    with patch.object(replaced_adapter, 'close', wraps=replaced_adapter.close) as close:
+        assert ensure_openai_pool_size(default_size + 8) == default_size + 8
+
+    # the replaced pool's connections are closed, not abandoned
+    close.assert_called_once_with()
+    assert ensure_openai_pool_size(2) == default_size + 8
+    assert get_openai_session().get_adapter('https://api.openai.com')._pool_maxsize == default_size + 8
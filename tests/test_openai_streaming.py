@@ -0,0 +1,113 @@
+import json
+import time
+from unittest.mock import patch
+
+import pytest
+
+from chalicelib.openai_streaming import StreamedResponse, salvage_partial_json
+from chalicelib.processors.GenericProcessor import GenericProcessor
+
+account = {'customer': {'name': 'polyverse-appsec', 'id': 'cus_test'}, 'email': 'test@polyverse.com'}
+
+
+class WordLedger:
+    # counts words instead of tokens, so no encodings need to be loaded
+    def num_tokens_from_string(self, string, model=None):
+        return len(string.split()), []
+
+
+@pytest.fixture(autouse=True)
+def word_ledger():
+    with patch('chalicelib.openai_streaming.get_token_ledger', return_value=WordLedger()):
+        yield
+
+
+def test_salvage_partial_json():
+    assert salvage_partial_json('{"bugs": [{"line": 1}, {"line": 2}]}') == {'bugs': [{'line': 1}, {'line': 2}]}
+    assert salvage_partial_json('{"bugs": [{"line": 1}, {"li') == {'bugs': [{'line': 1}]}
+    assert salvage_partial_json('{"bugs": [{"line": 1, "description": "a [tricky}, \\"string') == {'bugs': [{'line': 1}]}
+    assert salvage_partial_json('{"bugs": [{"li') is None
+    assert salvage_partial_json('') is None
+
+
+def content_chunk(content, finish_reason=None):
+    return {'choices': [{'delta': {'content': content}, 'finish_reason': finish_reason}]}
+
+
+def function_chunk(arguments, name=None, finish_reason=None):
+    function_call = {'arguments': arguments}
+    if name is not None:
+        function_call['name'] = name
+    return {'choices': [{'delta': {'function_call': function_call}, 'finish_reason': finish_reason}]}
+
+
+def test_streamed_function_call_is_salvaged():
+    params = {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': 'find the bugs'}]}
+
+    streamed = StreamedResponse(time.time())
+    for chunk in [function_chunk('', name='report_bugs'), function_chunk('{"bugs": [{"line": 1}, '), function_chunk('{"line"')]:
+        streamed.add(chunk)
+
+    result = streamed.result(params, partial=True)
+
+    assert result['partial'] and result['finish'] is None
+    assert result['message']['function_call']['name'] == 'report_bugs'
+    assert json.loads(result['message']['function_call']['arguments']) == {'bugs': [{'line': 1}]}
+    assert result['discarded'] > 0
+    assert result['input_tokens'] == 3
+    assert result['time_to_first_token'] is not None
+
+
+def slow_stream(words, delay):
+    def create(**params):
+        assert params['stream']
+
+        def stream():
+            yield {'choices': [{'delta': {'role': 'assistant'}, 'finish_reason': None}]}
+            for word in words:
+                time.sleep(delay)
+                yield content_chunk(f"{word} ")
+            yield content_chunk('', finish_reason='stop')
+        return stream()
+    return create
+
+
+@patch('chalicelib.processors.GenericProcessor.capture_metric')
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+def test_streaming_call_keeps_partial_text_at_timeout(_, capture_metric, monkeypatch):
+    monkeypatch.setenv('useOpenAIStreaming', 'True')
+
+    processor = GenericProcessor.__new__(GenericProcessor)
+    # single call, all calls and service timeouts
+    processor.get_call_timeout_settings = lambda data: (0.25, 10, 10)
+
+    params = {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': 'summarize this'}]}
+    with patch('openai.ChatCompletion.create', side_effect=slow_stream([f"word{i}" for i in range(20)], 0.05)):
+        result = processor.runAnalysis(params, account, 'test', 'correlation-1')
+
+    assert result['partial'] and result['finish'] is None
+    assert result['response'].startswith('word0 word1 ')
+    assert 0 < result['output_tokens'] < 20
+
+    metrics = [metric['name'] for call in capture_metric.call_args_list for metric in call.args[4:]]
+    assert metrics == ['OpenAITimeToFirstToken', 'OpenAIPartialResponse']
+
+
+@patch('chalicelib.processors.GenericProcessor.capture_metric')
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+def test_streaming_call_completes(_, capture_metric, monkeypatch):
+    monkeypatch.setenv('useOpenAIStreaming', 'True')
+
+    processor = GenericProcessor.__new__(GenericProcessor)
+    processor.get_call_timeout_settings = lambda data: (10, 10, 10)
+
+    params = {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': 'summarize this'}]}
+    with patch('openai.ChatCompletion.create', side_effect=slow_stream(['all', 'done'], 0)), \
+            patch('chalicelib.processors.GenericProcessor.openai_latency_model') as latency_model:
+        result = processor.runAnalysis(params, account, 'test', 'correlation-1')
+
+    assert result['response'] == 'all done '
+    assert result['finish'] == 'stop'
+    assert 'partial' not in result
+    assert result['message']['content'] == 'all done '
+    latency_model.record.assert_called_once()
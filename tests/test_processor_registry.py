@@ -0,0 +1,55 @@
+import threading
+import time
+
+from chalicelib.processor_registry import get_processor
+
+
+class SlowProcessor:
+    constructed = 0
+
+    def __init__(self):
+        # simulate prompt loading so concurrent callers overlap during construction
+        time.sleep(0.1)
+        SlowProcessor.constructed += 1
+
+
+def test_processor_constructed_once_across_threads():
+    instances = []
+
+    def get_instance():
+        instances.append(get_processor(SlowProcessor))
+
+    threads = [threading.Thread(target=get_instance) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert SlowProcessor.constructed == 1
+    assert all(instance is instances[0] for instance in instances)
+    assert get_processor(SlowProcessor) is instances[0]
+
+
+def test_processor_class_loaded_by_name():
+    from chalicelib.processor_registry import load_processor_class
+    from chalicelib.processors.SummaryProcessor import SummarizeProcessor
+    from chalicelib.processors.FlowDiagramProcessor import FlowDiagramProcessor
+
+    # class lives in a module with a different name
+    assert load_processor_class('SummarizeProcessor') is SummarizeProcessor
+    assert load_processor_class('FlowDiagramProcessor') is FlowDiagramProcessor
+
+
+def test_cold_start_budget_covers_every_lambda():
+    from client.measure_cold_start import lambda_processors
+    from chalicelib.processor_registry import load_processor_class
+
+    processors = lambda_processors()
+
+    # lambdas declared (event, context) as well as (event, _)
+    assert processors['compliance'] == 'ComplianceProcessor'
+    assert processors['performance_function_batch'] == 'PerformanceFunctionProcessor'
+    assert processors['customer_portal'] == ''
+
+    for processor_name in filter(None, processors.values()):
+        assert load_processor_class(processor_name) is not None
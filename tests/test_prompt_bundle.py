@@ -0,0 +1,117 @@
+import glob
+import io
+import mmap
+import os
+from types import SimpleNamespace
+
+import pytest
+from botocore.exceptions import ClientError
+
+import chalicelib.storage
+from chalicelib.prompt_bundle import PromptBundle, PromptBundleLoader, build_prompt_bundle
+
+prompt_dir = os.path.join(os.path.dirname(__file__), '..', 'chalicelib', 'prompts')
+
+
+def prompt_files():
+    files = {}
+    for path in glob.glob(os.path.join(prompt_dir, '*.prompt')):
+        with open(path, 'rb') as prompt_file:
+            files[f"prompts/{os.path.basename(path)}"] = (prompt_file.read(), os.path.getmtime(path))
+    return files
+
+
+def test_bundle_holds_every_prompt():
+    files = prompt_files()
+    bundle = PromptBundle(build_prompt_bundle(files, 'prompts', 'v1'))
+
+    assert bundle.version == 'v1'
+    for path, (contents, timestamp) in files.items():
+        assert bundle.get(path) == (contents.decode('utf-8'), timestamp)
+
+    assert bundle.get('prompts/missing.prompt') is None
+    assert bundle.covers('prompts') and bundle.covers('prompts/missing.prompt') and not bundle.covers('other/x.prompt')
+    assert bundle.search('prompts', 'guidelines-user-*.prompt') == sorted(path for path in files if '/guidelines-user-' in path)
+
+
+def test_corrupt_bundle_is_detected():
+    bundle_bytes = bytearray(build_prompt_bundle({'prompts/a.prompt': (b'hello', 1.0)}, 'prompts'))
+    bundle_bytes[-1:] = b'!'
+
+    with pytest.raises(ValueError):
+        PromptBundle(bytes(bundle_bytes)).get('prompts/a.prompt')
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.gets = []
+
+    def put(self, key, body, etag):
+        self.objects[key] = (body, etag)
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.gets.append((Key, IfNoneMatch))
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        body, etag = self.objects[Key]
+        if IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        return {'Body': io.BytesIO(body), 'ETag': etag}
+
+    def get_paginator(self, operation):
+        return SimpleNamespace(paginate=lambda **kwargs: [{}])
+
+
+def test_loader_refreshes_only_when_the_bundle_changes(tmp_path):
+    now = [1000.0]
+    s3 = FakeS3()
+    s3.put('dev/prompts.bundle', build_prompt_bundle({'prompts/a.prompt': (b'first', 1.0)}, 'prompts', 'v1'), '"1"')
+
+    loader = PromptBundleLoader(s3, 'bucket', 'dev', str(tmp_path), ttl=60, clock=lambda: now[0])
+
+    bundle = loader.get()
+    assert bundle.version == 'v1' and isinstance(bundle.buffer, mmap.mmap)
+
+    # within the TTL, nothing is fetched
+    assert loader.get() is bundle
+    assert len(s3.gets) == 1
+
+    # after it, an unchanged bundle is kept
+    now[0] += 61
+    assert loader.get() is bundle
+    assert s3.gets[-1] == ('dev/prompts.bundle', '"1"')
+
+    # and a changed one is loaded
+    now[0] += 61
+    s3.put('dev/prompts.bundle', build_prompt_bundle({'prompts/a.prompt': (b'second', 2.0)}, 'prompts', 'v2'), '"2"')
+    assert loader.get().get('prompts/a.prompt') == ('second', 2.0)
+    assert bundle.get('prompts/a.prompt') == ('first', 1.0)  # a bundle already in use is still readable
+
+    assert PromptBundleLoader(s3, 'bucket', 'prod', str(tmp_path), ttl=60).get() is None
+
+
+def test_storage_reads_prompts_from_the_stage_bundle(tmp_path, monkeypatch):
+    s3 = FakeS3()
+    s3.put('staging/prompts.bundle', build_prompt_bundle({'prompts/a.prompt': (b'from bundle', 1.0),
+                                                          'prompts/guidelines-user-1.prompt': (b'guideline', 1.0)},
+                                                         'prompts', 'v1'), '"1"')
+
+    monkeypatch.setenv('usePromptBundle', 'True')
+    monkeypatch.setenv('CHALICE_STAGE', 'dev')
+    monkeypatch.setattr(chalicelib.storage, 's3_client', s3)
+    monkeypatch.setattr(chalicelib.storage, 'prompt_bundle_directory', str(tmp_path))
+    monkeypatch.setattr(chalicelib.storage, 'prompt_bundle_loaders', {})
+    monkeypatch.setattr(chalicelib.storage, 's3_metadata_cache', {})
+    monkeypatch.setattr(chalicelib.storage, 'file_contents_cache', {})
+    monkeypatch.setenv('useDiskCache', 'False')
+
+    # dev and test have no bundle, nor the file - so it comes from the staging bundle
+    assert chalicelib.storage.get_file('prompts/a.prompt') == 'from bundle'
+    assert chalicelib.storage.get_file_time('prompts/a.prompt') == 1.0
+    assert chalicelib.storage.search_storage('prompts', 'guidelines-user-*.prompt') == ['prompts/guidelines-user-1.prompt']
+
+    # only one fetch per stage, after the per-file probes in dev and test
+    assert chalicelib.storage.get_file('prompts/a.prompt') == 'from bundle'
+    assert [key for key, _ in s3.gets if key.endswith('prompts.bundle')] == ['dev/prompts.bundle', 'test/prompts.bundle',
+                                                                              'staging/prompts.bundle']
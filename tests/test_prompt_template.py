@@ -0,0 +1,63 @@
+import glob
+import os
+
+import pytest
+
+from chalicelib.prompt_template import PromptTemplate, SafeDict
+from chalicelib.processors.GenericProcessor import GenericProcessor
+
+prompt_dir = os.path.join(os.path.dirname(__file__), '..', 'chalicelib', 'prompts')
+
+
+@pytest.mark.parametrize('prompt_file', sorted(glob.glob(os.path.join(prompt_dir, '*.prompt'))), ids=os.path.basename)
+def test_render_matches_format_map(prompt_file):
+    with open(prompt_file, 'r') as f:
+        text = f.read()
+
+    template = PromptTemplate(text)
+    assert template.compiled
+
+    # every other tag is missing
+    args = {tag: f"<{tag} value>" for tag in template.tags[::2]}
+
+    assert template.render(args) == text.format_map(SafeDict(args))
+    for tag in template.tag_set:
+        assert template.render(args, tag, 'slot') == text.format_map(SafeDict(args, **{tag: 'slot'}))
+
+
+def test_render_formats_values_like_format_map():
+    text = "{{literal}} {count} {count:>4} {name!r} {missing}."
+    template = PromptTemplate(text)
+
+    assert template.compiled
+    assert template.tags == ['{literal', 'count', 'count:>4', 'name!r', 'missing']
+    assert template.render({'count': 7, 'name': 'x'}) == text.format_map(SafeDict(count=7, name='x')) == "{literal} 7    7 'x' ."
+
+
+def test_templates_that_cant_be_compiled_are_formatted_as_before():
+    assert PromptTemplate("{user.name} wrote").render({'user': type('User', (), {'name': 'ann'})}) == "ann wrote"
+
+    unbalanced = PromptTemplate("a } b")
+    assert not unbalanced.compiled
+    with pytest.raises(ValueError):
+        unbalanced.render({})
+
+
+def test_generate_messages_expands_context_lists():
+    processor = GenericProcessor.__new__(GenericProcessor)
+    processor.prompts = [
+        [['main', 'main.prompt'], PromptTemplate("Analyze {code}{related}")],
+        [['system', 'role-system.prompt'], PromptTemplate("You are an expert. {guidelines}")],
+        [['system', 'context-related-system.prompt'], PromptTemplate("Related: {related}")],
+        [['system', 'context-history-system.prompt'], PromptTemplate("History: {history}")],
+    ]
+
+    messages = processor.generate_messages(None, {'code': 'x = 1', 'guidelines': None,
+                                                  'related': ['system', ['a.py', 'b.py']]})
+
+    assert messages == [
+        {'role': 'system', 'content': 'You are an expert. '},
+        {'role': 'system', 'content': 'Related: a.py'},
+        {'role': 'system', 'content': 'Related: b.py'},
+        {'role': 'user', 'content': 'Analyze x = 1\na.py\nb.py'},
+    ]
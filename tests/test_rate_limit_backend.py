@@ -0,0 +1,156 @@
+import asyncio
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+from chalicelib.openai_throttler import AsyncThrottler, Throttler
+from chalicelib.rate_limit_backend import SQLiteRateLimitBackend, DynamoDBRateLimitBackend
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+# a DynamoDB client supporting just the conditional writes the backend uses
+class FakeDynamoDB:
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+        self.conflicts = 0
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        with self.lock:
+            item = self.items.get(Key['key']['S'])
+            return {'Item': dict(item)} if item else {}
+
+    def put_item(self, TableName, Item, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues=None):
+        with self.lock:
+            existing = self.items.get(Item['key']['S'])
+            if ConditionExpression == 'attribute_not_exists(#key)':
+                allowed = existing is None
+            elif ConditionExpression == '#version = :previous_version':
+                allowed = existing is not None and existing.get('version', {}).get('N') == ExpressionAttributeValues[':previous_version']['N']
+            else:
+                allowed = existing is not None and 'version' not in existing and \
+                    existing['updated']['N'] == ExpressionAttributeValues[':previous_updated']['N']
+
+            if not allowed:
+                self.conflicts += 1
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+
+            self.items[Item['key']['S']] = Item
+
+
+@pytest.fixture(params=['sqlite', 'dynamodb'])
+def backend(request, tmp_path):
+    clock = FakeClock()
+    if request.param == 'sqlite':
+        return SQLiteRateLimitBackend(str(tmp_path / 'rate_limit.db'), clock=clock), clock
+    return DynamoDBRateLimitBackend('rate-limit', client=FakeDynamoDB(), clock=clock), clock
+
+
+def make_throttler(clock, backend):
+    return Throttler(6000, 600, 3600, 60, clock=clock, rate_limit_backend=backend)
+
+
+def test_containers_share_rate_limit(backend):
+    rate_limit_backend, clock = backend
+
+    # two containers, each with their own throttler and local bucket
+    first_container = make_throttler(clock, rate_limit_backend)
+    second_container = make_throttler(clock, rate_limit_backend)
+
+    assert first_container.get_wait_time(4000, clock(), 0) == 0.0
+
+    # the second container's own bucket is full, but the shared bucket only has 2000 tokens (100 tokens per second)
+    assert second_container.get_wait_time(3000, clock(), 0) == 10.0
+
+    clock.advance(10)
+    assert second_container.get_wait_time(3000, clock(), 0) == 0.0
+    assert first_container.get_wait_time(1000, clock(), 0) == 10.0
+
+
+def test_unavailable_backend_falls_back_to_local_rate_limit():
+    class UnavailableBackend:
+        def try_acquire(self, key, tokens_needed, capacity, rate):
+            raise ConnectionError("backend unavailable")
+
+    clock = FakeClock()
+    throttler = make_throttler(clock, UnavailableBackend())
+
+    assert throttler.get_wait_time(6000, clock(), 0) == 0.0
+    assert throttler.get_wait_time(1000, clock(), 0) == 10.0
+
+
+# records whether the throttler's lock was free, and which thread made each shared bucket call
+class RecordingBackend:
+    def __init__(self):
+        self.throttler = None
+        self.calls = []
+
+    def try_acquire(self, key, tokens_needed, capacity, rate):
+        lock_free = []
+
+        def check_lock():
+            lock_free.append(self.throttler.lock.acquire(blocking=False))
+            if lock_free[0]:
+                self.throttler.lock.release()
+
+        checker = threading.Thread(target=check_lock)
+        checker.start()
+        checker.join()
+
+        self.calls.append((threading.get_ident(), lock_free[0]))
+        return 0.0
+
+
+def test_shared_bucket_is_called_outside_the_throttler_lock():
+    clock = FakeClock()
+    backend = RecordingBackend()
+    throttler = backend.throttler = make_throttler(clock, backend)
+
+    assert throttler.get_wait_time(1000, clock(), 0) == 0.0
+    assert backend.calls == [(threading.get_ident(), True)]
+
+
+def test_async_throttler_calls_shared_bucket_off_the_event_loop():
+    clock = FakeClock()
+    backend = RecordingBackend()
+
+    async def wait_for_tokens():
+        throttler = backend.throttler = AsyncThrottler(6000, 600, 3600, 60, clock=clock, rate_limit_backend=backend)
+        return await throttler.wait_for_tokens(1000, clock(), 0)
+
+    assert asyncio.run(wait_for_tokens()) == 0.0
+    assert len(backend.calls) == 1
+    thread_id, lock_free = backend.calls[0]
+    assert thread_id != threading.get_ident() and lock_free
+
+
+def test_dynamodb_conflicting_updates_are_retried():
+    clock = FakeClock()
+    dynamodb = FakeDynamoDB()
+    rate_limit_backend = DynamoDBRateLimitBackend('rate-limit', client=dynamodb, clock=clock)
+
+    tokens_taken = []
+
+    def take_tokens():
+        if rate_limit_backend.try_acquire('openai', 100, 6000, 100) == 0.0:
+            tokens_taken.append(100)
+
+    threads = [threading.Thread(target=take_tokens) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # every conditional update that lost a race was retried, so no tokens were lost or double-counted
+    assert float(dynamodb.items['openai']['tokens']['N']) == 6000 - sum(tokens_taken)
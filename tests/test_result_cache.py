@@ -0,0 +1,143 @@
+import io
+import os
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+
+from chalicelib import result_cache
+from chalicelib.result_cache import DynamoDBResultCache, LocalResultCache, S3ResultCache, make_result_cache_key
+from chalicelib.processors.GenericProcessor import GenericProcessor
+
+account = {'customer': {'name': 'polyverse-appsec', 'id': 'cus_test'}, 'email': 'test@polyverse.com'}
+
+params = {'model': 'gpt-4', 'temperature': 0.1, 'messages': [{'role': 'user', 'content': 'find the bugs'}]}
+
+result = {'message': {'role': 'assistant', 'content': 'no bugs'}, 'response': 'no bugs', 'finish': 'stop',
+          'input_tokens': 100, 'output_tokens': 20}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_key_covers_everything_that_changes_the_result():
+    key = make_result_cache_key(params, {'prompts/bugs.prompt': 1.0})
+
+    assert key == make_result_cache_key(dict(params), {'prompts/bugs.prompt': 1.0})
+    assert key != make_result_cache_key(dict(params, model='gpt-3.5-turbo'), {'prompts/bugs.prompt': 1.0})
+    assert key != make_result_cache_key(dict(params, temperature=0.2), {'prompts/bugs.prompt': 1.0})
+    assert key != make_result_cache_key(dict(params, functions=[{'name': 'report_bugs'}]), {'prompts/bugs.prompt': 1.0})
+    assert key != make_result_cache_key(params, {'prompts/bugs.prompt': 2.0})
+
+
+def test_local_cache_expires_entries(tmp_path):
+    clock = FakeClock()
+    cache = LocalResultCache(str(tmp_path), ttl=60, clock=clock)
+
+    assert cache.get('key') is None
+    assert cache.put('key', dict(result, error='not cached'))
+    assert cache.get('key') == result
+
+    clock.now += 61
+    assert cache.get('key') is None
+
+
+def test_local_cache_evicts_least_recently_used(tmp_path):
+    cache = LocalResultCache(str(tmp_path), max_entries=2)
+
+    cache.put('a', result)
+    cache.put('b', result)
+
+    # 'b' was last used long ago, and reading 'a' makes it the most recently used
+    os.utime(cache.path('b'), (1, 1))
+    os.utime(cache.path('a'), (1, 1))
+    cache.get('a')
+
+    cache.put('c', result)
+
+    assert cache.get('a') == result
+    assert cache.get('b') is None
+    assert cache.get('c') == result
+
+
+def test_large_results_are_not_cached(tmp_path):
+    cache = LocalResultCache(str(tmp_path), max_entry_bytes=100)
+
+    assert not cache.put('key', dict(result, response='x' * 200))
+    assert cache.get('key') is None
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.objects[(Bucket, Key)] = Body
+
+
+class FakeDynamoDB:
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, TableName, Key):
+        item = self.items.get(Key['key']['S'])
+        return {'Item': item} if item else {}
+
+    def put_item(self, TableName, Item):
+        self.items[Item['key']['S']] = Item
+
+
+def test_remote_caches():
+    s3 = FakeS3()
+    dynamodb = FakeDynamoDB()
+    for cache in [S3ResultCache('bucket', 'results', client=s3), DynamoDBResultCache('results', client=dynamodb)]:
+        assert cache.get('key') is None
+        cache.put('key', result)
+        assert cache.get('key') == result
+
+    assert ('bucket', 'results/key.json') in s3.objects
+    assert int(dynamodb.items['key']['expires']['N']) > 0
+
+
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+def test_cache_hit_skips_openai(_, tmp_path, monkeypatch):
+    monkeypatch.setenv('ANALYSIS_RESULT_CACHE', f"local:{tmp_path}")
+    monkeypatch.setattr(result_cache, 'result_cache', None)
+
+    processor = GenericProcessor.__new__(GenericProcessor)
+    processor.prompt_files_timestamps = {'prompts/bugs.prompt': 1.0}
+
+    with patch.object(GenericProcessor, 'runAnalysis', return_value=dict(result)) as runAnalysis:
+        first = processor.runAnalysisForPrompt(0, params['messages'], 200, 100, params, account, 'test', 'correlation-1')
+        second = processor.runAnalysisForPrompt(0, params['messages'], 200, 100, params, account, 'test', 'correlation-1')
+
+        # a different prompt file version isn't a hit
+        processor.prompt_files_timestamps = {'prompts/bugs.prompt': 2.0}
+        processor.runAnalysisForPrompt(0, params['messages'], 200, 100, params, account, 'test', 'correlation-1')
+
+    assert runAnalysis.call_count == 2
+    assert 'cached' not in first
+    assert second['cached'] and second['response'] == 'no bugs'
+
+
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+def test_incomplete_results_are_not_cached(_, tmp_path, monkeypatch):
+    monkeypatch.setenv('ANALYSIS_RESULT_CACHE', f"local:{tmp_path}")
+    monkeypatch.setattr(result_cache, 'result_cache', None)
+
+    processor = GenericProcessor.__new__(GenericProcessor)
+
+    with patch.object(GenericProcessor, 'runAnalysis', return_value=dict(result, finish='length')) as runAnalysis:
+        processor.runAnalysisForPrompt(0, params['messages'], 200, 100, params, account, 'test', 'correlation-1')
+        processor.runAnalysisForPrompt(0, params['messages'], 200, 100, params, account, 'test', 'correlation-1')
+
+    assert runAnalysis.call_count == 2
@@ -0,0 +1,98 @@
+from datetime import datetime
+from unittest.mock import patch
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from chalicelib import auth, pvsecret
+from chalicelib.auth import verify_signed_identity
+
+
+def generate_key_pair():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(serialization.Encoding.PEM,
+                                            serialization.PrivateFormat.PKCS8,
+                                            serialization.NoEncryption()).decode('utf-8')
+    public_pem = private_key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                       serialization.PublicFormat.SubjectPublicKeyInfo).decode('utf-8')
+    return private_pem, public_pem
+
+
+def sign_identity(private_pem, expires_in=3600):
+    return jwt.encode({'email': 'test@polyverse.com',
+                       'organization': 'polyverse-appsec',
+                       'expires': datetime.now().timestamp() + expires_in},
+                      private_pem, algorithm='RS256')
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    auth.verified_identity_cache.clear()
+    pvsecret.jwt_signing_key_cache.clear()
+    pvsecret.jwt_signing_key_fetch_time.clear()
+    yield
+    pvsecret.set_local_jwt_signing_key(None)
+
+
+def test_verified_identity_is_cached():
+    private_pem, public_pem = generate_key_pair()
+    pvsecret.set_local_jwt_signing_key(public_pem)
+    signed_identity = sign_identity(private_pem)
+
+    with patch('chalicelib.auth.jwt.decode', wraps=jwt.decode) as mock_decode:
+        for _ in range(5):
+            identity = verify_signed_identity(signed_identity, 'RS256')
+            assert identity['email'] == 'test@polyverse.com'
+
+            # callers get their own copy of the identity
+            identity['email'] = 'changed'
+
+    assert mock_decode.call_count == 1
+
+
+def test_cached_identity_honors_expires():
+    private_pem, public_pem = generate_key_pair()
+    pvsecret.set_local_jwt_signing_key(public_pem)
+    signed_identity = sign_identity(private_pem, expires_in=60)
+
+    now = datetime.now().timestamp()
+    verify_signed_identity(signed_identity, 'RS256')
+
+    # the identity expires while it is still in the verified identity cache
+    with patch('chalicelib.auth.datetime') as mock_datetime:
+        mock_datetime.now.return_value.timestamp.return_value = now + 120
+        with pytest.raises(jwt.ExpiredSignatureError):
+            verify_signed_identity(signed_identity, 'RS256')
+
+    assert len(auth.verified_identity_cache) == 0
+
+
+def test_signing_key_fetched_once_and_refetched_on_rotation():
+    old_private_pem, old_public_pem = generate_key_pair()
+    new_private_pem, new_public_pem = generate_key_pair()
+
+    with patch('chalicelib.pvsecret.fetch_jwt_signing_key', return_value=old_public_pem) as mock_fetch, \
+            patch('chalicelib.pvsecret.jwt_signing_key_min_refresh', 0):
+        verify_signed_identity(sign_identity(old_private_pem), 'RS256')
+        verify_signed_identity(sign_identity(old_private_pem, expires_in=1800), 'RS256')
+        assert mock_fetch.call_count == 1
+
+        # the key is rotated - the first identity signed with the new key forces a refetch of the key
+        mock_fetch.return_value = new_public_pem
+        identity = verify_signed_identity(sign_identity(new_private_pem), 'RS256')
+        assert identity['organization'] == 'polyverse-appsec'
+        assert mock_fetch.call_count == 2
+
+
+def test_bad_signature_does_not_refetch_recently_fetched_key():
+    _, public_pem = generate_key_pair()
+    other_private_pem, _ = generate_key_pair()
+
+    with patch('chalicelib.pvsecret.fetch_jwt_signing_key', return_value=public_pem) as mock_fetch:
+        for _ in range(3):
+            with pytest.raises(jwt.InvalidSignatureError):
+                verify_signed_identity(sign_identity(other_private_pem), 'RS256')
+
+    assert mock_fetch.call_count == 1
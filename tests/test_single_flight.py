@@ -0,0 +1,306 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from botocore.exceptions import ClientError
+
+from chalicelib import result_cache, single_flight
+from chalicelib.single_flight import AnalysisLease, SingleFlight
+from chalicelib.openai_throttler import AsyncThrottler
+from chalicelib.processors.GenericProcessor import GenericProcessor, openai_calls_deadline
+
+account = {'customer': {'name': 'polyverse-appsec', 'id': 'cus_test'}, 'email': 'test@polyverse.com'}
+
+
+def test_concurrent_callers_share_one_call():
+    flights = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def analyze():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return {'response': 'analysis'}
+
+    def call(_):
+        return flights.do('key', analyze)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+        leader = executor.submit(call, 0)
+        started.wait()
+        followers = list(executor.map(call, range(4)))
+
+    assert len(calls) == 1
+    assert leader.result() == ({'response': 'analysis'}, False)
+    assert followers == [({'response': 'analysis'}, True)] * 4
+
+    # once the call is done, the next caller makes its own call
+    assert flights.do('key', analyze) == ({'response': 'analysis'}, False)
+    assert len(calls) == 2
+
+
+def test_followers_see_the_leaders_error():
+    flights = SingleFlight()
+    started = threading.Event()
+
+    def analyze():
+        started.set()
+        time.sleep(0.2)
+        raise TimeoutError("too slow")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        leader = executor.submit(flights.do, 'key', analyze)
+        started.wait()
+        follower = executor.submit(flights.do, 'key', analyze)
+        joined = executor.submit(flights.join, 'key')
+
+        with pytest.raises(TimeoutError):
+            leader.result()
+        with pytest.raises(TimeoutError):
+            follower.result()
+
+        # joining a failed call leaves the caller to make its own
+        assert joined.result() is None
+
+
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+def test_identical_chunks_share_one_openai_call(_):
+    processor = GenericProcessor.__new__(GenericProcessor)
+    processor.get_call_timeout_settings = lambda data: (60, 120, 180)
+
+    calls = []
+
+    async def acreate(**params):
+        calls.append(params['messages'][0]['content'])
+        await asyncio.sleep(0.1)
+        message = SimpleNamespace(content=params['messages'][0]['content'])
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason='stop')],
+                               usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5))
+
+    prompt_set = [([{'role': 'user', 'content': f"chunk {i % 2}"}], 100, 200, 0) for i in range(6)]
+
+    with patch('openai.ChatCompletion.acreate', side_effect=acreate):
+        results = asyncio.run(processor.runAnalysisForPromptsAsync(prompt_set, None, {'model': 'gpt-4'}, account,
+                                                                   'test', 'correlation-1', print))
+
+    assert sorted(calls) == ['chunk 0', 'chunk 1']
+    assert [result['response'] for result in results] == [f"chunk {i % 2}" for i in range(6)]
+    assert sum(1 for result in results if result.get('coalesced')) == 4
+
+
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+def test_coalesced_chunks_return_their_reserved_tokens(_):
+    processor = GenericProcessor.__new__(GenericProcessor)
+    processor.get_call_timeout_settings = lambda data: (60, 120, 180)
+
+    async def acreate(**params):
+        await asyncio.sleep(0.1)
+        message = SimpleNamespace(content=params['messages'][0]['content'])
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason='stop')],
+                               usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5))
+
+    prompt_set = [([{'role': 'user', 'content': 'chunk'}], 100, 200, 0) for _ in range(3)]
+
+    # the chunks start together, so they reserve tokens before finding the identical call in flight
+    async def join(self, key):
+        return None
+
+    with patch('openai.ChatCompletion.acreate', side_effect=acreate), \
+            patch.object(SingleFlight, 'join_async', join), \
+            patch.object(AsyncThrottler, 'return_tokens') as return_tokens:
+        results = asyncio.run(processor.runAnalysisForPromptsAsync(prompt_set, None, {'model': 'gpt-4'}, account,
+                                                                   'test', 'correlation-1', print))
+
+    assert sum(1 for result in results if result.get('coalesced')) == 2
+    assert [call.args for call in return_tokens.call_args_list] == [(300,)] * 2
+
+
+class FakeDynamoDB:
+    def __init__(self):
+        self.items = {}
+
+    def conditional_check_failed(self):
+        return ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+
+    def put_item(self, TableName, Item, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        existing = self.items.get(Item['key']['S'])
+        if existing and float(existing['expires']['N']) >= float(ExpressionAttributeValues[':now']['N']):
+            raise self.conditional_check_failed()
+        self.items[Item['key']['S']] = Item
+
+    def delete_item(self, TableName, Key, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        existing = self.items.get(Key['key']['S'])
+        if not existing or existing['owner']['S'] != ExpressionAttributeValues[':owner']['S']:
+            raise self.conditional_check_failed()
+        del self.items[Key['key']['S']]
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        item = self.items.get(Key['key']['S'])
+        return {'Item': item} if item else {}
+
+
+def test_lease_is_held_by_one_container_until_released_or_expired():
+    now = [1000.0]
+    dynamodb = FakeDynamoDB()
+    first = AnalysisLease('leases', client=dynamodb, ttl=60, clock=lambda: now[0])
+    second = AnalysisLease('leases', client=dynamodb, ttl=60, clock=lambda: now[0])
+
+    assert first.acquire('key')
+    assert not second.acquire('key')
+    assert second.is_held('key')
+
+    # only the holder can release the lease
+    second.release('key')
+    assert second.is_held('key')
+    first.release('key')
+    assert not second.is_held('key')
+
+    assert second.acquire('key')
+    now[0] += 61
+    assert first.acquire('key')
+
+
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+def test_waits_for_result_from_container_holding_the_lease(_, tmp_path, monkeypatch):
+    monkeypatch.setenv('ANALYSIS_RESULT_CACHE', f"local:{tmp_path}")
+    monkeypatch.setattr(result_cache, 'result_cache', None)
+    monkeypatch.setattr('chalicelib.processors.GenericProcessor.analysis_lease_poll_interval', 0.05)
+
+    dynamodb = FakeDynamoDB()
+    other_container = AnalysisLease('leases', client=dynamodb)
+    monkeypatch.setattr(single_flight, 'analysis_lease', AnalysisLease('leases', client=dynamodb))
+    monkeypatch.setenv('ANALYSIS_LEASE', 'dynamodb:leases')
+
+    processor = GenericProcessor.__new__(GenericProcessor)
+    params = {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': 'find the bugs'}]}
+    result = {'message': {'role': 'assistant', 'content': 'no bugs'}, 'response': 'no bugs', 'finish': 'stop',
+              'input_tokens': 100, 'output_tokens': 20}
+
+    key = processor.analysis_key(params)
+    assert other_container.acquire(key)
+
+    def other_container_finishes():
+        time.sleep(0.2)
+        result_cache.get_result_cache().put(key, result)
+        other_container.release(key)
+
+    threading.Thread(target=other_container_finishes).start()
+
+    with patch.object(GenericProcessor, 'runAnalysis') as runAnalysis:
+        shared = processor.runAnalysisForPrompt(0, params['messages'], 0, 100, params, account, 'test', 'correlation-1')
+
+    runAnalysis.assert_not_called()
+    assert shared['coalesced'] and shared['response'] == 'no bugs'
+
+
+@pytest.mark.parametrize('call_timeout, request_time_left', [(0.3, None), (60, 0.3)])
+def test_wait_for_lease_is_bounded_by_the_call_and_request_time(tmp_path, monkeypatch, call_timeout, request_time_left):
+    monkeypatch.setenv('ANALYSIS_RESULT_CACHE', f"local:{tmp_path}")
+    monkeypatch.setattr(result_cache, 'result_cache', None)
+    monkeypatch.setattr('chalicelib.processors.GenericProcessor.analysis_lease_poll_interval', 0.05)
+
+    dynamodb = FakeDynamoDB()
+    monkeypatch.setattr(single_flight, 'analysis_lease', AnalysisLease('leases', client=dynamodb))
+    monkeypatch.setenv('ANALYSIS_LEASE', 'dynamodb:leases')
+
+    processor = GenericProcessor.__new__(GenericProcessor)
+    processor.get_call_timeout_settings = lambda data: (call_timeout, 120, 180)
+    params = {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': 'find the bugs'}]}
+
+    # a stuck container holds the lease for its full TTL
+    assert AnalysisLease('leases', client=dynamodb).acquire(processor.analysis_key(params))
+
+    result = {'message': {'role': 'assistant', 'content': 'no bugs'}, 'response': 'no bugs', 'finish': 'stop',
+              'input_tokens': 100, 'output_tokens': 20}
+
+    deadline_token = openai_calls_deadline.set(time.time() + request_time_left if request_time_left is not None else None)
+    try:
+        start_time = time.time()
+        with patch.object(GenericProcessor, 'runAnalysis', return_value=result) as runAnalysis:
+            analyzed = processor.runAnalysisForPrompt(0, params['messages'], 0, 100, params, account, 'test', 'correlation-1')
+    finally:
+        openai_calls_deadline.reset(deadline_token)
+
+    # the analysis ran here once the wait was used up
+    assert 0.25 < time.time() - start_time < 2
+    runAnalysis.assert_called_once()
+    assert analyzed['response'] == 'no bugs' and not analyzed.get('coalesced')
+
+
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+def test_async_chunk_shares_a_threaded_call_in_flight(_):
+    processor = GenericProcessor.__new__(GenericProcessor)
+    processor.get_call_timeout_settings = lambda data: (60, 120, 180)
+    messages = [{'role': 'user', 'content': 'find the bugs'}]
+    key = processor.analysis_key(processor.get_prompt_params(messages, 100, {'model': 'gpt-4'}))
+
+    started = threading.Event()
+
+    # another request's chunk thread is making the identical call
+    def threaded_call():
+        started.set()
+        time.sleep(0.2)
+        return {'message': {'role': 'assistant', 'content': 'no bugs'}, 'response': 'no bugs', 'finish': 'stop',
+                'input_tokens': 100, 'output_tokens': 20}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor, \
+            patch('openai.ChatCompletion.acreate') as acreate:
+        leader = executor.submit(single_flight.analysis_flights.do, key, threaded_call)
+        started.wait()
+
+        results = asyncio.run(processor.runAnalysisForPromptsAsync([(messages, 100, 200, 0)], None, {'model': 'gpt-4'},
+                                                                   account, 'test', 'correlation-1', print))
+
+    acreate.assert_not_called()
+    assert leader.result() == (threaded_call(), False)
+    assert results[0]['coalesced'] and results[0]['response'] == 'no bugs'
+
+
+@patch('chalicelib.processors.GenericProcessor.init_openai_api_key')
+def test_async_chunk_waits_for_result_from_container_holding_the_lease(_, tmp_path, monkeypatch):
+    monkeypatch.setenv('ANALYSIS_RESULT_CACHE', f"local:{tmp_path}")
+    monkeypatch.setattr(result_cache, 'result_cache', None)
+    monkeypatch.setattr('chalicelib.processors.GenericProcessor.analysis_lease_poll_interval', 0.05)
+
+    dynamodb = FakeDynamoDB()
+    other_container = AnalysisLease('leases', client=dynamodb)
+    monkeypatch.setattr(single_flight, 'analysis_lease', AnalysisLease('leases', client=dynamodb))
+    monkeypatch.setenv('ANALYSIS_LEASE', 'dynamodb:leases')
+
+    processor = GenericProcessor.__new__(GenericProcessor)
+    processor.get_call_timeout_settings = lambda data: (60, 120, 180)
+    messages = [{'role': 'user', 'content': 'find the bugs'}]
+    result = {'message': {'role': 'assistant', 'content': 'no bugs'}, 'response': 'no bugs', 'finish': 'stop',
+              'input_tokens': 100, 'output_tokens': 20}
+
+    key = processor.analysis_key(processor.get_prompt_params(messages, 100, {'model': 'gpt-4'}))
+    assert other_container.acquire(key)
+
+    def other_container_finishes():
+        time.sleep(0.2)
+        result_cache.get_result_cache().put(key, result)
+        other_container.release(key)
+
+    threading.Thread(target=other_container_finishes).start()
+
+    # the result cache is read off the event loop
+    cache_threads = []
+    cache = result_cache.get_result_cache()
+    cache_get = cache.get
+
+    def get(key):
+        cache_threads.append(threading.current_thread())
+        return cache_get(key)
+
+    with patch('openai.ChatCompletion.acreate') as acreate, patch.object(cache, 'get', side_effect=get):
+        results = asyncio.run(processor.runAnalysisForPromptsAsync([(messages, 100, 200, 0)], None, {'model': 'gpt-4'},
+                                                                   account, 'test', 'correlation-1', print))
+
+    acreate.assert_not_called()
+    assert results[0]['coalesced'] and results[0]['response'] == 'no bugs'
+    assert cache_threads and threading.main_thread() not in cache_threads
@@ -4,7 +4,23 @@ import os
 from botocore.exceptions import ClientError
 import datetime
 
+import chalicelib.disk_cache
 import chalicelib.storage
+from chalicelib.disk_cache import DiskCache
+
+
+def s3_error(code):
+    return ClientError({'Error': {'Code': code}}, 'GetObject')
+
+
+@pytest.fixture(autouse=True)
+def reset_storage(tmp_path, monkeypatch):
+    chalicelib.storage.s3_client = None
+    chalicelib.storage.s3_metadata_cache = {}
+    monkeypatch.setattr(chalicelib.disk_cache, 'disk_cache', DiskCache(str(tmp_path / 'disk-cache')))
+    yield
+    chalicelib.storage.s3_client = None
+    chalicelib.storage.s3_metadata_cache = {}
 
 
 @patch('os.path.getmtime', return_value=1234567890)
@@ -13,9 +29,8 @@ def test_get_file_from_cache(mock_os_path_getmtime):
     assert chalicelib.storage.get_file("sample.txt") == "This is a cached file."
 
 
-@patch('chalicelib.storage.file_exists_in_s3', return_value=True)
 @patch('boto3.client')
-def test_get_file_from_s3(mock_client, mock_exists_in_s3):
+def test_get_file_from_s3(mock_client):
     os.environ["CHALICE_STAGE"] = "dev"
     chalicelib.storage.file_contents_cache = {}
 
@@ -29,7 +44,8 @@ def test_get_file_from_s3(mock_client, mock_exists_in_s3):
     # Mock the LastModified return value to be your mocked datetime
     s3_mock.get_object.return_value = {
         'Body': Mock(read=lambda: b"Content from S3"),
-        'LastModified': mocked_datetime
+        'LastModified': mocked_datetime,
+        'ETag': '"v1"'
     }
 
     mock_client.return_value = s3_mock
@@ -37,9 +53,9 @@ def test_get_file_from_s3(mock_client, mock_exists_in_s3):
     assert chalicelib.storage.get_file("sample.txt") == "Content from S3"
 
 
-@patch('chalicelib.storage.file_exists_in_s3', MagicMock(return_value=False))
+@patch('boto3.client', MagicMock(return_value=Mock(get_object=Mock(side_effect=s3_error('NoSuchKey')))))
 @patch('builtins.open', side_effect=FileNotFoundError())
-def test_get_file_not_found(mock_exists_in_s3):
+def test_get_file_not_found(mock_open):
     os.environ["CHALICE_STAGE"] = "dev"
     with pytest.raises(FileNotFoundError):
         chalicelib.storage.get_file("non_existent_file.txt")
@@ -59,10 +75,10 @@ class MockFile:
         pass
 
 
-@patch('chalicelib.storage.file_exists_in_s3', return_value=False)
+@patch('boto3.client', MagicMock(return_value=Mock(get_object=Mock(side_effect=s3_error('NoSuchKey')))))
 @patch('os.path.getmtime', return_value=1234567890)
 @patch('builtins.open', side_effect=lambda x, y: MockFile("Local content"))
-def test_get_file_from_local(mock_exists_in_s3, mock_path_gettime, mock_open):
+def test_get_file_from_local(mock_path_gettime, mock_open):
     chalicelib.storage.file_contents_cache = {}
     os.environ["CHALICE_STAGE"] = "dev"
     content = chalicelib.storage.get_file("sample.txt")
@@ -87,3 +103,53 @@ def test_file_exists_in_s3_false(mock_client):
     mock_client.return_value = s3_mock
 
     assert chalicelib.storage.file_exists_in_s3(chalicelib.storage.s3_storage_bucket_name, "non_existent_file.txt") is False
+
+
+@patch('boto3.client')
+def test_get_file_from_s3_is_revalidated_after_ttl(mock_client, monkeypatch):
+    os.environ["CHALICE_STAGE"] = "dev"
+    chalicelib.storage.file_contents_cache = {}
+
+    now = [1000.0]
+    monkeypatch.setattr('chalicelib.storage.time.monotonic', lambda: now[0])
+
+    s3_mock = Mock()
+    s3_mock.get_object.return_value = {
+        'Body': Mock(read=lambda: b"Content from S3"),
+        'LastModified': datetime.datetime.fromtimestamp(1628857792.0),
+        'ETag': '"v1"'
+    }
+    mock_client.return_value = s3_mock
+
+    assert chalicelib.storage.get_file("sample.txt") == "Content from S3"
+
+    # within the TTL, the cached contents are used without calling S3
+    assert chalicelib.storage.get_file("sample.txt") == "Content from S3"
+    assert s3_mock.get_object.call_count == 1
+
+    # after it, a conditional GET only confirms the contents haven't changed
+    now[0] += chalicelib.storage.s3_metadata_ttl + 1
+    s3_mock.get_object.side_effect = s3_error('304')
+    assert chalicelib.storage.get_file("sample.txt") == "Content from S3"
+    assert s3_mock.get_object.call_args.kwargs['IfNoneMatch'] == '"v1"'
+    assert chalicelib.storage.get_file_time("sample.txt") == 1628857792.0
+
+    # one client is shared by all calls
+    mock_client.assert_called_once_with('s3')
+
+
+@patch('boto3.client')
+def test_missing_s3_files_are_not_probed_again_within_ttl(mock_client):
+    os.environ["CHALICE_STAGE"] = "prod"
+    chalicelib.storage.file_contents_cache = {}
+
+    s3_mock = Mock()
+    s3_mock.get_object.side_effect = s3_error('NoSuchKey')
+    mock_client.return_value = s3_mock
+
+    with patch('os.path.getmtime', return_value=1234567890), \
+            patch('builtins.open', side_effect=lambda x, y: MockFile("Local content")):
+        assert chalicelib.storage.get_file("sample.txt") == "Local content"
+        assert chalicelib.storage.get_file("sample.txt") == "Local content"
+
+    assert s3_mock.get_object.call_count == 1
@@ -0,0 +1,101 @@
+import fnmatch
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import chalicelib.storage
+from chalicelib.storage_index import StorageIndex
+from chalicelib.processors.GenericProcessor import GenericProcessor
+
+
+@pytest.fixture(autouse=True)
+def reset_storage(monkeypatch):
+    monkeypatch.setenv('useDiskCache', 'False')
+    monkeypatch.setattr(chalicelib.storage, 'storage_indexes', {})
+    monkeypatch.setattr(chalicelib.storage, 'file_contents_cache', {})
+    monkeypatch.setattr(chalicelib.storage, 's3_metadata_cache', {})
+
+
+@pytest.fixture
+def local_prompts(tmp_path, monkeypatch):
+    monkeypatch.setenv('CHALICE_STAGE', 'local')
+    monkeypatch.chdir(tmp_path)
+    prompt_dir = tmp_path / 'chalicelib' / 'prompts'
+    prompt_dir.mkdir(parents=True)
+    return prompt_dir
+
+
+def test_search_matches_fnmatch():
+    paths = ['prompts/a.prompt', 'prompts/guidelines-user-1.prompt', 'prompts/guidelines-user-2.prompt',
+             'prompts/guidelines-assistant-1.prompt', 'prompts/main.prompt', 'other/guidelines-user-1.prompt']
+    index = StorageIndex(paths, 'v1')
+
+    for pattern in ['guidelines-user-*.prompt', '*.prompt', 'guidelines-?ser-[12].prompt', 'missing-*', None]:
+        expected = sorted(path for path in paths if path.startswith('prompts')
+                          and (pattern is None or fnmatch.fnmatch(path, os.path.join('prompts', pattern))))
+        assert index.search('prompts', pattern) == expected
+
+    # resolved patterns are kept with the index
+    assert ('prompts', '*.prompt') in index.matches
+
+
+def test_local_index_is_refreshed_when_files_are_added(local_prompts, monkeypatch):
+    (local_prompts / 'guidelines-user-1.prompt').write_text('one')
+    assert chalicelib.storage.search_storage('prompts', 'guidelines-user-*.prompt') == ['prompts/guidelines-user-1.prompt']
+
+    # an unchanged directory is not listed again
+    with monkeypatch.context() as m:
+        m.setattr(os, 'listdir', lambda path: pytest.fail("directory listed again"))
+        assert chalicelib.storage.search_storage('prompts', 'guidelines-user-*.prompt') == ['prompts/guidelines-user-1.prompt']
+
+    (local_prompts / 'guidelines-user-2.prompt').write_text('two')
+    os.utime(local_prompts, ns=(0, os.stat(local_prompts).st_mtime_ns + 1))
+    assert chalicelib.storage.search_storage('prompts', 'guidelines-user-*.prompt') == ['prompts/guidelines-user-1.prompt',
+                                                                                         'prompts/guidelines-user-2.prompt']
+
+
+def test_s3_index_is_kept_when_the_listing_has_not_changed(monkeypatch):
+    listings = []
+    objects = [['prod/prompts/a.prompt', '"1"']]
+
+    def paginate(Bucket, Prefix, **kwargs):
+        listings.append(Prefix)
+        return [{'Contents': [{'Key': key, 'ETag': etag} for key, etag in objects]}]
+
+    monkeypatch.setenv('CHALICE_STAGE', 'prod')
+    monkeypatch.setattr(chalicelib.storage, 's3_client', SimpleNamespace(get_paginator=lambda operation: SimpleNamespace(paginate=paginate)))
+
+    index = chalicelib.storage.get_storage_index('prod', 'prompts')
+    assert chalicelib.storage.search_storage('prompts', '*.prompt') == ['prompts/a.prompt']
+    assert len(listings) == 1
+
+    # after the TTL, an unchanged listing keeps the index
+    monkeypatch.setattr(chalicelib.storage, 's3_metadata_ttl', 0)
+    assert chalicelib.storage.get_storage_index('prod', 'prompts') is index
+    assert len(listings) == 2
+
+    objects.append(['prod/prompts/b.prompt', '"1"'])
+    assert chalicelib.storage.search_storage('prompts', '*.prompt') == ['prompts/a.prompt', 'prompts/b.prompt']
+
+
+def test_new_numbered_prompts_are_detected(local_prompts):
+    (local_prompts / 'guidelines-system-1.prompt').write_text('first')
+
+    processor = GenericProcessor.__new__(GenericProcessor)
+    processor.prompt_filenames = []
+    processor.numbered_prompt_keys = [['system', 'guidelines']]
+    processor.prompt_files_timestamps = {}
+    processor.prompts = None
+    processor.load_prompts_locked()
+
+    assert [prompt[0] for prompt in processor.prompts] == [['system', 'guidelines-system-1.prompt']]
+    assert not processor.check_prompt_files_changed()
+
+    (local_prompts / 'guidelines-system-2.prompt').write_text('second')
+    os.utime(local_prompts, ns=(0, os.stat(local_prompts).st_mtime_ns + 1))
+    assert processor.check_prompt_files_changed()
+
+    processor.load_prompts_locked()
+    assert [prompt[0] for prompt in processor.prompts] == [['system', 'guidelines-system-1.prompt'],
+                                                           ['system', 'guidelines-system-2.prompt']]
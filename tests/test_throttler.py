@@ -0,0 +1,72 @@
+from chalicelib.openai_throttler import Throttler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def make_throttler(clock, rate_limit_tokens_per_minute=40000):
+    # large overall timeouts, so the throttler is never bypassed during the simulation
+    return Throttler(rate_limit_tokens_per_minute, 600, 3600, 60, clock=clock)
+
+
+def test_wait_time_is_exact():
+    clock = FakeClock()
+    throttler = make_throttler(clock, 6000)  # 100 tokens per second
+
+    assert throttler.get_wait_time(6000, clock(), 0) == 0.0
+    assert throttler.get_wait_time(500, clock(), 0) == 5.0
+
+    clock.advance(2)
+    assert throttler.get_wait_time(500, clock(), 0) == 3.0
+
+    clock.advance(3)
+    assert throttler.get_wait_time(500, clock(), 0) == 0.0
+
+
+def test_oversized_call_waits_for_full_bucket_then_goes_into_debt():
+    clock = FakeClock()
+    throttler = make_throttler(clock, 6000)
+
+    assert throttler.get_wait_time(3000, clock(), 0) == 0.0
+    assert throttler.get_wait_time(9000, clock(), 0) == 30.0
+
+    clock.advance(30)
+    assert throttler.get_wait_time(9000, clock(), 0) == 0.0
+
+    # the bucket owes 3000 tokens, so a 600 token call waits for 3600 tokens to accrue
+    assert throttler.get_wait_time(600, clock(), 0) == 36.0
+
+
+def test_sustained_throughput_matches_rate_limit():
+    clock = FakeClock()
+    rate_limit_tokens_per_minute = 40000
+    throttler = make_throttler(clock, rate_limit_tokens_per_minute)
+
+    # a steady stream of calls of varying size, each waiting exactly as long as the throttler asks
+    call_sizes = [1200, 3500, 800, 2600, 4000, 1500]
+    simulated_minutes = 30
+    tokens_sent = 0
+    call = 0
+    while clock() < 1000.0 + simulated_minutes * 60:
+        tokens_needed = call_sizes[call % len(call_sizes)]
+        delay = throttler.get_wait_time(tokens_needed, clock(), tokens_needed)
+        if delay > 0:
+            clock.advance(delay)
+            continue
+
+        tokens_sent += tokens_needed
+        call += 1
+
+    # the initial full bucket is a one-time burst on top of the sustained rate
+    sustained_tokens_per_minute = (tokens_sent - rate_limit_tokens_per_minute) / simulated_minutes
+    print(f"Sustained throughput: {sustained_tokens_per_minute:.0f} tokens/minute over {simulated_minutes} minutes ({call} calls)")
+
+    assert 0.97 * rate_limit_tokens_per_minute <= sustained_tokens_per_minute <= rate_limit_tokens_per_minute
@@ -0,0 +1,54 @@
+from unittest.mock import patch
+
+from chalicelib.usage import (
+    OpenAIDefaults,
+    TokenLedger,
+    get_token_ledger,
+    token_ledger_scope
+)
+
+
+def fake_tokenizer(string, model=OpenAIDefaults.boost_default_gpt_model):
+    tokens = [ord(c) for c in string]
+    return len(tokens), tokens
+
+
+@patch('chalicelib.usage.num_tokens_from_string', side_effect=fake_tokenizer)
+def test_ledger_tokenizes_each_string_once(mock_num_tokens):
+    ledger = TokenLedger()
+
+    for _ in range(5):
+        count, tokens = ledger.num_tokens_from_string("def foo():\n    return 1\n")
+
+    assert count == len("def foo():\n    return 1\n")
+    assert tokens == [ord(c) for c in "def foo():\n    return 1\n"]
+    assert mock_num_tokens.call_count == 1
+    assert ledger.hits == 4
+    assert ledger.misses == 1
+
+
+@patch('chalicelib.usage.num_tokens_from_string', side_effect=fake_tokenizer)
+def test_ledger_is_keyed_by_encoding(mock_num_tokens):
+    ledger = TokenLedger()
+
+    ledger.num_tokens_from_string("same content", OpenAIDefaults.boost_model_gpt4)
+    # gpt-3.5 turbo shares the gpt-4 encoding, so this is a cache hit
+    ledger.num_tokens_from_string("same content", OpenAIDefaults.boost_model_gpt35_cheap_chat)
+    # codex uses a different encoding, so it must be tokenized again
+    ledger.num_tokens_from_string("same content", OpenAIDefaults.boost_model_codex)
+
+    assert mock_num_tokens.call_count == 2
+
+
+@patch('chalicelib.usage.num_tokens_from_string', side_effect=fake_tokenizer)
+def test_ledger_scope_is_shared_within_request(mock_num_tokens):
+    with token_ledger_scope() as ledger:
+        assert get_token_ledger() is ledger
+
+        get_token_ledger().num_tokens_from_string("user input")
+        get_token_ledger().get_openai_usage_per_string("user input", True)
+
+    assert mock_num_tokens.call_count == 1
+
+    # outside of a request scope, each caller gets its own ledger
+    assert get_token_ledger() is not ledger
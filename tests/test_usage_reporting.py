@@ -0,0 +1,117 @@
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from chalicelib import usage_reporting
+from chalicelib.usage_reporting import (
+    flush_usage_records,
+    load_spool,
+    replay_usage_spool,
+    append_to_spool,
+    batch_usage_records
+)
+
+
+@pytest.fixture(autouse=True)
+def usage_spool(tmp_path):
+    spool_path = str(tmp_path / 'usage_spool.jsonl')
+    with patch('chalicelib.usage_reporting.usage_spool_path', spool_path), \
+            patch('chalicelib.usage_reporting.usage_flush_thread', MagicMock()):
+        usage_reporting.pending_usage_records.clear()
+        usage_reporting.pending_usage_batches.clear()
+        yield spool_path
+
+
+def queue(subscription_item, quantity):
+    return usage_reporting.queue_usage_record(subscription_item, quantity)
+
+
+@patch('chalicelib.payments.report_usage_record')
+def test_usage_aggregated_per_subscription_item(mock_report, usage_spool):
+    queue('si_1', 2)
+    queue('si_2', 1)
+    queue('si_1', 3)
+
+    assert flush_usage_records() == (2, 0)
+
+    reported = {call.args[0]: call.args[1] for call in mock_report.call_args_list}
+    assert reported == {'si_1': 5, 'si_2': 1}
+
+    # spool is removed once everything is reported
+    assert load_spool(usage_spool) == ([], {})
+
+
+def test_idempotency_key_is_deterministic():
+    records = [{'id': 'a', 'subscription_item': 'si_1', 'quantity': 1, 'timestamp': 1},
+               {'id': 'b', 'subscription_item': 'si_1', 'quantity': 1, 'timestamp': 2}]
+
+    assert batch_usage_records(records)[0]['idempotency_key'] == batch_usage_records(list(reversed(records)))[0]['idempotency_key']
+
+
+@patch('chalicelib.payments.report_usage_record')
+def test_failed_batch_is_retried_with_same_idempotency_key(mock_report, usage_spool):
+    mock_report.side_effect = Exception("Stripe unavailable")
+    queue('si_1', 2)
+
+    assert flush_usage_records() == (0, 1)
+    _, unreported_batches = load_spool(usage_spool)
+    assert len(unreported_batches) == 1
+
+    mock_report.side_effect = None
+    assert flush_usage_records() == (1, 0)
+
+    idempotency_keys = {call.args[3] for call in mock_report.call_args_list}
+    assert idempotency_keys == set(unreported_batches.keys())
+
+
+@patch('chalicelib.payments.report_usage_record')
+def test_replay_spool(mock_report, tmp_path):
+    spool_path = str(tmp_path / 'failed_spool.jsonl')
+    records = [{'type': 'record', 'id': 'a', 'subscription_item': 'si_1', 'quantity': 1, 'timestamp': 1},
+               {'type': 'record', 'id': 'b', 'subscription_item': 'si_1', 'quantity': 4, 'timestamp': 2},
+               {'type': 'record', 'id': 'c', 'subscription_item': 'si_2', 'quantity': 1, 'timestamp': 3}]
+    reported_batch = batch_usage_records(records[2:])[0]
+    append_to_spool(records + [reported_batch, {'type': 'reported', 'idempotency_key': reported_batch['idempotency_key']}], spool_path)
+
+    assert replay_usage_spool(spool_path, dry_run=True) == (0, 0)
+    assert mock_report.call_count == 0
+
+    # only the records that were never reported are replayed
+    assert replay_usage_spool(spool_path) == (1, 0)
+    assert mock_report.call_args.args[:2] == ('si_1', 5)
+
+
+@patch('chalicelib.payments.report_usage_record')
+@patch('chalicelib.app_utils.validate_request_lambda', return_value={'email': 'test@polyverse.com', 'organization': 'polyverse-appsec', 'enabled': True, 'status': 'paid'})
+def test_usage_is_not_reported_on_the_request_path(mock_validate, mock_report):
+    from chalicelib.app_utils import process_request
+
+    # a failed batch from an earlier request (e.g. Stripe is down)
+    usage_reporting.pending_usage_batches['boost-usage-earlier'] = {'idempotency_key': 'boost-usage-earlier'}
+
+    def bill(data, account, function_name, correlation_id):
+        queue('si_1', 4)
+        return {'status': 'ok'}
+
+    response = process_request({'body': '{"code": "x"}', 'headers': {}}, bill, '0.0.0')
+
+    assert response['statusCode'] == 200
+    # the background thread reports it - the response never waits on Stripe
+    mock_report.assert_not_called()
+    assert [record['quantity'] for record in usage_reporting.pending_usage_records] == [4]
+
+
+def test_next_invocation_resumes_reporting_spooled_usage(usage_spool):
+    append_to_spool([{'type': 'record', 'id': 'a', 'subscription_item': 'si_1', 'quantity': 2, 'timestamp': 1}], usage_spool)
+
+    with patch('chalicelib.usage_reporting.usage_flush_thread', None), \
+            patch('chalicelib.usage_reporting.threading.Thread') as thread, \
+            patch('chalicelib.usage_reporting.atexit.register'):
+        usage_reporting.resume_usage_reporting()
+
+        thread.return_value.start.assert_called_once()
+        assert [record['id'] for record in usage_reporting.pending_usage_records] == ['a']
+
+        # and once it is running, a request does nothing
+        usage_reporting.resume_usage_reporting()
+        assert thread.call_count == 1